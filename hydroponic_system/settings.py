@@ -14,6 +14,7 @@ import os
 from datetime import timedelta
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -25,13 +26,25 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
+# Settings profile: "production" turns DEBUG off, leaves out the debug-only
+# apps and middleware and takes the secret key and the allowed hosts (comma
+# separated) from the environment.
+PROFILE = os.getenv("PROFILE", "development")
+
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = "django-insecure-h5oqt9&nt2!&)#gceu=)_w3fo@9^r9$((@w#$5_jp4xz3ulrb8"
+SECRET_KEY = os.getenv(
+    "SECRET_KEY",
+    "django-insecure-h5oqt9&nt2!&)#gceu=)_w3fo@9^r9$((@w#$5_jp4xz3ulrb8",
+)
+if PROFILE == "production" and SECRET_KEY.startswith("django-insecure-"):
+    raise ImproperlyConfigured("Set SECRET_KEY for the production profile.")
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = PROFILE != "production"
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = list(filter(None, os.getenv("ALLOWED_HOSTS", "").split(",")))
+if PROFILE == "production" and not ALLOWED_HOSTS:
+    raise ImproperlyConfigured("Set ALLOWED_HOSTS for the production profile.")
 
 
 # Application definition
@@ -45,22 +58,29 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     "django_filters",
     "drf_yasg",
-    "debug_toolbar",
     "rest_framework",
     "hydroponics",
 ]
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "hydroponics.profiling.ProfilingMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "hydroponics.routers.ReplicaRoutingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
 ]
 
+if DEBUG:
+    INSTALLED_APPS.append("debug_toolbar")
+    MIDDLEWARE.append("debug_toolbar.middleware.DebugToolbarMiddleware")
+else:
+    # Serves the collected static files, see STATIC_ROOT.
+    MIDDLEWARE.insert(1, "whitenoise.middleware.WhiteNoiseMiddleware")
+
 ROOT_URLCONF = "hydroponic_system.urls"
 
 TEMPLATES = [
@@ -81,6 +101,19 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "hydroponic_system.wsgi.application"
 
+# `manage.py serve`: the application is loaded once and WORKERS processes
+# (THREADS threads each) are forked from it. A worker is replaced after
+# MAX_REQUESTS requests (plus up to 10% jitter), finishing its requests
+# within GRACEFUL_TIMEOUT seconds.
+HYDROPONICS_SERVER_BIND = os.getenv("SERVER_BIND", "0.0.0.0:8000")
+HYDROPONICS_SERVER_WORKERS = int(
+    os.getenv("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1)
+)
+HYDROPONICS_SERVER_THREADS = int(os.getenv("SERVER_THREADS", 1))
+HYDROPONICS_SERVER_MAX_REQUESTS = 10000
+HYDROPONICS_SERVER_TIMEOUT = 30
+HYDROPONICS_SERVER_GRACEFUL_TIMEOUT = 30
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -96,6 +129,106 @@ DATABASES = {
     }
 }
 
+# Database connections (see hydroponics.pooling). With DATABASE_POOL=1 each
+# process keeps a pool of POOL_MIN_SIZE to POOL_MAX_SIZE connections per
+# database, checked before being lent; a request waiting longer than
+# POOL_TIMEOUT seconds for one fails. Otherwise a connection is kept for
+# CONN_MAX_AGE seconds and checked when reused (set it to 0 under ASGI, or
+# use the pool). DATABASE_POOLER=transaction declares an external pooler in
+# transaction mode (e.g. PgBouncer) in front of the databases: queries use
+# no server-side cursors and no session settings.
+HYDROPONICS_DATABASE_POOL = os.getenv("DATABASE_POOL", "") == "1"
+HYDROPONICS_DATABASE_POOLER = os.getenv("DATABASE_POOLER", "session")
+if HYDROPONICS_DATABASE_POOL:
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": int(os.getenv("DATABASE_POOL_MIN_SIZE", 2)),
+            "max_size": int(os.getenv("DATABASE_POOL_MAX_SIZE", 10)),
+            "timeout": float(os.getenv("DATABASE_POOL_TIMEOUT", 10)),
+        },
+    }
+else:
+    DATABASES["default"]["CONN_MAX_AGE"] = int(os.getenv("CONN_MAX_AGE", 60))
+DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = (
+    HYDROPONICS_DATABASE_POOLER == "transaction"
+)
+
+
+def add_databases(variable, prefix, **options):
+    """
+    Adds a copy of the default database for every host[:port][/name]
+    listed in the environment variable and returns the new aliases.
+    """
+    aliases = []
+    for index, address in enumerate(
+        filter(None, os.getenv(variable, "").split(",")), start=1
+    ):
+        address, _, name = address.strip().partition("/")
+        host, _, port = address.partition(":")
+        alias = f"{prefix}{index}"
+        DATABASES[alias] = {
+            **DATABASES["default"],
+            "NAME": name or DATABASES["default"]["NAME"],
+            "HOST": host,
+            "PORT": port or DATABASES["default"]["PORT"],
+            **options,
+        }
+        aliases.append(alias)
+    return aliases
+
+
+# Optional read replicas, e.g. DATABASE_REPLICA_HOSTS=replica1:5432,replica2.
+# Reads of safe requests are routed to them by hydroponics.routers; tests
+# mirror them to the primary.
+DATABASE_REPLICAS = add_databases(
+    "DATABASE_REPLICA_HOSTS", "replica", TEST={"MIRROR": "default"}
+)
+
+# Optional owner-based shards, e.g. DATABASE_SHARD_HOSTS=shard1:5432,db/shard2.
+# The default database is the first shard; each shard is migrated with
+# `migrate --database <alias>`.
+DATABASE_SHARDS = add_databases("DATABASE_SHARD_HOSTS", "shard")
+if DATABASE_SHARDS:
+    DATABASE_SHARDS.insert(0, "default")
+
+DATABASE_ROUTERS = [
+    "hydroponics.routers.ShardRouter",
+    "hydroponics.routers.ReplicaRouter",
+]
+
+# Seconds a client keeps reading from the primary after a write.
+HYDROPONICS_REPLICA_PIN_SECONDS = 10
+
+# Seconds a shard map entry is cached per process. Moving a tenant waits
+# for this long after every change of the map.
+HYDROPONICS_SHARD_MAP_CACHE_TTL = 5
+
+# IDs of sharded tables are allocated modulo this stride (max. shards).
+HYDROPONICS_SHARD_ID_STRIDE = 64
+
+# Cache shared by all processes (REDIS_URL, e.g. redis://redis:6379/0),
+# holding the token versions, read-your-writes pins and rate limits.
+# Without it each process has its own memory cache, so revocations and
+# pins are seen by other processes only once their entries expire and
+# rate limits apply per process; `manage.py serve` then refuses to start
+# more than one worker.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+            "KEY_PREFIX": "hydroponics",
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -119,7 +252,7 @@ AUTH_PASSWORD_VALIDATORS = [
 REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "hydroponics.authentication.StatelessJWTAuthentication",
     ),
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend",
@@ -127,17 +260,152 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Pre-generated OpenAPI document (`manage.py generate_schema`), served by
+# /api/schema.json and loaded from there by Swagger UI and ReDoc.
+HYDROPONICS_OPENAPI_SCHEMA = BASE_DIR / "hydroponic_system" / "openapi.json"
+SWAGGER_SETTINGS = {"SPEC_URL": "schema-json"}
+REDOC_SETTINGS = {"SPEC_URL": "schema-json"}
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    "TOKEN_OBTAIN_SERIALIZER": "hydroponics.authentication.VersionedTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "hydroponics.authentication.VersionedTokenRefreshSerializer",
+    "TOKEN_USER_CLASS": "hydroponics.authentication.LightweightUser",
 }
 
+# Token versions are cached in the Django cache for TTL seconds, the
+# longest a revoked token is accepted by a process that has not seen the
+# revocation (see CACHES); full User objects in a per-process cache used by
+# LightweightUser.get_full_user().
+HYDROPONICS_TOKEN_VERSION_CACHE_TTL = 30
+HYDROPONICS_USER_CACHE_SIZE = 1000
+HYDROPONICS_USER_CACHE_TTL = 60
+
+# Windows up to this length are computed exactly from raw measurements,
+# longer ones from hourly rollups (see `manage.py rollup_measurements`).
+HYDROPONICS_STATS_EXACT_WINDOW = timedelta(days=7)
+
+# Hours before the last rollup recomputed by every `rollup_measurements`
+# run, so that readings stored late (buffered ingestion, client timestamps,
+# offline batches) are included. Older imports need `--hours`.
+HYDROPONICS_ROLLUP_LOOKBACK_HOURS = int(os.getenv("ROLLUP_LOOKBACK_HOURS", 48))
+
+# Number of readings after which the running mean and variance used by
+# z-score alert rules decay exponentially instead of growing forever.
+HYDROPONICS_ALERT_ZSCORE_WINDOW = 1000
+
+# Measurement ingestion: "direct" inserts each request immediately,
+# "buffered" acknowledges readings once they are fsync'd to the local log
+# and inserts them in batches every FLUSH_INTERVAL_MS or FLUSH_ROWS readings.
+# A log segment failing to be inserted MAX_ATTEMPTS times is set aside as
+# `.failed` (see `manage.py flush_ingest_log --retry-failed`).
+HYDROPONICS_INGEST_MODE = os.getenv("INGEST_MODE", "direct")
+HYDROPONICS_INGEST_LOG_DIR = Path(
+    os.getenv("INGEST_LOG_DIR", BASE_DIR / "var" / "ingest")
+)
+HYDROPONICS_INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", 200))
+HYDROPONICS_INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", 1000))
+HYDROPONICS_INGEST_MAX_BATCH = 1000
+HYDROPONICS_INGEST_MAX_ATTEMPTS = 5
+
+# Ingestion rate limits in readings per minute, per sensor (unless its
+# system sets ingest_rate_limit) and per user, shared by the API and the
+# line-protocol listener through the Django cache. Up to BURST_SECONDS of
+# readings may be sent at once; a larger batch is admitted when nothing was
+# sent for as long, and the next one waits until the batch is paid off.
+HYDROPONICS_SENSOR_RATE_LIMIT = 60
+HYDROPONICS_USER_RATE_LIMIT = 6000
+HYDROPONICS_RATE_LIMIT_BURST_SECONDS = 10
+
+# Per-process cache of sensor/system ownership used by permissions,
+# serializers and filters (entries expire after TTL seconds). Changes are
+# announced to the other processes through the Django cache (see CACHES).
+HYDROPONICS_OWNERSHIP_CACHE_SIZE = 10000
+HYDROPONICS_OWNERSHIP_CACHE_TTL = 60
+
 INTERNAL_IPS = [
     "127.0.0.1",
     "localhost",
     "::1",
 ]
 
+HYDROPONICS_METRICS_ALLOWED_IPS = INTERNAL_IPS
+
+# Directory through which the workers of `manage.py serve` and the
+# line-protocol listener share their metrics, so /metrics/ reports all of
+# them whichever worker answers; each process writes its snapshot there
+# every WRITE_INTERVAL seconds (and when a worker exits).
+HYDROPONICS_METRICS_DIR = Path(os.getenv("METRICS_DIR", BASE_DIR / "var" / "metrics"))
+HYDROPONICS_METRICS_WRITE_INTERVAL = 5
+
+# Sync endpoint: changes younger than LAG_SECONDS wait for the next sync
+# (it must exceed the duration of the longest writing transaction),
+# deletions are remembered for TOMBSTONE_DAYS (older watermarks force a
+# full resync), a full sync includes INITIAL_DAYS of measurements and at
+# most PAGE_SIZE measurements are returned per call.
+HYDROPONICS_SYNC_LAG_SECONDS = 5
+HYDROPONICS_SYNC_TOMBSTONE_DAYS = 30
+HYDROPONICS_SYNC_INITIAL_DAYS = 7
+HYDROPONICS_SYNC_PAGE_SIZE = 1000
+
+# Chunked measurement storage (`manage.py compact_measurements`): readings
+# older than AFTER_DAYS are sealed into one compressed chunk per sensor and
+# CHUNK_HOURS period. Lists ordered by anything but measured_at sort at most
+# SORT_LIMIT merged measurements in memory.
+HYDROPONICS_CHUNKED_STORAGE = os.getenv("CHUNKED_STORAGE", "") == "1"
+HYDROPONICS_CHUNK_HOURS = 24
+HYDROPONICS_CHUNK_AFTER_DAYS = 30
+HYDROPONICS_CHUNK_SORT_LIMIT = 100000
+
+# Cold-storage archive (`manage.py archive_measurements`): measurements of
+# the months completed more than AFTER_MONTHS ago are moved from the database
+# into immutable per sensor and month files under ARCHIVE_DIR, which must be
+# shared by all the processes serving reads. Each process keeps the decoded
+# columns of the last CACHE_SIZE files read in memory.
+HYDROPONICS_ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", BASE_DIR / "var" / "archive"))
+HYDROPONICS_ARCHIVE_AFTER_MONTHS = 12
+HYDROPONICS_ARCHIVE_CACHE_SIZE = 64
+
+# Query budgets of the API (hydroponics.budgets) by "<basename>.<action>",
+# each completing the "default" one: queries running longer than
+# statement_timeout_ms are cancelled, lists estimated by the planner above
+# max_cost are rejected before running, and measurement lists without
+# measured_at__gte cover window_days (or are rejected with require_window).
+HYDROPONICS_QUERY_BUDGETS = {
+    "default": {"statement_timeout_ms": 30000},
+    "measurement.list": {
+        "statement_timeout_ms": 10000,
+        "max_cost": 1000000,
+        "window_days": 31,
+    },
+    "alert-event.list": {"statement_timeout_ms": 10000, "max_cost": 1000000},
+}
+
+# Admin lists of tables estimated to hold more rows than this show the
+# PostgreSQL planner estimate instead of an exact count.
+HYDROPONICS_ADMIN_EXACT_COUNT_LIMIT = 10000
+
+# On-demand profiling (hydroponics.profiling) of requests carrying a token
+# from `manage.py profiling_token <staff user>`, valid for TOKEN_MAX_AGE
+# seconds. Reports are written to PROFILING_DIR, which keeps at most
+# MAX_BYTES of the latest ones; stacks are sampled every SAMPLE_INTERVAL
+# seconds.
+HYDROPONICS_PROFILING_DIR = Path(
+    os.getenv("PROFILING_DIR", BASE_DIR / "var" / "profiles")
+)
+HYDROPONICS_PROFILING_MAX_BYTES = 100 * 1024 * 1024
+HYDROPONICS_PROFILING_TOKEN_MAX_AGE = 3600
+HYDROPONICS_PROFILING_SAMPLE_INTERVAL = 0.005
+
+# Background jobs (`manage.py run_jobs`): a running job is taken over by
+# another worker when its lease is not renewed for LEASE_SECONDS; failed
+# attempts are retried after RETRY_BASE_SECONDS, doubling up to MAX.
+HYDROPONICS_JOB_LEASE_SECONDS = 60
+HYDROPONICS_JOB_RETRY_BASE_SECONDS = 10
+HYDROPONICS_JOB_RETRY_MAX_SECONDS = 3600
+HYDROPONICS_JOB_FILES_DIR = Path(os.getenv("JOB_FILES_DIR", BASE_DIR / "var" / "jobs"))
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 
@@ -155,6 +423,18 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Static files are collected into STATIC_ROOT (`manage.py collectstatic`, run
+# when the Docker image is built) and served by WhiteNoise; in production
+# compressed and under names carrying their content hash.
+STATIC_ROOT = Path(os.getenv("STATIC_ROOT", BASE_DIR / "var" / "static"))
+if PROFILE == "production":
+    STORAGES = {
+        "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+        "staticfiles": {
+            "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"
+        },
+    }
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
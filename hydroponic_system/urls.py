@@ -19,26 +19,22 @@ from django.conf import settings
 from django.conf.urls import include
 from django.contrib import admin
 from django.urls import include, path
-from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import (TokenObtainPairView,
                                             TokenRefreshView)
 
-from hydroponics.views import (HydroponicSystemViewSet, MeasurementViewSet,
-                               SensorViewSet)
+from hydroponics.schema import SCHEMA_INFO
+from hydroponics.views import (AlertEventViewSet, AlertRuleViewSet,
+                               HydroponicSystemViewSet, JobViewSet,
+                               MeasurementViewSet, MetricsView, SensorViewSet,
+                               SyncView, liveness, openapi_schema, readiness)
 
+# The UIs load the pre-generated document from /api/schema.json
+# (SPEC_URL in SWAGGER_SETTINGS and REDOC_SETTINGS).
 schema_view = get_schema_view(
-    openapi.Info(
-        title="Hydroponic API",
-        default_version="v1",
-        description=(
-            "All protected endpoints require a JWT token in the request header. "
-            "Use `Authorization: Bearer <token>` to authenticate. "
-            "Obtain a token from `/api/token/` by providing valid credentials."
-        ),
-    ),
+    SCHEMA_INFO,
     public=True,
     permission_classes=[permissions.AllowAny],
 )
@@ -47,12 +43,20 @@ router = DefaultRouter()
 router.register(r"systems", HydroponicSystemViewSet, basename="system")
 router.register(r"sensors", SensorViewSet, basename="sensor")
 router.register(r"measurements", MeasurementViewSet, basename="measurement")
+router.register(r"alert-rules", AlertRuleViewSet, basename="alert-rule")
+router.register(r"alert-events", AlertEventViewSet, basename="alert-event")
+router.register(r"jobs", JobViewSet, basename="job")
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("api/schema.json", openapi_schema, name="schema-json"),
+    path("api/sync/", SyncView.as_view(), name="sync"),
     path("api/", include(router.urls)),
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
+    path("healthz", liveness, name="liveness"),
+    path("readyz", readiness, name="readiness"),
     path(
         "swagger/",
         schema_view.with_ui("swagger", cache_timeout=0),
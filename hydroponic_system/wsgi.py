@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hydroponic_system.settings")
 
 application = get_wsgi_application()
+
+from hydroponics.server import warm_up  # noqa: E402 (needs the apps loaded)
+
+warm_up()
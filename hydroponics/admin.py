@@ -1,15 +1,98 @@
+from datetime import datetime, timedelta
+
 from django.contrib import admin
+from django.db import models
+from django.db.models import Min
+from django.utils import timezone
 
-from .models import HydroponicSystem, Measurement, Sensor
+from .jobs import enqueue
+from .models import AlertEvent, AlertRule, HydroponicSystem, Job, Measurement, Sensor
+from .pagination import EstimatedCountPaginator
+from .sharding import is_sharded, on_shard, shard_aliases
 
 """
 Configuration of the Django Admin interface for the
-HydroponicSystem, Measurement, and Sensor models.
+HydroponicSystem, Measurement, Sensor, AlertRule, AlertEvent and Job models.
 """
 
 
+class ShardListFilter(admin.SimpleListFilter):
+    """
+    Selects the shard whose objects are listed.
+    """
+
+    title = "shard"
+    parameter_name = "shard"
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()]
+
+    def queryset(self, request, queryset):
+        if self.value() in shard_aliases():
+            return queryset.using(self.value())
+        return queryset
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    Lists the objects of one shard at a time (the default database
+    unless another shard is selected) and finds single objects on any
+    shard by their globally unique ID.
+    """
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if is_sharded():
+            return (ShardListFilter, *list_filter)
+        return list_filter
+
+    def get_object(self, request, object_id, from_field=None):
+        if not is_sharded():
+            return super().get_object(request, object_id, from_field)
+        for alias in shard_aliases():
+            with on_shard(alias):
+                obj = super().get_object(request, object_id, from_field)
+            if obj is not None:
+                return obj
+        return None
+
+
+class IndexedDatesQuerySet(models.QuerySet):
+    """
+    A queryset listing the distinct years, months or days of a datetime
+    field (as needed by the admin date hierarchy) with one indexed MIN()
+    lookup per period instead of a DISTINCT over all matching rows.
+    """
+
+    def datetimes(self, field_name, kind, order="ASC", tzinfo=None):
+        if kind not in ("year", "month", "day"):
+            return super().datetimes(field_name, kind, order, tzinfo)
+        tzinfo = tzinfo or timezone.get_current_timezone()
+        queryset = self.order_by()
+        periods = []
+        first = queryset.aggregate(first=Min(field_name))["first"]
+        while first is not None:
+            local = timezone.localtime(first, tzinfo)
+            start = datetime(
+                local.year,
+                local.month if kind != "year" else 1,
+                local.day if kind == "day" else 1,
+            )
+            if kind == "year":
+                end = start.replace(year=start.year + 1)
+            elif kind == "month":
+                end = (start + timedelta(days=32)).replace(day=1)
+            else:
+                end = start + timedelta(days=1)
+            periods.append(timezone.make_aware(start, tzinfo))
+            first = queryset.filter(
+                **{f"{field_name}__gte": timezone.make_aware(end, tzinfo)}
+            ).aggregate(first=Min(field_name))["first"]
+        return periods if order == "ASC" else periods[::-1]
+
+
 @admin.register(HydroponicSystem)
-class HydroponicSystemAdmin(admin.ModelAdmin):
+class HydroponicSystemAdmin(ShardedModelAdmin):
     """
     Admin configuration for the HydroponicSystem model.
 
@@ -21,9 +104,18 @@ class HydroponicSystemAdmin(admin.ModelAdmin):
     list_display = ("name", "owner", "created_at")
     search_fields = ("name", "owner__username")
 
+    def delete_model(self, request, obj):
+        obj.mark_for_deletion()
+        enqueue("purge_deleted", unique=True)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            obj.mark_for_deletion()
+        enqueue("purge_deleted", unique=True)
+
 
 @admin.register(Sensor)
-class SensorAdmin(admin.ModelAdmin):
+class SensorAdmin(ShardedModelAdmin):
     """
     Admin configuration for the Sensor model.
 
@@ -35,20 +127,121 @@ class SensorAdmin(admin.ModelAdmin):
 
     list_display = ("name", "sensor_type", "system")
     list_filter = ("sensor_type",)
+    list_select_related = ("system",)
     search_fields = ("name", "system__name")
 
+    def delete_model(self, request, obj):
+        obj.mark_for_deletion()
+        enqueue("purge_deleted", unique=True)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            obj.mark_for_deletion()
+        enqueue("purge_deleted", unique=True)
+
 
 @admin.register(Measurement)
-class MeasurementAdmin(admin.ModelAdmin):
+class MeasurementAdmin(ShardedModelAdmin):
     """
-    Admin configuration for the Measurement model.
+    Admin configuration for the Measurement model, usable with hundreds
+    of millions of rows: counts are estimated, the date hierarchy
+    filters by indexed time ranges and searches resolve sensors first.
 
     Attributes:
         list_display: Fields on the admin list page.
         list_filter: Fields used for filtering in the admin page.
+        list_select_related: Related objects fetched with the list.
+        date_hierarchy: Field used for drilling down by date.
         search_fields: Fields used for search in the admin page.
+        search_help_text: Description of the search shown in the admin page.
+        raw_id_fields: Relations edited by ID instead of a select box.
+        paginator: Paginator estimating the number of rows.
+        show_full_result_count: Whether to count the unfiltered rows.
     """
 
     list_display = ("id", "sensor", "value", "measured_at")
     list_filter = ("sensor__sensor_type",)
+    list_select_related = ("sensor",)
+    date_hierarchy = "measured_at"
     search_fields = ("sensor__name",)
+    search_help_text = "Sensor ID or the exact name of a sensor."
+    raw_id_fields = ("sensor",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return IndexedDatesQuerySet(
+            model=queryset.model,
+            query=queryset.query,
+            using=queryset._db,
+            hints=queryset._hints,
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Matches the search term against the sensor ID or the sensor name,
+        looked up in the small sensor table, so the measurements are
+        filtered by the indexed sensor column.
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        sensors = Sensor.objects.using(queryset.db)
+        matches = sensors.filter(name__iexact=search_term)
+        if search_term.isdigit():
+            matches |= sensors.filter(pk=int(search_term))
+        sensor_ids = list(matches.values_list("pk", flat=True))
+        return queryset.filter(sensor_id__in=sensor_ids), False
+
+
+@admin.register(AlertRule)
+class AlertRuleAdmin(ShardedModelAdmin):
+    """
+    Admin configuration for the AlertRule model.
+
+    Attributes:
+        list_display: Fields on the admin list page.
+        list_filter: Fields used for filtering in the admin page.
+        search_fields: Fields used for search in the admin page.
+    """
+
+    list_display = ("name", "owner", "kind", "sensor", "sensor_type", "is_active")
+    list_filter = ("kind", "is_active")
+    search_fields = ("name", "owner__username")
+
+
+@admin.register(AlertEvent)
+class AlertEventAdmin(ShardedModelAdmin):
+    """
+    Admin configuration for the AlertEvent model.
+
+    Attributes:
+        list_display: Fields on the admin list page.
+        list_filter: Fields used for filtering in the admin page.
+        list_select_related: Related objects fetched with the list.
+        paginator: Paginator estimating the number of rows.
+        show_full_result_count: Whether to count the unfiltered rows.
+    """
+
+    list_display = ("id", "rule", "sensor_id", "value", "measured_at")
+    list_filter = ("rule__kind",)
+    list_select_related = ("rule",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    """
+    Admin configuration for the Job model.
+
+    Attributes:
+        list_display: Fields on the admin list page.
+        list_filter: Fields used for filtering in the admin page.
+        search_fields: Fields used for search in the admin page.
+    """
+
+    list_display = ("id", "kind", "owner", "status", "progress", "attempts")
+    list_filter = ("status", "kind")
+    search_fields = ("kind", "owner__username")
@@ -0,0 +1,166 @@
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Q
+
+from .models import AlertEvent, AlertRule, SensorState
+from .ownership import resolver
+
+"""
+Incremental evaluation of alert rules at ingest time.
+
+Each sensor keeps a compact running state (Welford mean and variance,
+last reading), so rules are checked against new readings only and
+history never needs to be rescanned.
+"""
+
+
+def zscore_window():
+    """
+    Returns the number of readings after which the running mean and
+    variance switch to exponential decay, making the z-score rolling.
+    """
+    return getattr(settings, "HYDROPONICS_ALERT_ZSCORE_WINDOW", 1000)
+
+
+def update_state(state, value, measured_at, window):
+    """
+    Folds a reading into the sensor state.
+
+    Up to `window` readings the exact Welford update is used; afterwards
+    the state decays exponentially with weight 1/window.
+    """
+    delta = value - state.mean
+    if state.count < window:
+        state.count += 1
+        state.mean += delta / state.count
+        state.m2 += delta * (value - state.mean)
+    else:
+        variance = state.m2 / (window - 1) if window > 1 else 0.0
+        state.mean += delta / window
+        variance = (1 - 1 / window) * (variance + delta * delta / window)
+        state.m2 = variance * (window - 1)
+
+    if state.last_measured_at is None or measured_at >= state.last_measured_at:
+        state.last_value = value
+        state.last_measured_at = measured_at
+
+
+def check_rule(rule, state, value, measured_at):
+    """
+    Checks a reading against a rule using the state from before the reading.
+
+    Returns:
+        A message describing the violation, or None.
+    """
+    if rule.kind == "THRESHOLD":
+        if rule.min_value is not None and value < rule.min_value:
+            return f"Value {value} is below {rule.min_value}."
+        if rule.max_value is not None and value > rule.max_value:
+            return f"Value {value} is above {rule.max_value}."
+    elif rule.kind == "RATE":
+        if (
+            rule.max_rate is not None
+            and state.last_measured_at is not None
+            and measured_at > state.last_measured_at
+        ):
+            minutes = (measured_at - state.last_measured_at).total_seconds() / 60
+            rate = abs(value - state.last_value) / minutes
+            if rate > rule.max_rate:
+                return f"Value changed by {rate:.2f} per minute (limit {rule.max_rate})."
+    elif rule.kind == "ZSCORE":
+        if (
+            rule.z_threshold is not None
+            and state.count >= max(rule.min_samples, 2)
+        ):
+            stddev = math.sqrt(state.m2 / (state.count - 1))
+            if stddev > 0:
+                score = (value - state.mean) / stddev
+                if abs(score) > rule.z_threshold:
+                    return f"Z-score {score:.2f} exceeds {rule.z_threshold}."
+    return None
+
+
+def _lock_states(sensor_ids):
+    states = SensorState.objects.select_for_update().filter(sensor_id__in=sensor_ids)
+    return {state.sensor_id: state for state in states.order_by("sensor_id")}
+
+
+def evaluate_measurements(measurements):
+    """
+    Evaluates the active alert rules against newly ingested measurements
+    and updates the running state of their sensors.
+
+    Works for a single reading as well as for a batch, with a constant
+    number of queries per call. Sensor states are locked for the
+    duration of the update, so concurrent batches are serialized per
+    sensor.
+
+    Args:
+        measurements: Saved Measurement instances.
+
+    Returns:
+        The list of created AlertEvent instances.
+    """
+    by_sensor = defaultdict(list)
+    for measurement in measurements:
+        by_sensor[measurement.sensor_id].append(measurement)
+    if not by_sensor:
+        return []
+
+    sensors = {
+        sensor_id: (entry.sensor_type, entry.owner_id)
+        for sensor_id, entry in resolver.sensors_bulk(by_sensor).items()
+    }
+    targets = Q()
+    for sensor_type, owner_id in set(sensors.values()):
+        targets |= Q(sensor__isnull=True, sensor_type=sensor_type, owner_id=owner_id)
+    rules_by_sensor = defaultdict(list)
+    for rule in AlertRule.objects.filter(is_active=True).filter(
+        Q(sensor_id__in=sensors) | targets
+    ):
+        if rule.sensor_id is not None:
+            rules_by_sensor[rule.sensor_id].append(rule)
+            continue
+        for sensor_id, (sensor_type, owner_id) in sensors.items():
+            if rule.sensor_type == sensor_type and rule.owner_id == owner_id:
+                rules_by_sensor[sensor_id].append(rule)
+
+    window = zscore_window()
+    events = []
+    with transaction.atomic(using=router.db_for_write(SensorState)):
+        states = _lock_states(sensors)
+        missing = set(sensors) - set(states)
+        if missing:
+            SensorState.objects.bulk_create(
+                [SensorState(sensor_id=sensor_id) for sensor_id in missing],
+                ignore_conflicts=True,
+            )
+            states.update(_lock_states(missing))
+
+        for sensor_id, state in states.items():
+            readings = sorted(by_sensor[sensor_id], key=lambda m: m.measured_at)
+            for measurement in readings:
+                value = float(measurement.value)
+                for rule in rules_by_sensor[sensor_id]:
+                    message = check_rule(rule, state, value, measurement.measured_at)
+                    if message:
+                        events.append(
+                            AlertEvent(
+                                rule=rule,
+                                sensor_id=sensor_id,
+                                value=value,
+                                measured_at=measurement.measured_at,
+                                message=message,
+                            )
+                        )
+                update_state(state, value, measurement.measured_at, window)
+
+        SensorState.objects.bulk_update(
+            states.values(),
+            ["count", "mean", "m2", "last_value", "last_measured_at"],
+        )
+        AlertEvent.objects.bulk_create(events)
+    return events
@@ -0,0 +1,342 @@
+import fcntl
+import json
+import mmap
+import os
+import secrets
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+from operator import attrgetter
+from pathlib import Path
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Min
+from django.utils.dateparse import parse_datetime
+
+from .encoding import (archive_readings, decode_archive_columns, decode_chunk,
+                       encode_archive)
+from .models import Measurement, MeasurementChunk
+from .ownership import LRUCache
+
+"""
+Cold-storage archive of old measurements.
+
+`manage.py archive_measurements` moves the measurements (rows and
+chunks) older than HYDROPONICS_ARCHIVE_AFTER_MONTHS into immutable
+compressed columnar files on local disk, one per sensor and month, and
+removes them from the database. The files are listed in an append-only
+manifest (manifest.jsonl) in HYDROPONICS_ARCHIVE_DIR, where a later
+line for the same sensor and month supersedes the earlier ones.
+
+Archived segments are read through memory maps and stand in for
+MeasurementChunks on the read paths of hydroponics.chunks. The decoded
+columns of the last HYDROPONICS_ARCHIVE_CACHE_SIZE files read are kept
+in memory, and reads of a time range only build the readings within it.
+"""
+
+MANIFEST = "manifest.jsonl"
+LOCK = ".lock"
+
+# Decoded columns by file name; archive files never change once written.
+_columns = LRUCache(
+    maxsize=getattr(settings, "HYDROPONICS_ARCHIVE_CACHE_SIZE", 64),
+    ttl=float("inf"),
+)
+
+
+class ArchivedSegment(
+    namedtuple(
+        "ArchivedSegment",
+        [
+            "sensor_id",
+            "month",
+            "start",
+            "end",
+            "count",
+            "min_value",
+            "max_value",
+            "file",
+        ],
+    )
+):
+    """
+    An archive file holding the measurements of one sensor in one month
+    (and of the chunks starting in it), as listed in the manifest.
+    """
+
+    __slots__ = ()
+
+    def columns(self):
+        """
+        Returns the decoded columns of the file, see
+        hydroponics.encoding.decode_archive_columns().
+        """
+        columns = _columns.get(self.file)
+        if columns is None:
+            with open(archive_dir() / self.file, "rb") as file, mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as buffer:
+                columns = decode_archive_columns(buffer)
+            _columns.set(self.file, columns)
+        return columns
+
+    def readings(self, since=None, until=None):
+        """
+        Returns the readings of the segment taken between since and until
+        (both inclusive, unbounded when None), sorted by time.
+        """
+        try:
+            columns = self.columns()
+        except FileNotFoundError:
+            # Superseded and deleted by compact_manifest() since the
+            # manifest was read: the current segment holds the readings.
+            for current in segments().get(self.sensor_id, []):
+                if current.month == self.month and current.file != self.file:
+                    return current.readings(since, until)
+            return []
+        return archive_readings(columns, since, until)
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "sensor": self.sensor_id,
+                "month": self.month,
+                "start": self.start.isoformat(),
+                "end": self.end.isoformat(),
+                "count": self.count,
+                "min_value": str(self.min_value),
+                "max_value": str(self.max_value),
+                "file": self.file,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, line):
+        entry = json.loads(line)
+        return cls(
+            entry["sensor"],
+            entry["month"],
+            parse_datetime(entry["start"]),
+            parse_datetime(entry["end"]),
+            entry["count"],
+            Decimal(entry["min_value"]),
+            Decimal(entry["max_value"]),
+            entry["file"],
+        )
+
+
+def archive_dir():
+    return Path(settings.HYDROPONICS_ARCHIVE_DIR)
+
+
+# (manifest signature, segments by sensor ID) of the last manifest read.
+_manifest = (None, {})
+
+
+def _read_manifest():
+    """
+    Returns the current segment of each sensor and month.
+    """
+    latest = {}
+    with open(archive_dir() / MANIFEST) as file:
+        for line in file:
+            try:
+                segment = ArchivedSegment.from_json(line)
+            except (KeyError, TypeError, ValueError):
+                # A line cut short by a crash while appending.
+                continue
+            latest[segment.sensor_id, segment.month] = segment
+    return latest
+
+
+def segments():
+    """
+    Returns the archived segments keyed by sensor ID and sorted by
+    start, read again whenever the manifest changes.
+    """
+    global _manifest
+    try:
+        stat = (archive_dir() / MANIFEST).stat()
+    except FileNotFoundError:
+        return {}
+    signature = (str(archive_dir()), stat.st_mtime_ns, stat.st_size)
+    if _manifest[0] != signature:
+        by_sensor = {}
+        for segment in _read_manifest().values():
+            by_sensor.setdefault(segment.sensor_id, []).append(segment)
+        for sensor_segments in by_sensor.values():
+            sensor_segments.sort(key=attrgetter("start"))
+        _manifest = (signature, by_sensor)
+    return _manifest[1]
+
+
+def archived_segments(sensor_ids=None):
+    """
+    Returns the archived segments of the given sensors (of all sensors
+    when None) sorted by start.
+    """
+    by_sensor = segments()
+    if sensor_ids is None:
+        chosen = [segment for listed in by_sensor.values() for segment in listed]
+    else:
+        chosen = [
+            segment
+            for sensor_id in set(sensor_ids)
+            for segment in by_sensor.get(sensor_id, [])
+        ]
+    return sorted(chosen, key=attrgetter("start"))
+
+
+def month_start(moment):
+    return moment.astimezone(dt_timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def next_month(start):
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+@contextmanager
+def archive_lock():
+    """
+    Serializes the processes writing to the archive.
+    """
+    directory = archive_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / LOCK, "w") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _write(relative, content):
+    path = archive_dir() / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f"{path.name}.partial")
+    with open(partial, "wb") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(partial, path)
+
+
+def _append(segment):
+    with open(archive_dir() / MANIFEST, "a") as file:
+        file.write(segment.to_json() + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def archive_month(sensor_id, start):
+    """
+    Moves the measurement rows of a sensor in the month starting at
+    start, and its chunks starting in that month, into a new archive
+    file merged with the file already archived for the month. The rows
+    are deleted only once the file is listed in the manifest; should
+    the deletion fail, the next run archives them again and readers
+    skip the duplicates meanwhile.
+
+    Must be called within archive_lock().
+
+    Returns:
+        The number of measurements moved from the database.
+    """
+    end = next_month(start)
+    month = start.strftime("%Y-%m")
+    using = router.db_for_write(Measurement)
+    with transaction.atomic(using=using):
+        rows = list(
+            Measurement.objects.using(using)
+            .select_for_update()
+            .filter(sensor_id=sensor_id, measured_at__gte=start, measured_at__lt=end)
+            .values_list("id", "measured_at", "value")
+        )
+        chunks = list(
+            MeasurementChunk.objects.using(using)
+            .select_for_update()
+            .filter(sensor_id=sensor_id, start__gte=start, start__lt=end)
+        )
+        readings = rows + [
+            reading for chunk in chunks for reading in decode_chunk(chunk.data)
+        ]
+        if not readings:
+            return 0
+        moved = len(readings)
+        for previous in segments().get(sensor_id, []):
+            if previous.month == month:
+                readings += previous.readings()
+                start, end = min(start, previous.start), max(end, previous.end)
+        readings = sorted(
+            {reading[0]: reading for reading in readings}.values(),
+            key=lambda reading: (reading[1], reading[0]),
+        )
+
+        segment = ArchivedSegment(
+            sensor_id=sensor_id,
+            month=month,
+            start=min([start] + [chunk.start for chunk in chunks]),
+            end=max([end] + [chunk.end for chunk in chunks]),
+            count=len(readings),
+            min_value=min(reading[2] for reading in readings),
+            max_value=max(reading[2] for reading in readings),
+            file=f"sensor-{sensor_id}/{month}-{secrets.token_hex(4)}.col",
+        )
+        _write(segment.file, encode_archive(readings))
+        _append(segment)
+        Measurement.objects.using(using).filter(
+            id__in=[row[0] for row in rows]
+        ).delete()
+        MeasurementChunk.objects.using(using).filter(
+            id__in=[chunk.id for chunk in chunks]
+        ).delete()
+    return moved
+
+
+def archive_sensor(sensor_id, before):
+    """
+    Archives the measurements of a sensor month by month up to before
+    (the start of a month).
+
+    Returns:
+        The number of measurements moved from the database.
+    """
+    moved = 0
+    rows = Measurement.objects.filter(sensor_id=sensor_id, measured_at__lt=before)
+    chunks = MeasurementChunk.objects.filter(sensor_id=sensor_id, start__lt=before)
+    while True:
+        candidates = [
+            rows.aggregate(first=Min("measured_at"))["first"],
+            chunks.aggregate(first=Min("start"))["first"],
+        ]
+        candidates = [moment for moment in candidates if moment is not None]
+        if not candidates:
+            return moved
+        moved += archive_month(sensor_id, month_start(min(candidates)))
+
+
+def compact_manifest(sensor_ids):
+    """
+    Rewrites the manifest with only the current segments of the given
+    (existing) sensors and deletes the files no longer listed.
+
+    Must be called within archive_lock().
+    """
+    if not (archive_dir() / MANIFEST).exists():
+        return
+    sensor_ids = set(sensor_ids)
+    kept = [
+        segment
+        for segment in _read_manifest().values()
+        if segment.sensor_id in sensor_ids
+    ]
+    _write(MANIFEST, "".join(segment.to_json() + "\n" for segment in kept).encode())
+    listed = {segment.file for segment in kept}
+    for path in archive_dir().glob("sensor-*/*.col"):
+        if path.relative_to(archive_dir()).as_posix() not in listed:
+            path.unlink()
@@ -0,0 +1,134 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import (TokenObtainPairSerializer,
+                                                  TokenRefreshSerializer)
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import TokenVersion
+from .ownership import LRUCache
+
+"""
+Stateless JWT authentication: the user is built from token claims
+instead of being loaded from the database on every request. Tokens are
+revoked by bumping the per-user token version.
+"""
+
+VERSION_CLAIM = "ver"
+
+_full_users = LRUCache(
+    maxsize=getattr(settings, "HYDROPONICS_USER_CACHE_SIZE", 1000),
+    ttl=getattr(settings, "HYDROPONICS_USER_CACHE_TTL", 60),
+)
+
+
+def _version_cache_key(user_id):
+    return f"hydroponics:token-version:{user_id}"
+
+
+def current_token_version(user_id):
+    """
+    Returns the current token version of a user, cached in the Django
+    cache for HYDROPONICS_TOKEN_VERSION_CACHE_TTL seconds.
+    """
+    key = _version_cache_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = (
+            TokenVersion.objects.filter(user_id=user_id)
+            .values_list("version", flat=True)
+            .first()
+        ) or 0
+        cache.set(
+            key, version, getattr(settings, "HYDROPONICS_TOKEN_VERSION_CACHE_TTL", 30)
+        )
+    return version
+
+
+def bump_token_version(user_id):
+    """
+    Revokes all tokens of a user issued so far.
+    """
+    TokenVersion.objects.get_or_create(user_id=user_id)
+    TokenVersion.objects.filter(user_id=user_id).update(version=F("version") + 1)
+    transaction.on_commit(lambda: cache.delete(_version_cache_key(user_id)))
+    _full_users.delete(user_id)
+
+
+class LightweightUser(TokenUser):
+    """
+    A user built from token claims, usable wherever only the ID, the
+    username and the staff/active flags are needed. The full User model
+    instance is available through get_full_user().
+    """
+
+    @property
+    def is_active(self):
+        return self.token.get("is_active", True)
+
+    def get_full_user(self):
+        """
+        Returns the User model instance, cached per process.
+        """
+        user = _full_users.get(self.id)
+        if user is None:
+            user = get_user_model().objects.get(pk=self.id)
+            _full_users.set(self.id, user)
+        return user
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that returns a LightweightUser without querying
+    the user table. The token version claim is checked against the
+    cached current version, so revoked tokens are rejected.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        if not validated_token.get("is_active", True):
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if validated_token.get(VERSION_CLAIM, 0) != current_token_version(user_id):
+            raise AuthenticationFailed("Token has been revoked.", code="token_revoked")
+
+        return LightweightUser(validated_token)
+
+
+class VersionedTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Adds the claims used by StatelessJWTAuthentication to issued tokens.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token[VERSION_CLAIM] = current_token_version(user.pk)
+        token["username"] = user.get_username()
+        token["is_active"] = user.is_active
+        token["is_staff"] = user.is_staff
+        token["is_superuser"] = user.is_superuser
+        return token
+
+
+class VersionedTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Refuses to refresh tokens whose version has been revoked.
+    """
+
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs["refresh"])
+        user_id = refresh.get(api_settings.USER_ID_CLAIM)
+        if refresh.get(VERSION_CLAIM, 0) != current_token_version(user_id):
+            raise AuthenticationFailed("Token has been revoked.", code="token_revoked")
+        return super().validate(attrs)
@@ -0,0 +1,258 @@
+import json
+from contextlib import ExitStack
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as FieldValidationError
+from django.db import DatabaseError, OperationalError, connections
+from django.utils import timezone
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.exceptions import APIException, ValidationError
+
+from .metrics import registry
+
+"""
+Query cost guardrails of the API endpoints.
+
+Every viewset action has a budget, HYDROPONICS_QUERY_BUDGETS["default"]
+completed by the entry of "<basename>.<action>" (e.g. "measurement.list"):
+
+    statement_timeout_ms: PostgreSQL cancels every query of the request
+        running longer, answered with 400.
+    max_cost: The planner cost (EXPLAIN) above which a list query is
+        rejected with 400 before it runs.
+    window_days: Lists of the viewsets with a `time_window_field` are
+        restricted to this many days before their end (or now) unless
+        the request sets a start.
+    require_window: Rejects such lists without a start instead.
+
+Budgets only apply to PostgreSQL, except for the time window.
+"""
+
+rejected_queries = registry.counter(
+    "hydroponics_query_budget_rejected_total",
+    "API requests rejected by a query budget, by endpoint and reason.",
+)
+
+# SQLSTATE of a statement cancelled by statement_timeout.
+QUERY_CANCELED = "57014"
+
+# libpq transaction status of a connection outside of a transaction.
+TRANSACTION_IDLE = 0
+
+
+class QueryTooExpensive(APIException):
+    """
+    Raised for a request exceeding the query budget of its endpoint.
+    """
+
+    status_code = 400
+    default_detail = "The query is too expensive, please narrow it down."
+    default_code = "query_too_expensive"
+
+
+def query_budget(basename, action):
+    """
+    Returns the budget of a viewset action.
+    """
+    budgets = getattr(settings, "HYDROPONICS_QUERY_BUDGETS", {})
+    return {**budgets.get("default", {}), **budgets.get(f"{basename}.{action}", {})}
+
+
+def query_plan(queryset):
+    """
+    Returns the top node of the PostgreSQL plan of a queryset.
+    """
+    plan = json.loads(queryset.explain(format="json"))
+    # Depending on the driver the plan is wrapped in a list or not.
+    if isinstance(plan, list):
+        plan = plan[0]
+    return plan["Plan"]
+
+
+def _sqlstate(error):
+    cause = error.__cause__
+    return getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+
+
+class StatementTimeout:
+    """
+    A database execute wrapper setting statement_timeout on every
+    PostgreSQL connection before its first query.
+
+    Behind a pooler in transaction mode (HYDROPONICS_DATABASE_POOLER =
+    "transaction"), where a session setting would leak to other clients,
+    the timeout is set for each transaction instead and statements
+    outside of transactions are left to the timeout of the database role.
+
+    Attributes:
+        milliseconds: The timeout.
+        connections: The connections the timeout was set on.
+    """
+
+    def __init__(self, milliseconds):
+        self.milliseconds = milliseconds
+        self.connections = []
+        self.local = (
+            getattr(settings, "HYDROPONICS_DATABASE_POOLER", "session") == "transaction"
+        )
+
+    def __call__(self, execute, sql, params, many, context):
+        connection = context["connection"]
+        if connection.vendor == "postgresql":
+            if self.local:
+                # The transaction is opened by the first statement of the block.
+                status = connection.connection.info.transaction_status
+                if connection.in_atomic_block and status == TRANSACTION_IDLE:
+                    self._set(execute, context)
+            elif connection not in self.connections:
+                self.connections.append(connection)
+                self._set(execute, context)
+        return execute(sql, params, many, context)
+
+    def _set(self, execute, context):
+        execute(
+            "SELECT set_config('statement_timeout', %s, %s)",
+            [str(self.milliseconds), self.local],
+            False,
+            context,
+        )
+
+    def reset(self):
+        """
+        Restores the configured statement_timeout of the connections.
+        """
+        for connection in self.connections:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("RESET statement_timeout")
+            except DatabaseError:
+                # A broken connection is closed at the end of the request.
+                pass
+        self.connections = []
+
+
+class QueryBudgetMixin:
+    """
+    Viewset mixin enforcing the query budget of the requested action:
+    the statement timeout of all its queries and the cost of the list
+    queries.
+    """
+
+    @property
+    def endpoint(self):
+        return f"{self.basename}.{self.action}"
+
+    @property
+    def query_budget(self):
+        return query_budget(self.basename, self.action)
+
+    def initial(self, request, *args, **kwargs):
+        self._budget_stack = ExitStack()
+        milliseconds = self.query_budget.get("statement_timeout_ms")
+        if milliseconds:
+            self._statement_timeout = StatementTimeout(milliseconds)
+            for alias in connections:
+                self._budget_stack.enter_context(
+                    connections[alias].execute_wrapper(self._statement_timeout)
+                )
+            self._budget_stack.callback(self._statement_timeout.reset)
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        stack = getattr(self, "_budget_stack", None)
+        if stack is not None:
+            stack.close()
+            self._budget_stack = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        """
+        Answers queries cancelled by the statement timeout with 400.
+        """
+        if isinstance(exc, OperationalError) and _sqlstate(exc) == QUERY_CANCELED:
+            rejected_queries.inc(endpoint=self.endpoint, reason="timeout")
+            milliseconds = self.query_budget.get("statement_timeout_ms")
+            exc = QueryTooExpensive(
+                f"The query was cancelled after {milliseconds} ms, please "
+                "narrow it down with filters or a shorter time window."
+            )
+        return super().handle_exception(exc)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action == "list":
+            self.check_query_cost(queryset)
+        return queryset
+
+    def check_query_cost(self, queryset):
+        """
+        Rejects a list whose count or page query is estimated by the
+        PostgreSQL planner to cost more than max_cost.
+        """
+        max_cost = self.query_budget.get("max_cost")
+        if not max_cost or connections[queryset.db].vendor != "postgresql":
+            return
+        page_size = self.paginator.get_page_size(self.request) if self.paginator else 0
+        queries = [queryset.order_by()]
+        if page_size:
+            queries.append(queryset[:page_size])
+        cost = max(query_plan(query)["Total Cost"] for query in queries)
+        if cost > max_cost:
+            rejected_queries.inc(endpoint=self.endpoint, reason="cost")
+            raise QueryTooExpensive(
+                f"The query is estimated to cost {cost:.0f}, more than the "
+                f"budget of {max_cost}; please narrow it down with filters "
+                "or a shorter time window."
+            )
+
+
+class TimeWindowFilterBackend(DjangoFilterBackend):
+    """
+    A filter backend bounding the lists of viewsets with a
+    `time_window_field` to the window_days of their budget.
+    """
+
+    def get_filterset_kwargs(self, request, queryset, view):
+        kwargs = super().get_filterset_kwargs(request, queryset, view)
+        field = getattr(view, "time_window_field", None)
+        if field is None or getattr(view, "action", None) != "list":
+            return kwargs
+        data, start = kwargs["data"], f"{field}__gte"
+        if data.get(start):
+            return kwargs
+        budget = view.query_budget
+        if budget.get("require_window"):
+            rejected_queries.inc(endpoint=view.endpoint, reason="window")
+            raise ValidationError({start: "This filter is required."})
+        days = budget.get("window_days")
+        if days:
+            end = self.window_end(request, queryset, view, data.get(f"{field}__lte"))
+            if end is None:
+                # An invalid end is reported by the filterset.
+                return kwargs
+            if timezone.is_naive(end):
+                end = timezone.make_aware(end)
+            data = data.copy()
+            data[start] = (end - timedelta(days=days)).isoformat()
+            kwargs["data"] = data
+        return kwargs
+
+    def window_end(self, request, queryset, view, value):
+        """
+        Returns the end of the time window: the requested end, parsed by
+        the filter of the filterset (so e.g. a date alone is accepted
+        too), or now; None if the end is invalid.
+        """
+        if not value:
+            return timezone.now()
+        filterset_class = self.get_filterset_class(view, queryset)
+        lookup = f"{view.time_window_field}__lte"
+        declared = filterset_class.base_filters.get(lookup) if filterset_class else None
+        if declared is None:
+            # The filterset ignores the end.
+            return timezone.now()
+        try:
+            return declared.field.clean(value)
+        except FieldValidationError:
+            return None
@@ -0,0 +1,659 @@
+import heapq
+import operator
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Min, Model, OuterRef, Q, QuerySet, Subquery
+from django.utils.functional import cached_property
+from rest_framework.exceptions import ValidationError
+
+from .archive import archived_segments, segments
+from .encoding import EPOCH, decode_chunk, encode_chunk
+from .models import Measurement, MeasurementChunk, Sensor
+
+"""
+Compressed chunked storage of measurement series.
+
+With HYDROPONICS_CHUNKED_STORAGE enabled, `manage.py compact_measurements`
+seals the measurements older than HYDROPONICS_CHUNK_AFTER_DAYS into one
+MeasurementChunk per sensor and HYDROPONICS_CHUNK_HOURS period, storing
+each reading in a few bytes (see hydroponics.encoding) instead of a
+table row and its index entries.
+
+Recent measurements stay in the measurement table; the list, export and
+statistics read paths merge them with the readings of the chunks and of
+the archived segments (see hydroponics.archive), which are handled
+alike. Sealed measurements keep their IDs but can no longer be changed.
+"""
+
+# The fields of the measurements built from chunks, in model field order.
+FIELDS = ["id", "sensor_id", "value", "measured_at"]
+
+# Lookups on measured_at and value that can be evaluated on chunks.
+OPERATORS = {
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+
+
+def chunked_storage_enabled():
+    return getattr(settings, "HYDROPONICS_CHUNKED_STORAGE", False)
+
+
+def chunk_period():
+    return timedelta(hours=getattr(settings, "HYDROPONICS_CHUNK_HOURS", 24))
+
+
+def period_start(moment):
+    """
+    Returns the start of the chunk period containing a moment.
+    """
+    period = chunk_period()
+    return EPOCH + (moment - EPOCH) // period * period
+
+
+def _split(lookup):
+    field, _, name = lookup.partition("__")
+    if field not in ("measured_at", "value") or name not in OPERATORS:
+        raise ValueError(f"Unsupported chunk lookup {lookup!r}.")
+    return field, name
+
+
+def _matches(measured_at, value, lookups):
+    for lookup, bound in lookups.items():
+        field, name = _split(lookup)
+        current = measured_at if field == "measured_at" else value
+        if not OPERATORS[name](current, bound):
+            return False
+    return True
+
+
+def chunk_q(lookups):
+    """
+    Returns the condition selecting the chunks that may hold
+    measurements matching lookups on measured_at and value.
+    """
+    condition = Q()
+    for lookup, bound in lookups.items():
+        field, name = _split(lookup)
+        lower = name in ("gt", "gte")
+        if field == "measured_at":
+            condition &= Q(end__gt=bound) if lower else Q(**{f"start__{name}": bound})
+        else:
+            column = "max_value" if lower else "min_value"
+            condition &= Q(**{f"{column}__{name}": bound})
+    return condition
+
+
+def _may_match(chunk, lookups):
+    """
+    Evaluates chunk_q() on a chunk in memory.
+    """
+    for lookup, bound in lookups.items():
+        field, name = _split(lookup)
+        lower = name in ("gt", "gte")
+        if field == "measured_at":
+            possible = (
+                chunk.end > bound if lower else OPERATORS[name](chunk.start, bound)
+            )
+        else:
+            extreme = chunk.max_value if lower else chunk.min_value
+            possible = OPERATORS[name](extreme, bound)
+        if not possible:
+            return False
+    return True
+
+
+def _covers(chunk, lookups):
+    """
+    Returns whether all measurements of a chunk match the lookups.
+    """
+    for lookup, bound in lookups.items():
+        field, name = _split(lookup)
+        if field == "measured_at":
+            if name in ("gt", "gte"):
+                covered = OPERATORS[name](chunk.start, bound)
+            else:
+                covered = chunk.end <= bound
+        else:
+            test = OPERATORS[name]
+            covered = test(chunk.min_value, bound) and test(chunk.max_value, bound)
+        if not covered:
+            return False
+    return True
+
+
+def chunk_measurements(chunk, lookups=None):
+    """
+    Returns the measurements of a chunk or an archived segment matching
+    the lookups, as (read-only) Measurement instances sorted by time.
+    """
+    lookups = lookups or {}
+    if isinstance(chunk, MeasurementChunk):
+        readings = decode_chunk(chunk.data)
+    else:
+        # Archived segments only build the readings within the time range.
+        bounds = {"since": None, "until": None}
+        for lookup, bound in lookups.items():
+            field, name = _split(lookup)
+            if field == "measured_at":
+                bounds["since" if name in ("gt", "gte") else "until"] = bound
+        readings = chunk.readings(**bounds)
+    return [
+        Measurement.from_db(None, FIELDS, [pk, chunk.sensor_id, value, measured_at])
+        for pk, measured_at, value in readings
+        if _matches(measured_at, value, lookups)
+    ]
+
+
+def _sort_key(measurement):
+    return measurement.measured_at, measurement.id
+
+
+def _unique(measurements):
+    # Measurements are listed twice only while an interrupted archiving
+    # run has left them both in the archive and in the database.
+    previous = None
+    for measurement in measurements:
+        key = _sort_key(measurement)
+        if key != previous:
+            yield measurement
+        previous = key
+
+
+def _groups(chunks, reverse=False):
+    """
+    Groups chunks (ordered by start, or by end descending) into runs of
+    overlapping periods, whose readings are sorted together.
+    """
+    group, low, high = [], None, None
+    for chunk in chunks:
+        if group and (chunk.end <= low if reverse else chunk.start >= high):
+            yield group
+            group = []
+        if not group:
+            low, high = chunk.start, chunk.end
+        group.append(chunk)
+        low, high = min(low, chunk.start), max(high, chunk.end)
+    if group:
+        yield group
+
+
+def merge(rows, chunks, lookups=None, reverse=False):
+    """
+    Merges measurement rows sorted by (measured_at, id) with the
+    matching readings of chunks ordered by start (both descending
+    when reversed).
+    """
+    readings = (
+        measurement
+        for group in _groups(chunks, reverse)
+        for measurement in sorted(
+            (m for chunk in group for m in chunk_measurements(chunk, lookups)),
+            key=_sort_key,
+            reverse=reverse,
+        )
+    )
+    return _unique(heapq.merge(rows, readings, key=_sort_key, reverse=reverse))
+
+
+def _sensor_ids(sensors):
+    if sensors is None:
+        return None
+    if isinstance(sensors, QuerySet):
+        return list(sensors.values_list("id", flat=True))
+    return list(sensors)
+
+
+def _archived(sensors, lookups):
+    """
+    Returns the archived segments of the sensors that may hold
+    measurements matching the lookups, sorted by start.
+    """
+    if not segments():
+        return []
+    return [
+        segment
+        for segment in archived_segments(_sensor_ids(sensors))
+        if _may_match(segment, lookups)
+    ]
+
+
+def series(sensors, lookups, reverse=False):
+    """
+    Iterates over the measurements of sensors matching lookups on
+    measured_at and value, from the table, the chunks and the archive,
+    in time order.
+
+    Args:
+        sensors: Sensor queryset or IDs, or None for all sensors.
+        lookups: Dict of lookups, e.g. {"measured_at__gte": start}.
+        reverse: Whether to iterate from the newest measurement.
+    """
+    scope = {} if sensors is None else {"sensor__in": sensors}
+    order = ("-measured_at", "-id") if reverse else ("measured_at", "id")
+    rows = (
+        Measurement.objects.filter(**scope, **lookups)
+        .order_by(*order)
+        .iterator(chunk_size=2000)
+    )
+    archived = _archived(sensors, lookups)
+    if not chunked_storage_enabled() and not archived:
+        return rows
+    chunks = ()
+    if chunked_storage_enabled():
+        chunks = (
+            MeasurementChunk.objects.filter(chunk_q(lookups), **scope)
+            .order_by("-end" if reverse else "start")
+            .iterator(chunk_size=100)
+        )
+    if reverse:
+        archived = sorted(archived, key=lambda segment: segment.end, reverse=True)
+    position = (lambda chunk: chunk.end) if reverse else (lambda chunk: chunk.start)
+    chunks = heapq.merge(chunks, archived, key=position, reverse=reverse)
+    return merge(rows, chunks, lookups, reverse)
+
+
+def count_series(sensors, lookups):
+    """
+    Returns the number of measurements iterated by series().
+    """
+    count = Measurement.objects.filter(sensor__in=sensors, **lookups).count()
+    chunks = _archived(sensors, lookups)
+    if chunked_storage_enabled():
+        chunks = chain(
+            MeasurementChunk.objects.filter(
+                chunk_q(lookups), sensor__in=sensors
+            ).iterator(chunk_size=100),
+            chunks,
+        )
+    for chunk in chunks:
+        if _covers(chunk, lookups):
+            count += chunk.count
+        else:
+            count += len(chunk_measurements(chunk, lookups))
+    return count
+
+
+def chunks_overlap(sensors, start, end):
+    """
+    Returns whether measurements of the sensors in [start, end) are
+    stored in chunks or in the archive.
+    """
+    window = {"measured_at__gte": start, "measured_at__lt": end}
+    if _archived(sensors, window):
+        return True
+    return (
+        chunked_storage_enabled()
+        and MeasurementChunk.objects.filter(
+            sensor__in=sensors, end__gt=start, start__lt=end
+        ).exists()
+    )
+
+
+def latest_sealed(sensor_ids):
+    """
+    Returns the latest measurement of each of the sensors stored in a
+    chunk or in the archive, keyed by sensor ID, decoding only the last
+    chunk or segment of every sensor.
+    """
+    candidates = _archived(sensor_ids, {})
+    if chunked_storage_enabled():
+        newest = MeasurementChunk.objects.filter(sensor_id=OuterRef("sensor_id"))
+        chunks = MeasurementChunk.objects.filter(
+            sensor_id__in=sensor_ids,
+            start=Subquery(newest.order_by("-start").values("start")[:1]),
+        )
+        candidates = chain(candidates, chunks)
+    last = {}
+    for chunk in candidates:
+        current = last.get(chunk.sensor_id)
+        if current is None or chunk.end > current.end:
+            last[chunk.sensor_id] = chunk
+    latest = {}
+    for sensor_id, chunk in last.items():
+        measurements = chunk_measurements(chunk)
+        if measurements:
+            latest[sensor_id] = measurements[-1]
+    return latest
+
+
+def sealed_after(since, lookups):
+    """
+    Returns the IDs of the sensors with readings in chunks or in the
+    archive that may match the lookups and be newer than the time mapped
+    to the sensor in `since` (at any time for None).
+    """
+    if not since:
+        return set()
+
+    def newer(chunk):
+        moment = since[chunk.sensor_id]
+        return moment is None or chunk.end > moment
+
+    found = {
+        segment.sensor_id
+        for segment in _archived(list(since), lookups)
+        if newer(segment)
+    }
+    if chunked_storage_enabled():
+        condition = Q()
+        for sensor_id, moment in since.items():
+            if moment is None:
+                condition |= Q(sensor_id=sensor_id)
+            else:
+                condition |= Q(sensor_id=sensor_id, end__gt=moment)
+        found.update(
+            MeasurementChunk.objects.filter(condition, chunk_q(lookups))
+            .values_list("sensor_id", flat=True)
+            .distinct()
+        )
+    return found
+
+
+def merged_reads_enabled():
+    """
+    Returns whether the read paths have to look beyond the measurement
+    table.
+    """
+    return chunked_storage_enabled() or bool(segments())
+
+
+class _Rows:
+    """
+    A part of a merged list served by slicing a queryset.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    @cached_property
+    def count(self):
+        return self.queryset.count()
+
+    def get(self, start, stop):
+        return list(self.queryset[start:stop])
+
+
+class _List:
+    """
+    A part of a merged list held in memory.
+    """
+
+    def __init__(self, measurements):
+        self.measurements = measurements
+        self.count = len(measurements)
+
+    def get(self, start, stop):
+        return self.measurements[start:stop]
+
+
+def _load_data(chunks):
+    """
+    Loads the deferred data of MeasurementChunks with one query.
+    """
+    pending = {
+        chunk.pk: chunk
+        for chunk in chunks
+        if isinstance(chunk, MeasurementChunk) and "data" not in chunk.__dict__
+    }
+    if pending:
+        loaded = MeasurementChunk.objects.filter(pk__in=pending)
+        for pk, data in loaded.values_list("pk", "data"):
+            pending[pk].data = data
+
+
+class _Segment:
+    """
+    A part of a merged list made of overlapping chunks and the rows
+    falling into their periods. Chunks are decoded only when their
+    readings are needed, or to count readings not all matching or
+    merged with rows.
+    """
+
+    def __init__(self, chunks, rows, lookups, reverse):
+        self.chunks, self.rows = chunks, rows
+        self.lookups, self.reverse = lookups, reverse
+
+    @cached_property
+    def count(self):
+        # Rows may repeat archived readings, so they are counted merged.
+        if not self.rows and all(_covers(c, self.lookups) for c in self.chunks):
+            return sum(chunk.count for chunk in self.chunks)
+        return len(self.measurements)
+
+    @cached_property
+    def measurements(self):
+        _load_data(self.chunks)
+        readings = [
+            measurement
+            for chunk in self.chunks
+            for measurement in chunk_measurements(chunk, self.lookups)
+        ]
+        return list(
+            _unique(sorted(readings + self.rows, key=_sort_key, reverse=self.reverse))
+        )
+
+    def get(self, start, stop):
+        return self.measurements[start:stop]
+
+
+class MergedMeasurements:
+    """
+    A filtered measurement list merged with the matching readings of
+    chunks and archived segments, which can be counted and sliced by a
+    paginator.
+
+    Lists ordered by measured_at decode only the chunks of the requested
+    page (and, with value filters, those needed for counting). Other
+    orderings sort all matching measurements in memory, which is refused
+    above HYDROPONICS_CHUNK_SORT_LIMIT measurements.
+
+    Args:
+        rows: The filtered and ordered measurement queryset.
+        sensors: The sensors selected by the filters.
+        lookups: Filters on measured_at and value.
+        ordering: The ordering of the list, e.g. ["-measured_at"].
+    """
+
+    ordered = True
+
+    def __init__(self, rows, sensors, lookups, ordering):
+        self.lookups = lookups
+        self.ordering = list(ordering)
+        chunks = _archived(sensors, lookups)
+        if chunked_storage_enabled():
+            chunks += MeasurementChunk.objects.filter(
+                chunk_q(lookups), sensor__in=sensors
+            ).defer("data")
+        chunks.sort(key=lambda chunk: chunk.start)
+        if not chunks:
+            self.parts = [_Rows(rows)]
+        elif self.ordering in (["measured_at"], ["-measured_at"]):
+            self.parts = self._time_ordered(rows, chunks)
+        else:
+            self.parts = [self._sorted(rows, chunks)]
+
+    def _time_ordered(self, rows, chunks):
+        reverse = self.ordering == ["-measured_at"]
+        boundary = max(chunk.end for chunk in chunks)
+        # Rows older than the newest chunk arrived after their period was
+        # sealed; they are few until the next compaction takes them in.
+        late = sorted(rows.filter(measured_at__lt=boundary), key=_sort_key)
+        parts, position = [], 0
+        for group in _groups(chunks):
+            low = min(chunk.start for chunk in group)
+            high = max(chunk.end for chunk in group)
+            before = position
+            while position < len(late) and late[position].measured_at < low:
+                position += 1
+            if position > before:
+                parts.append(_Segment([], late[before:position], {}, reverse))
+            before = position
+            while position < len(late) and late[position].measured_at < high:
+                position += 1
+            parts.append(_Segment(group, late[before:position], self.lookups, reverse))
+        if position < len(late):
+            parts.append(_Segment([], late[position:], {}, reverse))
+
+        order = ("-measured_at", "-id") if reverse else ("measured_at", "id")
+        recent = _Rows(rows.filter(measured_at__gte=boundary).order_by(*order))
+        if reverse:
+            return [recent, *reversed(parts)]
+        return [*parts, recent]
+
+    def _sorted(self, rows, chunks):
+        limit = getattr(settings, "HYDROPONICS_CHUNK_SORT_LIMIT", 100000)
+        total = rows.count() + sum(chunk.count for chunk in chunks)
+        if total > limit:
+            raise ValidationError(
+                {
+                    "ordering": f"Sorting more than {limit} measurements by "
+                    f"{', '.join(self.ordering)} is not supported; narrow "
+                    "the measured_at range or order by measured_at."
+                }
+            )
+        _load_data(chunks)
+        measurements = list(rows) + [
+            measurement
+            for chunk in chunks
+            for measurement in chunk_measurements(chunk, self.lookups)
+        ]
+        sensors = Sensor.objects.select_related("system").in_bulk(
+            {measurement.sensor_id for measurement in measurements}
+        )
+        for field in reversed(self.ordering):
+            name = field.lstrip("-")
+            measurements.sort(
+                key=lambda measurement: _attribute(measurement, name, sensors),
+                reverse=field.startswith("-"),
+            )
+        return _List(measurements)
+
+    @cached_property
+    def _count(self):
+        return sum(part.count for part in self.parts)
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index : index + 1][0]
+        start, stop = index.start or 0, index.stop
+        result, offset = [], 0
+        for part in self.parts:
+            if stop is not None and offset >= stop:
+                break
+            size = part.count
+            if offset + size > start:
+                result.extend(
+                    part.get(
+                        max(start - offset, 0),
+                        size if stop is None else min(stop - offset, size),
+                    )
+                )
+            offset += size
+        return result
+
+
+def _attribute(measurement, name, sensors):
+    if not name.startswith("sensor__"):
+        return getattr(measurement, name)
+    target = sensors[measurement.sensor_id]
+    for part in name.split("__")[1:]:
+        target = getattr(target, part)
+    return target.pk if isinstance(target, Model) else target
+
+
+def filterset_lookups(filterset):
+    """
+    Splits the filters of a valid measurement filterset into those
+    selecting sensors, as lookups on Sensor, and the lookups on
+    measured_at and value evaluated on the readings of chunks.
+
+    Returns:
+        A (sensor filters, lookups) pair of dicts.
+    """
+    sensor_filters, lookups = {}, {}
+    for name, value in filterset.form.cleaned_data.items():
+        if value in (None, ""):
+            continue
+        declared = filterset.filters[name]
+        if declared.field_name in ("measured_at", "value"):
+            lookups[f"{declared.field_name}__{declared.lookup_expr}"] = value
+        else:
+            field = declared.field_name.removeprefix("sensor").lstrip("_")
+            if not field:
+                field, value = "pk", getattr(value, "pk", value)
+            sensor_filters[f"{field}__{declared.lookup_expr}"] = value
+    return sensor_filters, lookups
+
+
+def seal(sensor_id, start):
+    """
+    Moves the measurements of a sensor in the period starting at start
+    into its chunk, merging them with the readings already sealed.
+
+    Returns:
+        The number of measurement rows sealed.
+    """
+    end = start + chunk_period()
+    using = router.db_for_write(MeasurementChunk)
+    with transaction.atomic(using=using):
+        rows = list(
+            Measurement.objects.using(using)
+            .select_for_update()
+            .filter(sensor_id=sensor_id, measured_at__gte=start, measured_at__lt=end)
+            .values_list("id", "measured_at", "value")
+        )
+        if not rows:
+            return 0
+        chunk = (
+            MeasurementChunk.objects.using(using)
+            .select_for_update()
+            .filter(sensor_id=sensor_id, start=start)
+            .first()
+        )
+        if chunk is None:
+            chunk = MeasurementChunk(sensor_id=sensor_id, start=start, end=end)
+            readings = rows
+        else:
+            readings = decode_chunk(chunk.data) + rows
+        readings = sorted(
+            {reading[0]: reading for reading in readings}.values(),
+            key=lambda reading: (reading[1], reading[0]),
+        )
+        chunk.data = encode_chunk(readings)
+        chunk.count = len(readings)
+        chunk.min_value = min(reading[2] for reading in readings)
+        chunk.max_value = max(reading[2] for reading in readings)
+        chunk.save(using=using)
+        Measurement.objects.using(using).filter(
+            id__in=[row[0] for row in rows]
+        ).delete()
+    return len(rows)
+
+
+def compact_sensor(sensor_id, before):
+    """
+    Seals the measurements of a sensor taken before a period boundary,
+    one period at a time.
+
+    Returns:
+        The number of measurement rows sealed.
+    """
+    sealed = 0
+    rows = Measurement.objects.filter(sensor_id=sensor_id, measured_at__lt=before)
+    while True:
+        first = rows.aggregate(first=Min("measured_at"))["first"]
+        if first is None:
+            return sealed
+        sealed += seal(sensor_id, period_start(first))
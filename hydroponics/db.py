@@ -0,0 +1,138 @@
+from django.db import connections
+from django.db.migrations.operations import AlterField
+from django.db.migrations.operations.base import Operation
+from django.db.models import CASCADE
+
+from .fields import ScaledDecimalField
+
+"""
+Database-level cascading deletes, and the migration operations this
+project needs beyond Django's.
+
+Foreign keys declared with on_delete=DB_CASCADE are not collected by
+Django on PostgreSQL: the DatabaseCascade migration operation adds
+ON DELETE CASCADE to their constraints, so deleting a row removes its
+dependants in the database without loading them into Python. Other
+backends fall back to the regular CASCADE emulation.
+"""
+
+
+def DB_CASCADE(collector, field, sub_objs, using):
+    if connections[using].vendor != "postgresql":
+        CASCADE(collector, field, sub_objs, using)
+
+
+# Lets the collector skip the query for related objects.
+DB_CASCADE.lazy_sub_objs = True
+
+
+class DatabaseCascade(Operation):
+    """
+    Recreates the foreign key constraint of a field with ON DELETE
+    CASCADE (PostgreSQL only). Must be applied again after any later
+    AlterField that recreates the constraint.
+
+    Attributes:
+        model_name: The model declaring the foreign key.
+        name: The name of the foreign key field.
+    """
+
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, name):
+        self.model_name = model_name
+        self.name = name
+
+    def deconstruct(self):
+        return self.__class__.__name__, [self.model_name, self.name], {}
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._recreate(app_label, schema_editor, to_state, cascade=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._recreate(app_label, schema_editor, to_state, cascade=False)
+
+    def _recreate(self, app_label, schema_editor, state, cascade):
+        connection = schema_editor.connection
+        if connection.vendor != "postgresql":
+            return
+        model = state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(connection.alias, model):
+            return
+
+        field = model._meta.get_field(self.name)
+        table = model._meta.db_table
+        target = field.target_field
+        quote = schema_editor.quote_name
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        for name, info in constraints.items():
+            if info["foreign_key"] and info["columns"] == [field.column]:
+                schema_editor.execute(
+                    f"ALTER TABLE {quote(table)} DROP CONSTRAINT {quote(name)}"
+                )
+        on_delete = " ON DELETE CASCADE" if cascade else ""
+        schema_editor.execute(
+            f"ALTER TABLE {quote(table)} ADD CONSTRAINT "
+            f"{quote(f'{table}_{field.column}_fk')} FOREIGN KEY ({quote(field.column)}) "
+            f"REFERENCES {quote(target.model._meta.db_table)} ({quote(target.column)})"
+            f"{on_delete} DEFERRABLE INITIALLY DEFERRED"
+        )
+
+    def describe(self):
+        return f"Cascade deletes of {self.model_name}.{self.name} in the database"
+
+
+class AlterScaledField(AlterField):
+    """
+    Alters a DecimalField into a ScaledDecimalField, or back when
+    reversed, converting the stored values. On PostgreSQL the column is
+    rewritten by a single ALTER TABLE.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._convert(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._convert(app_label, schema_editor, from_state, to_state)
+
+    def _convert(self, app_label, schema_editor, from_state, to_state):
+        connection = schema_editor.connection
+        from_model = from_state.apps.get_model(app_label, self.model_name)
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(connection.alias, to_model):
+            return
+
+        old_field = from_model._meta.get_field(self.name)
+        new_field = to_model._meta.get_field(self.name)
+        scaled = isinstance(new_field, ScaledDecimalField)
+        factor = 10 ** (new_field if scaled else old_field).decimal_places
+        table = schema_editor.quote_name(to_model._meta.db_table)
+        column = schema_editor.quote_name(new_field.column)
+        if connection.vendor == "postgresql":
+            if scaled:
+                using = f"round({column} * {factor})"
+            else:
+                using = f"{column}::numeric / {factor}"
+            schema_editor.execute(
+                f"ALTER TABLE {table} ALTER COLUMN {column} "
+                f"TYPE {new_field.db_type(connection)} USING {using}"
+            )
+        elif scaled:
+            schema_editor.alter_field(from_model, old_field, new_field)
+            schema_editor.execute(
+                f"UPDATE {table} SET {column} = "
+                f"CAST(ROUND({column} * {factor}) AS INTEGER)"
+            )
+        else:
+            schema_editor.execute(
+                f"UPDATE {table} SET {column} = {column} / {factor}.0"
+            )
+            schema_editor.alter_field(from_model, old_field, new_field)
+
+    def describe(self):
+        return f"Store {self.model_name}.{self.name} as scaled integers"
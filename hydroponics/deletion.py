@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import HydroponicSystem, Measurement, Sensor, Tombstone
+from .sharding import on_shard, shard_aliases
+
+"""
+Background removal of systems and sensors marked for deletion.
+
+The API only marks objects (see HydroponicSystem.mark_for_deletion),
+which hides them immediately. Their measurements are then deleted one
+time slice per statement, so no single statement or transaction runs
+for long, and the remaining rows go with a database-level cascade.
+Tombstones left for synchronizing clients are pruned along the way.
+"""
+
+DEFAULT_SLICE = timedelta(days=1)
+
+
+def delete_measurements(sensor_id, slice=DEFAULT_SLICE):
+    """
+    Deletes all measurements of a sensor, oldest first, one time slice
+    at a time.
+
+    Returns:
+        The number of deleted measurements.
+    """
+    measurements = Measurement.objects.filter(sensor_id=sensor_id)
+    deleted = 0
+    while True:
+        oldest = measurements.aggregate(oldest=Min("measured_at"))["oldest"]
+        if oldest is None:
+            return deleted
+        count, _ = measurements.filter(measured_at__lt=oldest + slice).delete()
+        deleted += count
+
+
+def purge_pending_deletions(slice=DEFAULT_SLICE):
+    """
+    Deletes the sensors and systems marked for deletion, and tombstones
+    older than HYDROPONICS_SYNC_TOMBSTONE_DAYS, on every shard.
+
+    Returns:
+        A (systems, sensors, measurements) tuple of deletion counts.
+    """
+    retention = timedelta(days=getattr(settings, "HYDROPONICS_SYNC_TOMBSTONE_DAYS", 30))
+    systems = sensors = measurements = 0
+    for alias in shard_aliases():
+        with on_shard(alias):
+            Tombstone.objects.filter(deleted_at__lt=timezone.now() - retention).delete()
+            for sensor in Sensor.all_objects.exclude(Sensor.live):
+                measurements += delete_measurements(sensor.id, slice)
+                sensor.delete()
+                sensors += 1
+            for system in HydroponicSystem.all_objects.exclude(HydroponicSystem.live):
+                system.delete()
+                systems += 1
+    return systems, sensors, measurements
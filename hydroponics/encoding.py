@@ -0,0 +1,197 @@
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+from itertools import accumulate
+
+from .models import Measurement
+
+"""
+Binary encodings of measurement series as (id, measured_at, value)
+tuples sorted by time: the row-wise format of MeasurementChunk blobs
+and the columnar, zlib-compressed format of archive files.
+
+Both store IDs and values (scaled to integers by the decimal places of
+Measurement.value) as deltas and timestamps as delta-of-deltas of
+microseconds, all as zigzag varints.
+"""
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+VALUE_SCALE = Measurement._meta.get_field("value").decimal_places
+
+CHUNK_FORMAT = 1
+
+ARCHIVE_MAGIC = b"HYDA"
+ARCHIVE_FORMAT = 1
+# Magic, format version and number of readings.
+ARCHIVE_HEADER = struct.Struct("<4sBI")
+COLUMN_LENGTH = struct.Struct("<I")
+# Orders of differences stored for the ID, time and value columns.
+COLUMN_ORDERS = (1, 2, 1)
+
+
+def _put(out, number):
+    # Zigzag encoding maps small negative numbers to small varints too.
+    number = number * 2 if number >= 0 else -number * 2 - 1
+    while number >= 0x80:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _get(data, position):
+    number, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    number = -(number >> 1) - 1 if number & 1 else number >> 1
+    return number, position
+
+
+def _micros(measured_at):
+    return (measured_at - EPOCH) // MICROSECOND
+
+
+def _scaled(value):
+    return int(Decimal(value).scaleb(VALUE_SCALE).to_integral_value())
+
+
+def _reading(pk, micros, scaled):
+    return pk, EPOCH + micros * MICROSECOND, Decimal(scaled).scaleb(-VALUE_SCALE)
+
+
+def encode_chunk(readings):
+    """
+    Encodes readings row by row, as stored in MeasurementChunk.data.
+    """
+    out = bytearray([CHUNK_FORMAT])
+    _put(out, len(readings))
+    previous_id = previous_time = previous_delta = previous_value = 0
+    for index, (pk, measured_at, value) in enumerate(readings):
+        micros, scaled = _micros(measured_at), _scaled(value)
+        _put(out, pk - previous_id)
+        if index == 0:
+            _put(out, micros)
+            delta = 0
+        else:
+            delta = micros - previous_time
+            _put(out, delta - previous_delta)
+        _put(out, scaled - previous_value)
+        previous_id, previous_time, previous_delta = pk, micros, delta
+        previous_value = scaled
+    return bytes(out)
+
+
+def decode_chunk(data):
+    """
+    Decodes the readings of a MeasurementChunk.
+    """
+    data = bytes(data)
+    if data[0] != CHUNK_FORMAT:
+        raise ValueError(f"Unknown chunk format {data[0]}.")
+    count, position = _get(data, 1)
+    readings = []
+    pk = micros = delta = scaled = 0
+    for index in range(count):
+        step, position = _get(data, position)
+        pk += step
+        change, position = _get(data, position)
+        if index == 0:
+            micros = change
+        else:
+            delta += change
+            micros += delta
+        step, position = _get(data, position)
+        scaled += step
+        readings.append(_reading(pk, micros, scaled))
+    return readings
+
+
+def _encode_column(numbers, order):
+    for _ in range(order):
+        numbers = [
+            current - previous for previous, current in zip([0] + numbers, numbers)
+        ]
+    out = bytearray()
+    for number in numbers:
+        _put(out, number)
+    return zlib.compress(bytes(out))
+
+
+def _decode_column(data, count, order):
+    data = zlib.decompress(data)
+    numbers, position = [], 0
+    for _ in range(count):
+        number, position = _get(data, position)
+        numbers.append(number)
+    for _ in range(order):
+        numbers = list(accumulate(numbers))
+    return numbers
+
+
+def encode_archive(readings):
+    """
+    Encodes readings column by column, as stored in archive files.
+    """
+    columns = (
+        [pk for pk, _, _ in readings],
+        [_micros(measured_at) for _, measured_at, _ in readings],
+        [_scaled(value) for _, _, value in readings],
+    )
+    out = bytearray(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_FORMAT, len(readings)))
+    for numbers, order in zip(columns, COLUMN_ORDERS):
+        data = _encode_column(numbers, order)
+        out += COLUMN_LENGTH.pack(len(data))
+        out += data
+    return bytes(out)
+
+
+def decode_archive_columns(buffer):
+    """
+    Decodes the ID, time (microseconds since EPOCH) and scaled value
+    columns of an archive file from a buffer, e.g. a memory map of the
+    file, as arrays of 64-bit integers.
+    """
+    magic, version, count = ARCHIVE_HEADER.unpack_from(buffer, 0)
+    if magic != ARCHIVE_MAGIC or version != ARCHIVE_FORMAT:
+        raise ValueError(f"Unknown archive format {magic!r} {version}.")
+    position = ARCHIVE_HEADER.size
+    columns = []
+    for order in COLUMN_ORDERS:
+        (length,) = COLUMN_LENGTH.unpack_from(buffer, position)
+        position += COLUMN_LENGTH.size
+        numbers = _decode_column(buffer[position : position + length], count, order)
+        columns.append(array("q", numbers))
+        position += length
+    return columns
+
+
+def archive_readings(columns, since=None, until=None):
+    """
+    Returns the readings of decoded archive columns taken between since
+    and until (both inclusive, unbounded when None), found by bisecting
+    the time column.
+    """
+    ids, times, values = columns
+    first = 0 if since is None else bisect_left(times, _micros(since))
+    last = len(times) if until is None else bisect_right(times, _micros(until))
+    return [
+        _reading(*numbers)
+        for numbers in zip(ids[first:last], times[first:last], values[first:last])
+    ]
+
+
+def decode_archive(buffer):
+    """
+    Decodes the readings of an archive file from a buffer, e.g. a
+    memory map of the file; only the compressed columns are copied.
+    """
+    return archive_readings(decode_archive_columns(buffer))
@@ -0,0 +1,57 @@
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from django.db import models
+
+"""
+Model fields storing numbers compactly.
+"""
+
+
+class ScaledDecimalField(models.DecimalField):
+    """
+    A decimal stored as an integer count of its smallest unit, e.g. the
+    hundredths of the value with decimal_places=2: four bytes per row
+    instead of a variable-length numeric, and integer arithmetic in
+    database aggregates.
+
+    It behaves as a DecimalField everywhere else: values are Decimal
+    instances built from the integers, and forms, filters and
+    serializers treat it as a decimal. Expressions over the column, such
+    as Cast("value", FloatField()) or Avg("value"), see the integers.
+    """
+
+    def get_internal_type(self):
+        return "IntegerField"
+
+    def db_type(self, connection):
+        return connection.data_types["IntegerField"]
+
+    def rel_db_type(self, connection):
+        return self.db_type(connection)
+
+    def scale(self, value):
+        """
+        Returns the stored integer of a Decimal value.
+        """
+        return int(value.scaleb(self.decimal_places).to_integral_value(ROUND_HALF_EVEN))
+
+    def unscale(self, value):
+        """
+        Returns the value of a stored integer (or aggregate of integers).
+        """
+        return Decimal(value).scaleb(-self.decimal_places)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return self.unscale(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None or hasattr(value, "as_sql"):
+            return value
+        return self.scale(value)
+
+    def get_db_prep_save(self, value, connection):
+        return self.get_db_prep_value(value, connection)
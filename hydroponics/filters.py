@@ -1,6 +1,10 @@
+from functools import partial
+
 import django_filters
+from django import forms
 
-from .models import HydroponicSystem, Measurement, Sensor
+from .models import AlertEvent, AlertRule, Measurement, Sensor
+from .ownership import resolver
 
 """
 Definition of custom filters (based on django-filter) for 
@@ -8,6 +12,38 @@ searching and filtering data.
 """
 
 
+class OwnedObjectField(forms.IntegerField):
+    """
+    A form field accepting the ID of an object owned by the user,
+    as decided by the `is_owned` callable.
+    """
+
+    default_error_messages = {
+        "invalid_choice": "Select a valid choice. "
+        "That choice is not one of the available choices.",
+    }
+
+    def __init__(self, *, is_owned=None, **kwargs):
+        self.is_owned = is_owned
+        super().__init__(**kwargs)
+
+    def validate(self, value):
+        super().validate(value)
+        if value is not None and not (self.is_owned and self.is_owned(value)):
+            raise forms.ValidationError(
+                self.error_messages["invalid_choice"], code="invalid_choice"
+            )
+
+
+class OwnedObjectFilter(django_filters.NumberFilter):
+    """
+    An exact-match filter on a related object ID, restricted to objects
+    owned by the user through the cached ownership resolver.
+    """
+
+    field_class = OwnedObjectField
+
+
 class MeasurementFilter(django_filters.FilterSet):
     """
     A filter that allows searching measurements by various types
@@ -27,12 +63,8 @@ class MeasurementFilter(django_filters.FilterSet):
             connected to user.
     """
 
-    sensor__system = django_filters.ModelChoiceFilter(
-        queryset=HydroponicSystem.objects.none(), label="System"
-    )
-    sensor = django_filters.ModelChoiceFilter(
-        queryset=Sensor.objects.none(), label="Sensor"
-    )
+    sensor__system = OwnedObjectFilter(label="System")
+    sensor = OwnedObjectFilter(label="Sensor")
 
     class Meta:
         model = Measurement
@@ -54,11 +86,13 @@ class MeasurementFilter(django_filters.FilterSet):
         super().__init__(*args, **kwargs)
 
         if request and hasattr(request, "user"):
-            user = request.user
-            self.filters["sensor__system"].queryset = HydroponicSystem.objects.filter(
-                owner=user
+            user_id = request.user.id
+            self.filters["sensor__system"].extra["is_owned"] = partial(
+                resolver.owns_system, user_id
+            )
+            self.filters["sensor"].extra["is_owned"] = partial(
+                resolver.owns_sensor, user_id
             )
-            self.filters["sensor"].queryset = Sensor.objects.filter(system__owner=user)
 
 
 class SensorFilter(django_filters.FilterSet):
@@ -77,9 +111,7 @@ class SensorFilter(django_filters.FilterSet):
             connected to user.
     """
 
-    system = django_filters.ModelChoiceFilter(
-        queryset=HydroponicSystem.objects.none(), label="System"
-    )
+    system = OwnedObjectFilter(label="System")
 
     class Meta:
         model = Sensor
@@ -98,7 +130,63 @@ class SensorFilter(django_filters.FilterSet):
         super().__init__(*args, **kwargs)
         request = kwargs.get("request")
         if request and hasattr(request, "user"):
-            user = request.user
-            self.filters["system"].queryset = HydroponicSystem.objects.filter(
-                owner=user
+            self.filters["system"].extra["is_owned"] = partial(
+                resolver.owns_system, request.user.id
+            )
+
+
+def owns_rule(user_id, rule_id):
+    """
+    Returns whether an alert rule belongs to the user.
+    """
+    return AlertRule.objects.filter(pk=rule_id, owner_id=user_id).exists()
+
+
+class AlertEventFilter(django_filters.FilterSet):
+    """
+    A filter that allows searching alert events by various types
+    of data.
+
+    In Meta fields:
+        rule: Filter by rule ID.
+        sensor: Filter by sensor ID.
+        sensor__system: Filter by system ID.
+        measured_at: Filter by reading date range.
+
+    Attributes:
+        rule: Initialization for list of rules of the user.
+        sensor: Initialization for list of sensors
+            connected to user.
+        sensor__system: Initialization for list of systems
+            connected to user.
+    """
+
+    rule = OwnedObjectFilter(label="Rule")
+    sensor = OwnedObjectFilter(label="Sensor")
+    sensor__system = OwnedObjectFilter(label="System")
+
+    class Meta:
+        model = AlertEvent
+        fields = {
+            "rule": ["exact"],
+            "sensor": ["exact"],
+            "sensor__system": ["exact"],
+            "measured_at": ["gte", "lte"],
+        }
+
+    def __init__(self, *args, **kwargs):
+        """
+        Restricting list of rules, systems and sensors
+        to those owned by the logged-in user.
+        """
+        super().__init__(*args, **kwargs)
+        request = kwargs.get("request")
+        if request and hasattr(request, "user"):
+            user_id = request.user.id
+            self.filters["rule"].extra["is_owned"] = partial(owns_rule, user_id)
+            self.filters["sensor"].extra["is_owned"] = partial(
+                resolver.owns_sensor, user_id
+            )
+            self.filters["sensor__system"].extra["is_owned"] = partial(
+                resolver.owns_system, user_id
             )
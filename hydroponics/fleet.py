@@ -0,0 +1,136 @@
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+from django.utils import timezone
+
+from .chunks import latest_sealed, merged_reads_enabled
+from .models import HydroponicSystem, Sensor
+from .readings import latest_rows
+from .serializers import ALLOWED_RANGES
+
+"""
+Health summary of all systems of a user.
+
+The summary takes a fixed number of queries however many systems and
+sensors the user has: one for the systems, one for their sensors and
+one for the latest reading of every sensor (see hydroponics.readings),
+plus one for the chunks (and a look at the archive) of the sensors
+without rows in the measurement table.
+"""
+
+# Orderings of the summary: sort key and whether it is descending.
+ORDERINGS = {
+    "name": (lambda system: (system["name"].lower(), system["id"]), False),
+    # Systems without any reading first, then the longest silent ones.
+    "stale": (
+        lambda system: (
+            system["last_measured_at"] is not None,
+            system["last_measured_at"] or datetime.min.replace(tzinfo=dt_timezone.utc),
+            system["id"],
+        ),
+        False,
+    ),
+    "out_of_range": (
+        lambda system: (system["out_of_range"], -system["id"]),
+        True,
+    ),
+}
+
+
+def in_allowed_range(sensor_type, value):
+    """
+    Returns whether a value is within the ALLOWED_RANGES of the sensor
+    type; values of sensor types without a range always are.
+    """
+    if sensor_type not in ALLOWED_RANGES:
+        return True
+    min_val, max_val = ALLOWED_RANGES[sensor_type]
+    return min_val <= value <= max_val
+
+
+def _latest_readings(sensor_ids):
+    """
+    Returns the latest measurement of each sensor that has one, keyed
+    by sensor ID.
+    """
+    latest = {
+        sensor_id: readings[0]
+        for sensor_id, readings in latest_rows(sensor_ids, 1).items()
+        if readings
+    }
+    missing = [sensor_id for sensor_id in sensor_ids if sensor_id not in latest]
+    if missing and merged_reads_enabled():
+        latest.update(latest_sealed(missing))
+    return latest
+
+
+def fleet_summary(owner_id, ordering="name"):
+    """
+    Summarizes the latest readings of every system of a user.
+
+    Args:
+        owner_id: The ID of the user.
+        ordering: One of ORDERINGS.
+
+    Returns:
+        A list of dicts, one per system, with the sensor count, the time
+        of the latest reading and the seconds since, the number of
+        sensors whose latest reading is out of range, and the latest
+        reading of each sensor type.
+    """
+    now = timezone.now()
+    systems = {
+        system_id: {
+            "id": system_id,
+            "name": name,
+            "sensor_count": 0,
+            "last_measured_at": None,
+            "seconds_since_last": None,
+            "out_of_range": 0,
+            "sensor_types": {},
+        }
+        for system_id, name in HydroponicSystem.objects.filter(
+            owner_id=owner_id
+        ).values_list("id", "name")
+    }
+    sensors = list(
+        Sensor.objects.filter(system__owner_id=owner_id).values_list(
+            "id", "system_id", "sensor_type"
+        )
+    )
+    latest = _latest_readings([sensor_id for sensor_id, _, _ in sensors])
+
+    for sensor_id, system_id, sensor_type in sensors:
+        system = systems.get(system_id)
+        if system is None:
+            continue
+        system["sensor_count"] += 1
+        measurement = latest.get(sensor_id)
+        if measurement is None:
+            continue
+        in_range = in_allowed_range(sensor_type, measurement.value)
+        if not in_range:
+            system["out_of_range"] += 1
+        last = system["last_measured_at"]
+        if last is None or measurement.measured_at > last:
+            system["last_measured_at"] = measurement.measured_at
+        current = system["sensor_types"].get(sensor_type)
+        if current is None or measurement.measured_at > current["measured_at"]:
+            system["sensor_types"][sensor_type] = {
+                "sensor_type": sensor_type,
+                "sensor": sensor_id,
+                "value": measurement.value,
+                "measured_at": measurement.measured_at,
+                "in_range": in_range,
+            }
+
+    for system in systems.values():
+        if system["last_measured_at"] is not None:
+            elapsed = now - system["last_measured_at"]
+            system["seconds_since_last"] = max(elapsed.total_seconds(), 0)
+        system["sensor_types"] = [
+            system["sensor_types"][sensor_type]
+            for sensor_type in sorted(system["sensor_types"])
+        ]
+    key, reverse = ORDERINGS[ordering]
+    return sorted(systems.values(), key=key, reverse=reverse)
@@ -0,0 +1,433 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.db import (InterfaceError, OperationalError, close_old_connections,
+                       router, transaction)
+from django.utils.dateparse import parse_datetime
+
+from .alerts import evaluate_measurements
+from .metrics import registry
+from .models import IngestedSegment, Measurement, Sensor
+from .ownership import resolver
+from .routers import shard_for_owner
+from .sharding import TenantMoving, is_sharded, on_shard
+
+"""
+Measurement ingestion: the shared batched write path, and the optional
+write-behind buffer that acknowledges readings once they are fsync'd
+to a local append-only log and inserts them in batches later.
+"""
+
+logger = logging.getLogger(__name__)
+
+queue_depth = registry.gauge(
+    "hydroponics_ingest_queue_depth",
+    "Readings accepted by this process and not yet written to the database.",
+)
+flush_latency = registry.summary(
+    "hydroponics_ingest_flush_seconds",
+    "Time spent writing one log segment to the database.",
+)
+flushed_rows = registry.counter(
+    "hydroponics_ingest_flushed_rows_total",
+    "Readings written to the database by the write-behind flusher.",
+)
+flush_errors = registry.counter(
+    "hydroponics_ingest_flush_errors_total",
+    "Failed attempts to write a log segment to the database.",
+)
+quarantined_segments = registry.counter(
+    "hydroponics_ingest_quarantined_segments_total",
+    "Log segments set aside as .failed after failing to be written repeatedly.",
+)
+
+# Errors of the database or the shard map rather than of a segment's
+# contents: the flush stops and every segment is retried later.
+TRANSIENT_ERRORS = (InterfaceError, OperationalError, TenantMoving)
+
+
+def group_by_shard(measurements):
+    """
+    Groups unsaved measurements by the shard of their sensor's owner.
+    Measurements of unknown sensors are assigned to the default database.
+
+    Raises:
+        TenantMoving: if any of the owners is being moved between shards.
+    """
+    if not is_sharded():
+        return {"default": list(measurements)}
+    sensors = resolver.sensors_bulk({m.sensor_id for m in measurements})
+    groups = defaultdict(list)
+    for measurement in measurements:
+        entry = sensors.get(measurement.sensor_id)
+        shard = shard_for_owner(entry.owner_id, for_write=True) if entry else "default"
+        groups[shard].append(measurement)
+    return groups
+
+
+def write_measurements(measurements):
+    """
+    Inserts unsaved Measurement instances with multi-row INSERTs and
+    evaluates alert rules for them, in one transaction per shard.
+
+    Returns:
+        The created measurements.
+    """
+    created = []
+    for alias, group in group_by_shard(measurements).items():
+        with on_shard(alias):
+            with transaction.atomic(using=router.db_for_write(Measurement)):
+                rows = Measurement.objects.bulk_create(group, batch_size=1000)
+                evaluate_measurements(rows)
+            created += rows
+    return created
+
+
+def to_record(sensor_id, value, measured_at):
+    """
+    Returns the log representation of a validated reading.
+    """
+    return {"s": sensor_id, "v": str(value), "t": measured_at.isoformat()}
+
+
+def from_record(record):
+    """
+    Returns an unsaved Measurement for a log record.
+    """
+    return Measurement(
+        sensor_id=record["s"], value=record["v"], measured_at=parse_datetime(record["t"])
+    )
+
+
+class IngestionLog:
+    """
+    A directory of append-only JSON-lines segments.
+
+    The active segment of a process is named `<pid>-<n>.active` and is
+    held under an exclusive flock while the process is alive. Rotation
+    renames it to `.sealed`; a flusher claims a sealed segment by renaming
+    it to `.flushing` (again under flock). Any `.active` or `.flushing`
+    segment whose lock can be taken belongs to a dead process and is
+    recovered by sealing it again. A segment that cannot be written is
+    quarantined by renaming it to `.failed`.
+
+    Attributes:
+        directory: Path of the log directory.
+        attempts: Failed attempts to write each segment, by name.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.attempts = Counter()
+        self._file = None
+        self._path = None
+        self._sequence = 0
+
+    def _open(self):
+        self._sequence += 1
+        name = f"{os.getpid()}-{time.time_ns()}-{self._sequence}"
+        pending = self.directory / f"{name}.tmp"
+        self._file = open(pending, "ab")
+        # Locked before it becomes visible, so it is never taken for an orphan.
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._path = self.directory / f"{name}.active"
+        os.rename(pending, self._path)
+
+    def append(self, records):
+        """
+        Appends records and fsyncs them before returning.
+        """
+        self.sync(self.write(records))
+
+    def write(self, records):
+        """
+        Appends records without waiting for the disk.
+
+        Returns:
+            A descriptor of the segment for `sync`, which remains valid
+            after the segment is rotated.
+        """
+        if self._file is None:
+            self._open()
+        data = b"".join(
+            json.dumps(record, separators=(",", ":")).encode() + b"\n"
+            for record in records
+        )
+        self._file.write(data)
+        self._file.flush()
+        return os.dup(self._file.fileno())
+
+    @staticmethod
+    def sync(descriptor):
+        """
+        Fsyncs the records written before a `write` returned the
+        descriptor, and closes it.
+        """
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def rotate(self):
+        """
+        Seals the active segment so it can be flushed.
+        """
+        if self._file is None:
+            return
+        sealed = self._path.with_suffix(".sealed")
+        os.rename(self._path, sealed)
+        self._file.close()
+        self._file = None
+        self._path = None
+
+    def recover_orphans(self):
+        """
+        Seals segments left behind by processes that are no longer running.
+        """
+        for path in list(self.directory.glob("*.active")) + list(
+            self.directory.glob("*.flushing")
+        ):
+            if path == self._path:
+                continue
+            try:
+                with open(path, "rb") as handle:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.rename(path, path.with_suffix(".sealed"))
+            except (BlockingIOError, FileNotFoundError):
+                continue
+
+    def claim(self):
+        """
+        Yields sealed segments as (name, records, path), holding each
+        under flock until the consumer moves on. The consumer calls
+        `release(path)` once the records are durably stored.
+        """
+        for sealed in sorted(self.directory.glob("*.sealed")):
+            try:
+                handle = open(sealed, "rb")
+            except FileNotFoundError:
+                continue
+            with handle:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    flushing = sealed.with_suffix(".flushing")
+                    os.rename(sealed, flushing)
+                except (BlockingIOError, FileNotFoundError):
+                    continue
+                records = []
+                for line in handle:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A torn last line from a crash mid-write.
+                        logger.warning("Skipping corrupt record in %s", flushing)
+                yield sealed.stem, records, flushing
+
+    @staticmethod
+    def release(path):
+        os.remove(path)
+
+    def fail(self, path, max_attempts):
+        """
+        Returns a claimed segment that could not be written, sealing it
+        again for a later attempt or, after max_attempts, quarantining it.
+
+        Returns:
+            Whether the segment was quarantined.
+        """
+        name = path.stem
+        self.attempts[name] += 1
+        if self.attempts[name] < max_attempts:
+            os.rename(path, path.with_suffix(".sealed"))
+            return False
+        os.rename(path, path.with_suffix(".failed"))
+        del self.attempts[name]
+        return True
+
+    def retry_failed(self):
+        """
+        Seals the quarantined segments again and returns their number.
+        """
+        failed = list(self.directory.glob("*.failed"))
+        for path in failed:
+            os.rename(path, path.with_suffix(".sealed"))
+        return len(failed)
+
+    def pending_segments(self):
+        return len(list(self.directory.glob("*.sealed")))
+
+    def failed_segments(self):
+        return len(list(self.directory.glob("*.failed")))
+
+
+def flush_log(log):
+    """
+    Writes all sealed segments of the log to the database.
+
+    Each segment is inserted in one transaction per shard together with
+    an IngestedSegment marker on that shard, so replaying a segment that
+    was already written (a crash between commit and file removal) is a
+    no-op. Readings of sensors deleted in the meantime are dropped.
+
+    A segment failing to be written is sealed again and the following
+    ones are written; after HYDROPONICS_INGEST_MAX_ATTEMPTS failures it
+    is quarantined as `.failed` (see `flush_ingest_log --retry-failed`).
+    Errors of the database itself stop the flush.
+
+    Returns:
+        The number of readings written.
+
+    Raises:
+        One of TRANSIENT_ERRORS, once the claimed segment is sealed again.
+    """
+    max_attempts = getattr(settings, "HYDROPONICS_INGEST_MAX_ATTEMPTS", 5)
+    written = 0
+    for name, records, path in log.claim():
+        started = time.monotonic()
+        try:
+            groups = group_by_shard([from_record(record) for record in records])
+            for alias, measurements in groups.items():
+                with on_shard(alias), transaction.atomic(using=alias):
+                    if IngestedSegment.objects.filter(name=name).exists():
+                        logger.info("Segment %s was already ingested.", name)
+                        continue
+                    sensors = set(
+                        Sensor.objects.filter(
+                            id__in={m.sensor_id for m in measurements}
+                        ).values_list("id", flat=True)
+                    )
+                    measurements = [m for m in measurements if m.sensor_id in sensors]
+                    IngestedSegment.objects.create(name=name, rows=len(measurements))
+                    write_measurements(measurements)
+                    written += len(measurements)
+                    flushed_rows.inc(len(measurements))
+        except TRANSIENT_ERRORS:
+            flush_errors.inc()
+            logger.exception("Failed to flush ingestion segment %s.", name)
+            os.rename(path, path.with_suffix(".sealed"))
+            raise
+        except Exception:
+            flush_errors.inc()
+            if log.fail(path, max_attempts):
+                quarantined_segments.inc()
+                logger.exception(
+                    "Quarantined ingestion segment %s after %d failed attempts.",
+                    name,
+                    max_attempts,
+                )
+            else:
+                logger.exception("Failed to flush ingestion segment %s.", name)
+            continue
+        flush_latency.observe(time.monotonic() - started)
+        log.release(path)
+    return written
+
+
+class WriteBehindBuffer:
+    """
+    Accepts validated readings, persists them to the ingestion log and
+    flushes them to the database from a background thread every
+    `flush_interval` seconds or as soon as `flush_rows` are pending.
+
+    Attributes:
+        log: The underlying IngestionLog.
+        flush_interval: Maximum delay before pending readings are flushed.
+        flush_rows: Number of pending readings that triggers a flush.
+    """
+
+    def __init__(self, directory, flush_interval, flush_rows):
+        self.log = IngestionLog(directory)
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._pending = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        queue_depth.set_function(lambda: self._pending + self._in_flight)
+
+    def submit(self, records):
+        """
+        Durably appends records to the log and schedules a flush.
+        """
+        with self._lock:
+            descriptor = self.log.write(records)
+            self._pending += len(records)
+            pending = self._pending
+            if self._thread is None:
+                self._start()
+        # Concurrent requests wait for the disk together, not in turn.
+        self.log.sync(descriptor)
+        if pending >= self.flush_rows:
+            self._wake.set()
+
+    def _start(self):
+        self.log.recover_orphans()
+        self._thread = threading.Thread(
+            target=self._run, name="ingest-flusher", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(self.flush_interval)
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """
+        Seals the active segment and writes every sealed segment.
+        Readings of a failed flush remain in flight until a later one
+        succeeds.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self.log.rotate()
+                self._in_flight += self._pending
+                self._pending = 0
+                taken = self._in_flight
+            flush_log(self.log)
+            with self._lock:
+                self._in_flight -= taken
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """
+    Returns the process-wide write-behind buffer configured in settings.
+    """
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer(
+                settings.HYDROPONICS_INGEST_LOG_DIR,
+                settings.HYDROPONICS_INGEST_FLUSH_INTERVAL_MS / 1000,
+                settings.HYDROPONICS_INGEST_FLUSH_ROWS,
+            )
+        return _buffer
+
+
+def is_buffered():
+    """
+    Returns True when measurements are ingested through the write-behind buffer.
+    """
+    return getattr(settings, "HYDROPONICS_INGEST_MODE", "direct") == "buffered"
@@ -0,0 +1,256 @@
+import logging
+import os
+import random
+import socket
+import threading
+from collections import namedtuple
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job
+from .sharding import tenant
+
+"""
+A small database-backed job queue.
+
+Jobs are rows of the Job table. Workers (the run_jobs command) claim
+them with SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers
+can poll the same table without a broker. A running job holds a lease
+renewed by its worker; jobs whose lease expired (a crashed worker) are
+claimed again. Failed attempts are retried with exponential backoff.
+
+Job kinds are registered with the `register` decorator; the built-in
+kinds live in hydroponics.tasks.
+"""
+
+logger = logging.getLogger(__name__)
+
+JobKind = namedtuple("JobKind", ["name", "handler", "params_serializer", "staff_only"])
+
+kinds = {}
+
+
+class JobCancelled(Exception):
+    """
+    Raised in a running job when it was cancelled or taken over by
+    another worker.
+    """
+
+
+def register(name, params_serializer=None, staff_only=False):
+    """
+    Registers a job handler, called with the Job and returning its
+    JSON-serializable result.
+
+    Args:
+        name: The job kind.
+        params_serializer: Serializer validating the parameters given
+            through the API, or None if the kind takes no parameters.
+        staff_only: Whether only staff users may enqueue the kind.
+    """
+
+    def decorator(handler):
+        kinds[name] = JobKind(name, handler, params_serializer, staff_only)
+        return handler
+
+    return decorator
+
+
+def lease_duration():
+    return timedelta(seconds=getattr(settings, "HYDROPONICS_JOB_LEASE_SECONDS", 60))
+
+
+def retry_delay(attempts):
+    """
+    Returns the backoff before the next attempt, doubling per failed
+    attempt up to HYDROPONICS_JOB_RETRY_MAX_SECONDS, with jitter.
+    """
+    base = getattr(settings, "HYDROPONICS_JOB_RETRY_BASE_SECONDS", 10)
+    cap = getattr(settings, "HYDROPONICS_JOB_RETRY_MAX_SECONDS", 3600)
+    delay = min(cap, base * 2 ** max(attempts - 1, 0))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def enqueue(kind, owner_id=None, params=None, unique=False):
+    """
+    Adds a job to the queue.
+
+    Args:
+        kind: A registered job kind.
+        owner_id: The user the job runs for, if any.
+        params: Parameters of the job.
+        unique: Return an identical queued job instead of adding another.
+
+    Returns:
+        The Job.
+    """
+    params = params or {}
+    if unique:
+        existing = Job.objects.filter(
+            kind=kind, owner_id=owner_id, params=params, status=Job.QUEUED
+        ).first()
+        if existing is not None:
+            return existing
+    return Job.objects.create(kind=kind, owner_id=owner_id, params=params)
+
+
+def claim(worker):
+    """
+    Locks the next runnable job, skipping jobs locked by other workers,
+    and marks it as running.
+
+    Returns:
+        The claimed Job, or None if no job is runnable.
+    """
+    now = timezone.now()
+    runnable = Q(status=Job.QUEUED, run_after__lte=now) | Q(
+        status=Job.RUNNING, lease_expires_at__lt=now
+    )
+    with transaction.atomic():
+        job = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(runnable)
+            .order_by("run_after", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = Job.RUNNING
+        job.attempts += 1
+        job.worker = worker
+        job.started_at = now
+        job.lease_expires_at = now + lease_duration()
+        job.save(
+            update_fields=[
+                "status",
+                "attempts",
+                "worker",
+                "started_at",
+                "lease_expires_at",
+            ]
+        )
+    return job
+
+
+def report_progress(job, fraction, message=""):
+    """
+    Records the progress of a running job.
+
+    Raises:
+        JobCancelled: if the job no longer belongs to this worker.
+    """
+    if job._lost.is_set():
+        raise JobCancelled()
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(
+        progress=max(0.0, min(fraction, 1.0)), message=message[:255]
+    )
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renews the lease of a running job until stopped, and flags the job
+    as lost if it was cancelled or claimed by another worker.
+    """
+
+    def __init__(self, job):
+        super().__init__(name=f"job-heartbeat-{job.pk}", daemon=True)
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        interval = lease_duration().total_seconds() / 3
+        try:
+            while not self.stopped.wait(interval):
+                renewed = Job.objects.filter(
+                    pk=self.job.pk, status=Job.RUNNING, worker=self.job.worker
+                ).update(lease_expires_at=timezone.now() + lease_duration())
+                if not renewed:
+                    self.job._lost.set()
+                    return
+        finally:
+            connection.close()
+
+
+def _finish(job, **fields):
+    return Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(
+        lease_expires_at=None, **fields
+    )
+
+
+def run(job):
+    """
+    Runs a claimed job and records its outcome. Jobs of a user run
+    with that user's data routing (see hydroponics.sharding).
+    """
+    job._lost = threading.Event()
+    kind = kinds.get(job.kind)
+    heartbeat = _Heartbeat(job)
+    heartbeat.start()
+    try:
+        if kind is None:
+            raise ValueError(f"Unknown job kind {job.kind!r}.")
+        if job.attempts > job.max_attempts:
+            raise RuntimeError("The job was abandoned by its worker too often.")
+        with tenant(job.owner_id) if job.owner_id else nullcontext():
+            result = kind.handler(job)
+    except JobCancelled:
+        logger.info("Job %s was cancelled.", job.pk)
+    except Exception as error:
+        logger.exception("Job %s (%s) failed.", job.pk, job.kind)
+        message = f"{type(error).__name__}: {error}"
+        if kind is not None and job.attempts < job.max_attempts:
+            _finish(
+                job,
+                status=Job.QUEUED,
+                error=message,
+                run_after=timezone.now() + retry_delay(job.attempts),
+            )
+        else:
+            _finish(job, status=Job.FAILED, error=message, finished_at=timezone.now())
+    else:
+        _finish(
+            job,
+            status=Job.SUCCEEDED,
+            result=result,
+            progress=1.0,
+            error="",
+            finished_at=timezone.now(),
+        )
+    finally:
+        heartbeat.stopped.set()
+
+
+def worker_name(index):
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+def work(worker, stop, poll_interval=1.0, exit_when_idle=False):
+    """
+    Claims and runs jobs until `stop` is set (or, with `exit_when_idle`,
+    until no job is runnable). Errors are logged and do not end the loop.
+    """
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            job = claim(worker)
+        except Exception:
+            logger.exception("Failed to claim a job.")
+            job = None
+        if job is None:
+            if exit_when_idle:
+                return
+            stop.wait(poll_interval)
+            continue
+        try:
+            run(job)
+        except Exception:
+            # E.g. the database went away while recording the outcome; the
+            # job is claimed again once its lease expires.
+            logger.exception("Failed to run job %s.", job.pk)
+            stop.wait(poll_interval)
+    close_old_connections()
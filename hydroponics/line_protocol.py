@@ -0,0 +1,422 @@
+import asyncio
+import hmac
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+
+from django.db import close_old_connections
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.exceptions import Throttled
+
+from .ingest import TRANSIENT_ERRORS, group_by_shard, write_measurements
+from .metrics import registry
+from .models import Measurement, Sensor, hash_api_key
+from .serializers import validate_value_range
+from .sharding import fan_out
+from .throttling import throttle
+
+"""
+A compact line protocol for constrained devices, served over TCP and UDP.
+
+Every line is either an authentication line or a reading:
+
+    AUTH <sensor_id> <api_key>
+    <sensor_id> <value> [<unix timestamp>]
+
+A TCP connection authenticates each sensor once and may then send readings
+for it; a UDP datagram is a self-contained session, so it carries its AUTH
+lines before the readings. Readings are validated like in
+MeasurementSerializer.validate, rate limited like the API ingestion
+endpoints and written in batches.
+
+The lines are handled by blocks, a UDP datagram or whatever a TCP read
+returned: the readings of a block are rate limited with one check per
+owner, run off the event loop like the database queries, and admitted or
+rejected together.
+"""
+
+logger = logging.getLogger(__name__)
+
+accepted_lines = registry.counter(
+    "hydroponics_line_protocol_readings_total",
+    "Readings accepted by the line-protocol listener.",
+)
+rejected_lines = registry.counter(
+    "hydroponics_line_protocol_rejected_total",
+    "Lines rejected by the line-protocol listener.",
+)
+dropped_readings = registry.counter(
+    "hydroponics_line_protocol_dropped_total",
+    "Accepted readings the line-protocol listener could not write, by reason.",
+)
+
+TWO_PLACES = Decimal("0.01")
+
+# Longest accepted line, in bytes.
+LINE_LIMIT = 2**16
+
+
+class LineProtocolError(ValueError):
+    """
+    Raised for a line that cannot be accepted.
+    """
+
+
+def parse_reading(line):
+    """
+    Parses a reading line into (sensor_id, value, measured_at).
+    """
+    parts = line.split()
+    if len(parts) not in (2, 3):
+        raise LineProtocolError("Expected '<sensor_id> <value> [<timestamp>]'.")
+    try:
+        sensor_id = int(parts[0])
+        value = Decimal(parts[1]).quantize(TWO_PLACES)
+        if not value.is_finite():
+            raise InvalidOperation
+    except (ValueError, InvalidOperation):
+        raise LineProtocolError("Invalid sensor id or value.")
+    if len(parts) == 3:
+        try:
+            measured_at = datetime.fromtimestamp(float(parts[2]), tz=dt_timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            raise LineProtocolError("Invalid timestamp.")
+    else:
+        measured_at = timezone.now()
+    return sensor_id, value, measured_at
+
+
+class Session:
+    """
+    Authentication state of one TCP connection or UDP datagram.
+
+    Attributes:
+        sensors: (sensor type, owner ID, system rate limit) of the sensors
+            authenticated in the session.
+    """
+
+    def __init__(self):
+        self.sensors = {}
+
+
+class LineProtocolServer:
+    """
+    Accepts line-protocol readings and writes them in batches.
+
+    Readings that cannot be written because the database is unavailable
+    are kept for the next flush, up to max_pending readings. Readings of
+    sensors deleted in the meantime are dropped, and a batch failing for
+    another reason is split until the failing readings are isolated, so
+    they do not take the rest of the batch with them.
+
+    Attributes:
+        batch_size: Number of pending readings that triggers a write.
+        flush_interval: Maximum delay in seconds before pending readings
+            are written.
+        key_cache_ttl: Seconds an API key lookup is cached for.
+        max_pending: Number of readings kept while they cannot be written;
+            the oldest are dropped beyond it.
+        addresses: The bound (host, port) of the "tcp" and "udp" listeners.
+    """
+
+    def __init__(
+        self, batch_size=5000, flush_interval=0.2, key_cache_ttl=60, max_pending=None
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.key_cache_ttl = key_cache_ttl
+        self.max_pending = max_pending or 10 * batch_size
+        self.addresses = {}
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
+        self._keys = {}
+
+    async def authenticate(self, session, sensor_id, key):
+        """
+        Verifies a sensor API key and marks the sensor as authenticated.
+        """
+        cached = self._keys.get(sensor_id)
+        if cached is None or cached[-1] < time.monotonic():
+            row = await asyncio.to_thread(self._load_sensor, sensor_id)
+            cached = (*row, time.monotonic() + self.key_cache_ttl)
+            self._keys[sensor_id] = cached
+        sensor_type, key_hash, owner_id, rate_limit, _ = cached
+        if not key_hash or not hmac.compare_digest(key_hash, hash_api_key(key)):
+            raise LineProtocolError(f"Authentication failed for sensor {sensor_id}.")
+        session.sensors[sensor_id] = (sensor_type, owner_id, rate_limit)
+
+    @staticmethod
+    def _load_sensor(sensor_id):
+        close_old_connections()
+        queryset = Sensor.objects.filter(id=sensor_id).values_list(
+            "sensor_type",
+            "api_key_hash",
+            "system__owner_id",
+            "system__ingest_rate_limit",
+        )
+        for shard_queryset in fan_out(queryset):
+            row = shard_queryset.first()
+            if row is not None:
+                return row
+        return (None, "", None, None)
+
+    async def process_line(self, session, line):
+        """
+        Handles one line of input.
+
+        Returns:
+            The validated reading as (owner ID, system rate limit,
+            Measurement), or None for an authentication line.
+
+        Raises:
+            LineProtocolError: if the line is rejected.
+        """
+        if line.startswith("AUTH "):
+            parts = line.split()
+            if len(parts) != 3 or not parts[1].isdigit():
+                raise LineProtocolError("Expected 'AUTH <sensor_id> <api_key>'.")
+            await self.authenticate(session, int(parts[1]), parts[2])
+            return None
+
+        sensor_id, value, measured_at = parse_reading(line)
+        if sensor_id not in session.sensors:
+            raise LineProtocolError(f"Sensor {sensor_id} is not authenticated.")
+        sensor_type, owner_id, rate_limit = session.sensors[sensor_id]
+        try:
+            validate_value_range(sensor_type, value)
+        except serializers.ValidationError as error:
+            raise LineProtocolError(str(error.detail[0]))
+        measurement = Measurement(
+            sensor_id=sensor_id, value=value, measured_at=measured_at
+        )
+        return owner_id, rate_limit, measurement
+
+    async def process_lines(self, session, lines, start=1):
+        """
+        Handles a block of lines, numbered from start, and returns the
+        error messages.
+        """
+        errors, readings = [], []
+        for number, line in enumerate(lines, start=start):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                reading = await self.process_line(session, line)
+            except LineProtocolError as error:
+                errors.append((number, str(error)))
+                continue
+            if reading is not None:
+                readings.append((number, reading))
+
+        if readings:
+            refused = await asyncio.to_thread(
+                self._throttle, [reading for _, reading in readings]
+            )
+            accepted = 0
+            for number, (owner_id, _, measurement) in readings:
+                if owner_id in refused:
+                    errors.append((number, refused[owner_id]))
+                else:
+                    self._pending.append(measurement)
+                    accepted += 1
+            accepted_lines.inc(accepted)
+            if len(self._pending) >= self.batch_size:
+                await self.flush()
+        if errors:
+            rejected_lines.inc(len(errors))
+        return [f"ERR {number} {message}" for number, message in sorted(errors)]
+
+    async def process_text(self, session, text):
+        """
+        Handles a block of text and returns the error messages.
+        """
+        return await self.process_lines(session, text.splitlines())
+
+    @staticmethod
+    def _throttle(readings):
+        """
+        Checks readings against the rate limits, with one throttle() per
+        owner for all their readings.
+
+        Returns:
+            The error messages of the owners whose readings are rejected.
+        """
+        by_owner = {}
+        for owner_id, rate_limit, measurement in readings:
+            counts = by_owner.setdefault(owner_id, {})
+            _, count = counts.get(measurement.sensor_id, (rate_limit, 0))
+            counts[measurement.sensor_id] = (rate_limit, count + 1)
+        refused = {}
+        for owner_id, counts in by_owner.items():
+            try:
+                throttle(owner_id, counts)
+            except Throttled as error:
+                refused[owner_id] = str(error.detail)
+        return refused
+
+    async def flush(self):
+        """
+        Writes the pending readings with batched inserts.
+        """
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                unwritten, unknown = await asyncio.to_thread(self._write, batch)
+            except TRANSIENT_ERRORS:
+                logger.exception("Failed to write %d readings.", len(batch))
+                unwritten, unknown = batch, set()
+            for sensor_id in unknown:
+                self._keys.pop(sensor_id, None)
+            if unwritten:
+                # Retried with the next flush, e.g. once a move is done.
+                self._pending[:0] = unwritten
+                excess = len(self._pending) - self.max_pending
+                if excess > 0:
+                    del self._pending[:excess]
+                    dropped_readings.inc(excess, reason="backlog")
+                    logger.error(
+                        "Dropped the %d oldest readings waiting to be written.",
+                        excess,
+                    )
+
+    def _write(self, batch):
+        """
+        Writes a batch of readings of known sensors, shard by shard.
+
+        Returns:
+            The readings to retry and the IDs of the unknown sensors.
+
+        Raises:
+            TenantMoving: if an owner is being moved; nothing is written.
+        """
+        close_old_connections()
+        sensor_ids = {measurement.sensor_id for measurement in batch}
+        known = set()
+        for queryset in fan_out(
+            Sensor.objects.filter(id__in=sensor_ids).values_list("id", flat=True)
+        ):
+            known.update(queryset)
+        unknown = sensor_ids - known
+        if unknown:
+            written = [m for m in batch if m.sensor_id in known]
+            dropped_readings.inc(len(batch) - len(written), reason="unknown_sensor")
+            logger.warning("Dropped the readings of deleted sensors %s.", unknown)
+            batch = written
+        unwritten = []
+        for group in group_by_shard(batch).values():
+            try:
+                self._write_isolating(group)
+            except TRANSIENT_ERRORS:
+                logger.exception("Failed to write %d readings.", len(group))
+                unwritten += group
+        return unwritten, unknown
+
+    def _write_isolating(self, batch):
+        """
+        Writes readings of one shard, halving a failing batch until the
+        readings failing on their own are found and dropped.
+        """
+        try:
+            write_measurements(batch)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception:
+            if len(batch) == 1:
+                dropped_readings.inc(reason="error")
+                logger.exception(
+                    "Dropped a reading of sensor %s that cannot be written.",
+                    batch[0].sensor_id,
+                )
+                return
+            middle = len(batch) // 2
+            self._write_isolating(batch[:middle])
+            self._write_isolating(batch[middle:])
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def handle_tcp(self, reader, writer):
+        session = Session()
+        number, rest = 0, b""
+        try:
+            while True:
+                data = await reader.read(LINE_LIMIT)
+                *lines, rest = (rest + data).split(b"\n")
+                if not data and rest:
+                    # The last line of the connection may lack its newline.
+                    lines.append(rest)
+                errors = await self.process_lines(
+                    session,
+                    [line.decode(errors="replace") for line in lines],
+                    start=number + 1,
+                )
+                number += len(lines)
+                if len(rest) >= LINE_LIMIT:
+                    # The rest of the line cannot be told from the next one.
+                    rejected_lines.inc()
+                    errors.append(f"ERR {number + 1} Line too long.")
+                if errors:
+                    writer.write("".join(f"{error}\n" for error in errors).encode())
+                    await writer.drain()
+                if not data or len(rest) >= LINE_LIMIT:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, tcp_port=None, udp_port=None, ready=None):
+        """
+        Runs the TCP and/or UDP listeners until cancelled.
+
+        Args:
+            host: Address to bind to.
+            tcp_port: TCP port, or None to disable TCP.
+            udp_port: UDP port, or None to disable UDP.
+            ready: Optional asyncio.Event set once the sockets are bound
+                (to the `addresses`).
+        """
+        loop = asyncio.get_running_loop()
+        servers = []
+        if tcp_port is not None:
+            server = await asyncio.start_server(self.handle_tcp, host, tcp_port)
+            self.addresses["tcp"] = server.sockets[0].getsockname()[:2]
+            servers.append(server)
+        if udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), local_addr=(host, udp_port)
+            )
+            self.addresses["udp"] = transport.get_extra_info("sockname")[:2]
+            servers.append(transport)
+        if ready is not None:
+            ready.set()
+        try:
+            await self._flush_periodically()
+        finally:
+            for server in servers:
+                server.close()
+            await self.flush()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Treats every UDP datagram as an independent session.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.tasks = set()
+
+    def datagram_received(self, data, addr):
+        task = asyncio.ensure_future(
+            self.server.process_text(Session(), data.decode(errors="replace"))
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
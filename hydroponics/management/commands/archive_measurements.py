@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from hydroponics.archive import (archive_lock, archive_sensor,
+                                 compact_manifest, month_start)
+from hydroponics.models import Sensor
+from hydroponics.sharding import on_shard, shard_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves old measurements from the database into the cold-storage "
+        "archive (HYDROPONICS_ARCHIVE_DIR), one file per sensor and month."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-months",
+            type=int,
+            default=getattr(settings, "HYDROPONICS_ARCHIVE_AFTER_MONTHS", 12),
+            help="Archive the months completed more than this many months ago.",
+        )
+
+    def handle(self, *args, **options):
+        current = month_start(timezone.now())
+        months = current.year * 12 + current.month - 1 - options["older_than_months"]
+        before = current.replace(year=months // 12, month=months % 12 + 1)
+        archived, sensor_ids = 0, []
+        with archive_lock():
+            for alias in shard_aliases():
+                with on_shard(alias):
+                    for sensor_id in list(Sensor.objects.values_list("id", flat=True)):
+                        archived += archive_sensor(sensor_id, before)
+                    sensor_ids += Sensor.all_objects.values_list("id", flat=True)
+            # Drops the segments of purged sensors and superseded files.
+            compact_manifest(sensor_ids)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Archived {archived} measurements taken before "
+                f"{before.isoformat()}."
+            )
+        )
@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from hydroponics.chunks import chunked_storage_enabled, compact_sensor, period_start
+from hydroponics.models import Sensor
+from hydroponics.sharding import on_shard, shard_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        "Seals old measurements into compressed chunks, one per sensor and "
+        "period (HYDROPONICS_CHUNKED_STORAGE must be enabled)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days",
+            type=int,
+            default=getattr(settings, "HYDROPONICS_CHUNK_AFTER_DAYS", 30),
+            help="Seal the complete periods older than this many days.",
+        )
+
+    def handle(self, *args, **options):
+        if not chunked_storage_enabled():
+            raise CommandError(
+                "Chunked storage is disabled (HYDROPONICS_CHUNKED_STORAGE)."
+            )
+        before = period_start(
+            timezone.now() - timedelta(days=options["older_than_days"])
+        )
+        sealed = 0
+        for alias in shard_aliases():
+            with on_shard(alias):
+                for sensor_id in list(Sensor.objects.values_list("id", flat=True)):
+                    sealed += compact_sensor(sensor_id, before)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Sealed {sealed} measurements taken before {before.isoformat()}."
+            )
+        )
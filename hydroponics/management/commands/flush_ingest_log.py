@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from hydroponics.ingest import IngestionLog, flush_log
+from hydroponics.models import IngestedSegment
+from hydroponics.sharding import on_shard, shard_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays write-behind ingestion log segments left by stopped or "
+        "crashed processes into the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prune-days",
+            type=int,
+            default=7,
+            help="Delete replay markers of segments ingested this many days ago.",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Replay the segments quarantined after repeated failures as well.",
+        )
+
+    def handle(self, *args, **options):
+        log = IngestionLog(settings.HYDROPONICS_INGEST_LOG_DIR)
+        log.recover_orphans()
+        if options["retry_failed"]:
+            log.retry_failed()
+        written = flush_log(log)
+
+        cutoff = timezone.now() - timedelta(days=options["prune_days"])
+        pruned = 0
+        for alias in shard_aliases():
+            with on_shard(alias):
+                deleted, _ = IngestedSegment.objects.filter(
+                    created_at__lt=cutoff
+                ).delete()
+            pruned += deleted
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Replayed {written} measurements, pruned {pruned} segment markers."
+            )
+        )
+        failed = log.failed_segments()
+        if failed:
+            self.stderr.write(
+                f"{failed} segments are quarantined in {log.directory}, see the "
+                "log for their errors and replay them with --retry-failed."
+            )
@@ -0,0 +1,37 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hydroponics.schema import generate_schema, schema_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the OpenAPI document of the API to the static schema file "
+        "served by /api/schema.json, or checks that the file is up to date."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            type=Path,
+            help="Path of the schema file (HYDROPONICS_OPENAPI_SCHEMA by default).",
+        )
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Fail if the schema file differs from the generated document.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["output"] or schema_path()
+        content = generate_schema()
+        if options["check"]:
+            if not path.exists() or path.read_bytes() != content:
+                raise CommandError(
+                    f"{path} is out of date; run `manage.py generate_schema`."
+                )
+            self.stdout.write(self.style.SUCCESS(f"{path} is up to date."))
+            return
+        path.write_bytes(content)
+        self.stdout.write(self.style.SUCCESS(f"Written the OpenAPI schema to {path}."))
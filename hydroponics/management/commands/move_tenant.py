@@ -0,0 +1,179 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max, Min, Q, Sum
+
+from hydroponics.models import (AlertEvent, AlertRule, HydroponicSystem,
+                                Measurement, MeasurementChunk,
+                                MeasurementRollup, Sensor, SensorState,
+                                TenantShard, Tombstone)
+from hydroponics.routers import invalidate_placement, placement
+from hydroponics.sharding import is_sharded, shard_aliases
+
+# Tenant models in foreign key order, with the lookup selecting an owner's rows.
+TENANT_TABLES = [
+    (HydroponicSystem, "owner_id"),
+    (Sensor, "system__owner_id"),
+    (AlertRule, "owner_id"),
+    (SensorState, "sensor__system__owner_id"),
+    (MeasurementRollup, "sensor__system__owner_id"),
+    (Measurement, "sensor__system__owner_id"),
+    (MeasurementChunk, "sensor__system__owner_id"),
+    (AlertEvent, "rule__owner_id"),
+    (Tombstone, "owner_id"),
+]
+
+# Aggregates compared per chunk to find the rows of large tables that
+# changed since the last pass. Chunks of the other tables are always copied.
+SIGNATURES = {
+    MeasurementRollup: {"total": Sum("total"), "count": Sum("count")},
+    Measurement: {
+        "values": Sum("value"),
+        "earliest": Min("measured_at"),
+        "latest": Max("measured_at"),
+        "changed": Max("changed_at"),
+    },
+    MeasurementChunk: {"readings": Sum("count"), "latest": Max("end")},
+    AlertEvent: {},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the systems, sensors and measurements of one owner to another "
+        "shard while the service keeps running. Writes of the owner are "
+        "rejected only during the final catch-up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("owner_id", type=int, help="ID of the owner to move.")
+        parser.add_argument("shard", help="Alias of the target shard.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of rows compared and copied per chunk.",
+        )
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("Sharding is not configured (DATABASE_SHARD_HOSTS).")
+        owner_id, target = options["owner_id"], options["shard"]
+        if target not in shard_aliases():
+            raise CommandError(f"Unknown shard {target!r}.")
+        self.batch_size = options["batch_size"]
+
+        invalidate_placement(owner_id)
+        source = placement(owner_id).shard
+        if source == target:
+            self.stdout.write(f"Owner {owner_id} is already on {target}.")
+            return
+
+        self.stdout.write(f"Copying owner {owner_id} from {source} to {target}.")
+        self.sync(owner_id, source, target)
+        # A second pass while writes continue keeps the frozen pass short.
+        self.sync(owner_id, source, target)
+
+        self.stdout.write("Freezing writes and catching up.")
+        self.set_placement(owner_id, source, frozen=True)
+        try:
+            self.sync(owner_id, source, target)
+        except BaseException:
+            self.set_placement(owner_id, source, frozen=False)
+            raise
+        self.set_placement(owner_id, target, frozen=False)
+
+        self.stdout.write(f"Deleting the copied data from {source}.")
+        self.delete(owner_id, source)
+        self.stdout.write(
+            self.style.SUCCESS(f"Moved owner {owner_id} from {source} to {target}.")
+        )
+
+    def set_placement(self, owner_id, shard, frozen):
+        """
+        Updates the shard map and waits until every process has seen it.
+        """
+        TenantShard.objects.update_or_create(
+            owner_id=owner_id, defaults={"shard": shard, "is_frozen": frozen}
+        )
+        invalidate_placement(owner_id)
+        time.sleep(getattr(settings, "HYDROPONICS_SHARD_MAP_CACHE_TTL", 5) + 1)
+
+    def scoped(self, model, lookup, owner_id, alias):
+        return (
+            model._base_manager.using(alias).filter(**{lookup: owner_id}).order_by("pk")
+        )
+
+    def sync(self, owner_id, source, target):
+        """
+        Makes the owner's rows on the target equal to those on the source,
+        chunk by chunk in primary key order.
+        """
+        for model, lookup in TENANT_TABLES:
+            source_rows = self.scoped(model, lookup, owner_id, source)
+            target_rows = self.scoped(model, lookup, owner_id, target)
+            last = None
+            while True:
+                bounds = Q() if last is None else Q(pk__gt=last)
+                pks = list(
+                    source_rows.filter(bounds).values_list("pk", flat=True)[
+                        : self.batch_size
+                    ]
+                )
+                done = len(pks) < self.batch_size
+                if not done:
+                    bounds &= Q(pk__lte=pks[-1])
+
+                source_chunk = source_rows.filter(bounds)
+                target_chunk = target_rows.filter(bounds)
+                stale = set(target_chunk.values_list("pk", flat=True)) - set(pks)
+                if stale:
+                    model._base_manager.using(target).filter(pk__in=stale).delete()
+                if pks and self.differs(model, source_chunk, target_chunk):
+                    self.upsert(model, list(source_chunk), target)
+                if done:
+                    break
+                last = pks[-1]
+
+    def differs(self, model, source_chunk, target_chunk):
+        signature = SIGNATURES.get(model)
+        if signature is None:
+            return True
+        aggregates = {"rows": Count("pk"), **signature}
+        return source_chunk.aggregate(**aggregates) != target_chunk.aggregate(
+            **aggregates
+        )
+
+    def upsert(self, model, rows, target):
+        # bulk_create() overwrites auto_now(_add) fields; they are restored after.
+        automatic = [
+            field
+            for field in model._meta.concrete_fields
+            if getattr(field, "auto_now", False)
+            or getattr(field, "auto_now_add", False)
+        ]
+        values = [[getattr(row, field.attname) for field in automatic] for row in rows]
+        model.objects.using(target).bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=[model._meta.pk.name],
+            update_fields=[
+                field.name
+                for field in model._meta.concrete_fields
+                if not field.primary_key
+            ],
+        )
+        if automatic:
+            for row, saved in zip(rows, values):
+                for field, value in zip(automatic, saved):
+                    setattr(row, field.attname, value)
+            model.objects.using(target).bulk_update(
+                rows, [field.name for field in automatic]
+            )
+
+    def delete(self, owner_id, source):
+        for model, lookup in reversed(TENANT_TABLES):
+            rows = self.scoped(model, lookup, owner_id, source)
+            while pks := list(rows.values_list("pk", flat=True)[: self.batch_size]):
+                model._base_manager.using(source).filter(pk__in=pks).delete()
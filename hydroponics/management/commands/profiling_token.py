@@ -0,0 +1,23 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from hydroponics.profiling import profiling_token
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints a token that enables profiling of the API requests sending "
+        "it in the X-Profile header (see hydroponics.profiling)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="A staff user.")
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options["username"])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"Unknown user {options['username']!r}.")
+        if not (user.is_staff and user.is_active):
+            raise CommandError(f"User {user.username!r} is not active staff.")
+        self.stdout.write(profiling_token(user))
@@ -0,0 +1,54 @@
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from hydroponics.provisioning import provision
+from hydroponics.serializers import ProvisioningSerializer
+from hydroponics.sharding import tenant
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates systems and their sensors for a user from a JSON document "
+        '({"systems": [{"name": ..., "sensors": [{"name": ..., '
+        '"sensor_type": ...}]}]}), in one transaction.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="Owner of the systems.")
+        parser.add_argument(
+            "document", help="Path of the JSON document, or - for standard input."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            owner = get_user_model().objects.get(username=options["username"])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"Unknown user {options['username']!r}.")
+        try:
+            if options["document"] == "-":
+                document = json.load(sys.stdin)
+            else:
+                with open(options["document"]) as file:
+                    document = json.load(file)
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Cannot read the document: {error}")
+
+        with tenant(owner.pk):
+            serializer = ProvisioningSerializer(
+                data=document, context={"owner_id": owner.pk}
+            )
+            if not serializer.is_valid():
+                raise CommandError(json.dumps(serializer.errors))
+            systems = provision(owner.pk, serializer.validated_data["systems"])
+
+        # The IDs go to stdout and the summary to stderr, for piping.
+        self.stdout.write(json.dumps(systems))
+        self.stderr.write(
+            self.style.SUCCESS(
+                f"Provisioned {len(systems)} systems with "
+                f"{sum(len(system['sensors']) for system in systems)} sensors."
+            )
+        )
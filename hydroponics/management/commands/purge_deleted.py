@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from hydroponics.deletion import purge_pending_deletions
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the systems and sensors marked for deletion, removing their "
+        "measurements in time slices."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--slice-hours",
+            type=int,
+            default=24,
+            help="Hours of measurements deleted per statement.",
+        )
+
+    def handle(self, *args, **options):
+        systems, sensors, measurements = purge_pending_deletions(
+            timedelta(hours=options["slice_hours"])
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {systems} systems, {sensors} sensors and "
+                f"{measurements} measurements."
+            )
+        )
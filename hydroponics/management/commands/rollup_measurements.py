@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from hydroponics.models import Measurement, MeasurementRollup
+from hydroponics.sharding import on_shard, shard_aliases
+from hydroponics.stats import ROLLUP_INTERVAL, build_rollups, floor_hour
+
+
+class Command(BaseCommand):
+    help = "Builds hourly measurement rollups used by long-window statistics."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours",
+            type=int,
+            help="Recompute the given number of most recent complete hours.",
+        )
+        parser.add_argument(
+            "--chunk-hours",
+            type=int,
+            default=24,
+            help="Number of hours processed per pass.",
+        )
+
+    def handle(self, *args, **options):
+        written = 0
+        for alias in shard_aliases():
+            with on_shard(alias):
+                written += self.roll_up(options)
+        self.stdout.write(self.style.SUCCESS(f"Written {written} hourly rollups."))
+
+    def roll_up(self, options):
+        end = floor_hour(timezone.now())
+
+        if options["hours"]:
+            start = end - timedelta(hours=options["hours"])
+        else:
+            last = MeasurementRollup.objects.aggregate(last=Max("bucket"))["last"]
+            if last is not None:
+                # The last hours are recomputed to pick up backdated rows.
+                lookback = getattr(settings, "HYDROPONICS_ROLLUP_LOOKBACK_HOURS", 48)
+                start = min(last, end - timedelta(hours=lookback))
+            else:
+                first = Measurement.objects.aggregate(first=Min("measured_at"))["first"]
+                if first is None:
+                    return 0
+                start = floor_hour(first)
+
+        step = ROLLUP_INTERVAL * options["chunk_hours"]
+        written = 0
+        while start < end:
+            written += build_rollups(start, min(start + step, end))
+            start += step
+        return written
@@ -0,0 +1,55 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from hydroponics.jobs import work, worker_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs background jobs from the job table with a pool of worker "
+        "threads. Any number of these processes may run side by side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=2, help="Number of worker threads."
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds an idle worker waits before looking for jobs again.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once no job is runnable instead of polling forever.",
+        )
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+
+        threads = [
+            threading.Thread(
+                target=work,
+                args=(worker_name(index), stop),
+                kwargs={
+                    "poll_interval": options["poll_interval"],
+                    "exit_when_idle": options["once"],
+                },
+                name=f"job-worker-{index}",
+            )
+            for index in range(options["workers"])
+        ]
+        self.stdout.write(f"Running jobs with {len(threads)} workers.")
+        for thread in threads:
+            thread.start()
+        # Running jobs are finished before exiting; signals stop new claims.
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=0.5)
+        self.stdout.write(self.style.SUCCESS("Stopped."))
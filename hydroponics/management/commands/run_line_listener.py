@@ -0,0 +1,55 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from hydroponics.line_protocol import LineProtocolServer
+from hydroponics.metrics import registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the line-protocol ingestion listener "
+        "('<sensor_id> <value> [<timestamp>]' over TCP and UDP)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--tcp-port", type=int, default=8089)
+        parser.add_argument("--udp-port", type=int, default=8089)
+        parser.add_argument("--no-tcp", action="store_true")
+        parser.add_argument("--no-udp", action="store_true")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of pending readings that triggers a database write.",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=0.2,
+            help="Maximum delay in seconds before pending readings are written.",
+        )
+
+    def handle(self, *args, **options):
+        server = LineProtocolServer(
+            batch_size=options["batch_size"],
+            flush_interval=options["flush_interval"],
+        )
+        tcp_port = None if options["no_tcp"] else options["tcp_port"]
+        udp_port = None if options["no_udp"] else options["udp_port"]
+        self.stdout.write(
+            f"Listening on {options['host']} (TCP: {tcp_port}, UDP: {udp_port})."
+        )
+        # Exposed by the /metrics/ endpoint of `manage.py serve` on this host.
+        registry.share(
+            settings.HYDROPONICS_METRICS_DIR,
+            getattr(settings, "HYDROPONICS_METRICS_WRITE_INTERVAL", 5),
+        )
+        try:
+            asyncio.run(server.serve(options["host"], tcp_port, udp_port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            registry.unshare()
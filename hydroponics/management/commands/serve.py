@@ -0,0 +1,124 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import get_internal_wsgi_application
+from gunicorn.app.base import BaseApplication
+
+from hydroponics.metrics import registry
+from hydroponics.server import has_shared_cache, startup_seconds
+
+
+class PreloadedApplication(BaseApplication):
+    """
+    Serves a WSGI application loaded in the gunicorn master process,
+    which its workers inherit when forked.
+
+    Attributes:
+        application: The WSGI application.
+        options: Gunicorn settings.
+    """
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return self.application
+
+
+def share_metrics(server, worker):
+    """
+    Shares the metrics of a forked worker with the other processes (see
+    hydroponics.metrics).
+    """
+    registry.share(
+        settings.HYDROPONICS_METRICS_DIR,
+        getattr(settings, "HYDROPONICS_METRICS_WRITE_INTERVAL", 5),
+    )
+
+
+def unshare_metrics(server, worker):
+    registry.unshare()
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the application in production: loads it once and forks a "
+        "pool of gunicorn worker processes, recycled after a number of "
+        "requests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bind",
+            default=getattr(settings, "HYDROPONICS_SERVER_BIND", "0.0.0.0:8000"),
+            help="Address (host:port or unix:path) to listen on.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=getattr(settings, "HYDROPONICS_SERVER_WORKERS", 3),
+            help="Number of worker processes.",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=getattr(settings, "HYDROPONICS_SERVER_THREADS", 1),
+            help="Number of request threads per worker.",
+        )
+        parser.add_argument(
+            "--max-requests",
+            type=int,
+            default=getattr(settings, "HYDROPONICS_SERVER_MAX_REQUESTS", 10000),
+            help="Requests after which a worker is replaced (0 disables).",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] > 1 and not has_shared_cache():
+            # Token revocations, read-your-writes pins and rate limits
+            # would only hold within each worker.
+            raise CommandError(
+                "Several workers need a shared cache: set REDIS_URL, or "
+                "start a single worker with --workers 1."
+            )
+        if not Path(settings.STATIC_ROOT).is_dir():
+            raise CommandError(
+                f"No static files in {settings.STATIC_ROOT}; run "
+                "`manage.py collectstatic` first."
+            )
+        # Snapshots left by the workers of a previous run.
+        metrics_dir = Path(settings.HYDROPONICS_METRICS_DIR)
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        for path in metrics_dir.glob("*.json"):
+            path.unlink()
+        # Imports WSGI_APPLICATION, which warms the application up.
+        application = get_internal_wsgi_application()
+        self.stdout.write(
+            f"Application loaded in {startup_seconds.value():.3f} s; starting "
+            f"{options['workers']} workers on {options['bind']}."
+        )
+        PreloadedApplication(
+            application,
+            {
+                "bind": options["bind"],
+                "workers": options["workers"],
+                "threads": options["threads"],
+                "max_requests": options["max_requests"],
+                "max_requests_jitter": options["max_requests"] // 10,
+                "timeout": getattr(settings, "HYDROPONICS_SERVER_TIMEOUT", 30),
+                "graceful_timeout": getattr(
+                    settings, "HYDROPONICS_SERVER_GRACEFUL_TIMEOUT", 30
+                ),
+                "preload_app": True,
+                "proc_name": "hydroponics",
+                "accesslog": "-",
+                "post_fork": share_metrics,
+                "worker_exit": unshare_metrics,
+            },
+        ).run()
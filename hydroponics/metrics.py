@@ -0,0 +1,336 @@
+import fcntl
+import json
+import os
+import threading
+from pathlib import Path
+
+"""
+A minimal in-process metrics registry rendered in the Prometheus text
+format.
+
+Values are kept per process. Processes serving the same /metrics/
+endpoint, the workers of `manage.py serve`, share them through a
+directory (see Registry.share): each writes a snapshot of its metrics
+there every few seconds and on exit, and a scrape merges the snapshots
+of all of them. Counters and summaries are summed, including those of
+exited workers, so they keep growing when workers are replaced; gauges
+describe live processes and get a `pid` label.
+"""
+
+# Snapshot holding the counters and summaries of exited processes.
+EXITED = "exited.json"
+LOCK = ".lock"
+
+
+class Metric:
+    """
+    Base class of registered metrics.
+
+    Attributes:
+        name: The metric name.
+        help: The description shown in the exposition.
+        kind: The Prometheus metric type.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def samples(self):
+        raise NotImplementedError
+
+    def families(self):
+        """
+        Returns the metric families exposed for the metric as tuples of
+        name, help, kind and samples (suffix, labels, value).
+        """
+        return [(self.name, self.help, self.kind, self.samples())]
+
+    def render(self):
+        return "\n".join(render_family(*family) for family in self.families())
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing value, optionally split by labels, either
+    incremented directly or read from a callback at exposition time
+    (returning a dict of values by label tuples, like Gauge's).
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self._values = {}
+        self._function = function
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.items()), 0)
+
+    def samples(self):
+        values = self._function() if self._function else self._values
+        return [("", labels, value) for labels, value in list(values.items())]
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, either set directly or read
+    from a callback at exposition time. A callback may return a dict
+    mapping label tuples, e.g. (("database", "default"),), to values.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self._value = 0
+        self._function = function
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self):
+        return self._function() if self._function else self._value
+
+    def samples(self):
+        value = self.value()
+        if isinstance(value, dict):
+            return [("", labels, item) for labels, item in value.items()]
+        return [("", (), value)]
+
+
+class Summary(Metric):
+    """
+    Count and sum of observed values (e.g. latencies), with their
+    maximum exposed as the gauge <name>_max.
+    """
+
+    kind = "summary"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def samples(self):
+        return [("_count", (), self.count), ("_sum", (), self.total)]
+
+    def families(self):
+        return super().families() + [
+            (
+                f"{self.name}_max",
+                f"Largest value of {self.name} observed by the process.",
+                "gauge",
+                [("", (), self.max)],
+            )
+        ]
+
+
+def render_family(name, help, kind, samples):
+    """
+    Returns the exposition of a metric family.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        label_text = ""
+        if labels:
+            pairs = ",".join(f'{key}="{val}"' for key, val in sorted(labels))
+            label_text = "{" + pairs + "}"
+        lines.append(f"{name}{suffix}{label_text} {value}")
+    return "\n".join(lines)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read(path):
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return []
+
+
+def _write(path, families):
+    partial = path.with_name(f"{path.name}.{threading.get_ident()}.partial")
+    partial.write_text(json.dumps(families))
+    os.replace(partial, path)
+
+
+def _merge(merged, families, pid=None):
+    """
+    Adds the families of a snapshot to merged, a dict of families by
+    name with their samples by (suffix, labels). Gauges of a process
+    are labelled with its pid, or skipped without one.
+    """
+    for name, help, kind, samples in families:
+        if kind == "gauge" and pid is None:
+            continue
+        family = merged.setdefault(name, (help, kind, {}))[2]
+        for suffix, labels, value in samples:
+            labels = tuple(tuple(pair) for pair in labels)
+            if kind == "gauge":
+                family[(suffix, labels + (("pid", pid),))] = value
+            else:
+                key = (suffix, labels)
+                family[key] = family.get(key, 0) + value
+
+
+def _unmerge(merged):
+    return [
+        (
+            name,
+            help,
+            kind,
+            [(suffix, labels, value) for (suffix, labels), value in samples.items()],
+        )
+        for name, (help, kind, samples) in merged.items()
+    ]
+
+
+def collect(directory):
+    """
+    Merges the snapshots of the processes sharing a directory, folding
+    those of exited processes into a single snapshot.
+
+    Returns:
+        The merged metric families.
+    """
+    directory = Path(directory)
+    with open(directory / LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            exited = {}
+            _merge(exited, _read(directory / EXITED))
+            merged, gone = {}, []
+            for path in sorted(directory.glob("*.json")):
+                if not path.stem.isdigit():
+                    continue
+                pid = int(path.stem)
+                if _is_running(pid):
+                    _merge(merged, _read(path), pid)
+                else:
+                    _merge(exited, _read(path))
+                    gone.append(path)
+            if gone:
+                _write(directory / EXITED, _unmerge(exited))
+                for path in gone:
+                    path.unlink()
+            for name, (help, kind, samples) in exited.items():
+                family = merged.setdefault(name, (help, kind, {}))[2]
+                for key, value in samples.items():
+                    family[key] = family.get(key, 0) + value
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return _unmerge(merged)
+
+
+class Registry:
+    """
+    Holds metrics by name and renders them for scraping.
+
+    Attributes:
+        directory: The directory the metrics are shared through, or None.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.directory = None
+        self._stop = threading.Event()
+
+    def _register(self, cls, name, help, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help, function=None):
+        return self._register(Counter, name, help, function=function)
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge, name, help, function=function)
+
+    def summary(self, name, help):
+        return self._register(Summary, name, help)
+
+    def families(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [family for metric in metrics for family in metric.families()]
+
+    def share(self, directory, interval=5):
+        """
+        Shares the metrics of the current process through a directory,
+        writing them there every interval seconds from a background
+        thread.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._stop = threading.Event()
+        self.write()
+        threading.Thread(
+            target=self._write_every, args=(interval, self._stop), daemon=True
+        ).start()
+
+    def unshare(self):
+        """
+        Stops sharing the metrics after writing them a last time, e.g.
+        when the process exits.
+        """
+        if self.directory is not None:
+            self._stop.set()
+            self.write()
+            self.directory = None
+
+    def write(self):
+        """
+        Writes the snapshot of the current process to the shared directory.
+        """
+        _write(self.directory / f"{os.getpid()}.json", self.families())
+
+    def _write_every(self, interval, stop):
+        while not stop.wait(interval):
+            self.write()
+
+    def render(self):
+        if self.directory is None:
+            families = self.families()
+        else:
+            self.write()
+            families = collect(self.directory)
+        return "\n".join(render_family(*family) for family in families) + "\n"
+
+
+registry = Registry()
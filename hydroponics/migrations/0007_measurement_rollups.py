@@ -0,0 +1,44 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hydroponics', '0006_alter_sensor_sensor_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeasurementRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('total', models.FloatField()),
+                ('total_sq', models.FloatField()),
+                ('min_value', models.FloatField()),
+                ('max_value', models.FloatField()),
+                ('sketch', models.JSONField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='measurement',
+            index=models.Index(fields=['sensor', 'measured_at'], name='measurement_sensor_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='measurementrollup',
+            name='sensor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='hydroponics.sensor'),
+        ),
+        migrations.AddIndex(
+            model_name='measurementrollup',
+            index=models.Index(fields=['bucket'], name='rollup_bucket_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='measurementrollup',
+            constraint=models.UniqueConstraint(fields=('sensor', 'bucket'), name='unique_rollup_sensor_bucket'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hydroponics', '0007_measurement_rollups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorState',
+            fields=[
+                ('sensor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state', serialize=False, to='hydroponics.sensor')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('mean', models.FloatField(default=0.0)),
+                ('m2', models.FloatField(default=0.0)),
+                ('last_value', models.FloatField(blank=True, null=True)),
+                ('last_measured_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AlertRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('sensor_type', models.CharField(blank=True, choices=[('PH', 'pH'), ('TEMP', 'Temperature'), ('TDS', 'TDS')], max_length=10)),
+                ('kind', models.CharField(choices=[('THRESHOLD', 'Threshold'), ('RATE', 'Rate of change'), ('ZSCORE', 'Z-score')], max_length=10)),
+                ('min_value', models.FloatField(blank=True, null=True)),
+                ('max_value', models.FloatField(blank=True, null=True)),
+                ('max_rate', models.FloatField(blank=True, null=True)),
+                ('z_threshold', models.FloatField(blank=True, null=True)),
+                ('min_samples', models.PositiveIntegerField(default=30)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to=settings.AUTH_USER_MODEL)),
+                ('sensor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to='hydroponics.sensor')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AlertEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.FloatField()),
+                ('measured_at', models.DateTimeField()),
+                ('message', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sensor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_events', to='hydroponics.sensor')),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='hydroponics.alertrule')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sensor', 'measured_at'], name='alertevent_sensor_time_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:28
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hydroponics', '0008_alert_rules'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('rows', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='measurement',
+            name='measured_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hydroponics', '0009_write_behind_ingestion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensor',
+            name='api_key_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
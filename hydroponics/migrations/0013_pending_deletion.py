@@ -0,0 +1,98 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:47
+
+import hydroponics.db
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0012_tenant_shard"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="hydroponicsystem",
+            name="deletion_requested_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="sensor",
+            name="deletion_requested_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name="alertevent",
+            name="rule",
+            field=models.ForeignKey(
+                on_delete=hydroponics.db.DB_CASCADE,
+                related_name="events",
+                to="hydroponics.alertrule",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="alertevent",
+            name="sensor",
+            field=models.ForeignKey(
+                on_delete=hydroponics.db.DB_CASCADE,
+                related_name="alert_events",
+                to="hydroponics.sensor",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="alertrule",
+            name="sensor",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=hydroponics.db.DB_CASCADE,
+                related_name="alert_rules",
+                to="hydroponics.sensor",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="measurement",
+            name="sensor",
+            field=models.ForeignKey(
+                on_delete=hydroponics.db.DB_CASCADE,
+                related_name="measurements",
+                to="hydroponics.sensor",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="measurementrollup",
+            name="sensor",
+            field=models.ForeignKey(
+                on_delete=hydroponics.db.DB_CASCADE,
+                related_name="rollups",
+                to="hydroponics.sensor",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="sensor",
+            name="system",
+            field=models.ForeignKey(
+                on_delete=hydroponics.db.DB_CASCADE,
+                related_name="sensors",
+                to="hydroponics.hydroponicsystem",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="sensorstate",
+            name="sensor",
+            field=models.OneToOneField(
+                on_delete=hydroponics.db.DB_CASCADE,
+                primary_key=True,
+                related_name="state",
+                serialize=False,
+                to="hydroponics.sensor",
+            ),
+        ),
+        hydroponics.db.DatabaseCascade("sensor", "system"),
+        hydroponics.db.DatabaseCascade("measurement", "sensor"),
+        hydroponics.db.DatabaseCascade("measurementrollup", "sensor"),
+        hydroponics.db.DatabaseCascade("sensorstate", "sensor"),
+        hydroponics.db.DatabaseCascade("alertrule", "sensor"),
+        hydroponics.db.DatabaseCascade("alertevent", "rule"),
+        hydroponics.db.DatabaseCascade("alertevent", "sensor"),
+    ]
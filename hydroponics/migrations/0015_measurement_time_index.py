@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0014_jobs"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="measurement",
+            index=models.Index(fields=["measured_at"], name="measurement_time_idx"),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.1.6 on 2026-10-19 18:59
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0015_measurement_time_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Tombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("system", "System"),
+                            ("sensor", "Sensor"),
+                            ("measurement", "Measurement"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("object_id", models.BigIntegerField()),
+                ("deleted_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="hydroponicsystem",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="sensor",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="hydroponicsystem",
+            index=models.Index(
+                fields=["owner", "updated_at"], name="system_owner_updated_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="measurement",
+            index=models.Index(
+                fields=["sensor", "id"], name="measurement_sensor_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sensor",
+            index=models.Index(
+                fields=["system", "updated_at"], name="sensor_system_updated_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="tombstone",
+            name="owner",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(
+                fields=["owner", "deleted_at"], name="tombstone_owner_deleted_idx"
+            ),
+        ),
+    ]
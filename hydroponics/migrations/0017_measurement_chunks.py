@@ -0,0 +1,51 @@
+# Generated by Django 5.1.6 on 2026-10-19 19:08
+
+import hydroponics.db
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0016_sync_tracking"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MeasurementChunk",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start", models.DateTimeField()),
+                ("end", models.DateTimeField()),
+                ("count", models.PositiveIntegerField()),
+                ("min_value", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("max_value", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("data", models.BinaryField()),
+                (
+                    "sensor",
+                    models.ForeignKey(
+                        on_delete=hydroponics.db.DB_CASCADE,
+                        related_name="chunks",
+                        to="hydroponics.sensor",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["start"], name="chunk_start_idx")],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("sensor", "start"), name="unique_chunk_sensor_start"
+                    )
+                ],
+            },
+        ),
+        hydroponics.db.DatabaseCascade("measurementchunk", "sensor"),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-19 19:18
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0017_measurement_chunks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="hydroponicsystem",
+            name="ingest_rate_limit",
+            field=models.PositiveIntegerField(
+                blank=True,
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+    ]
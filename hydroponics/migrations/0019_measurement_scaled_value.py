@@ -0,0 +1,20 @@
+# Generated by Django 5.1.6 on 2026-10-19 19:24
+
+import hydroponics.db
+import hydroponics.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0018_system_ingest_rate_limit"),
+    ]
+
+    operations = [
+        hydroponics.db.AlterScaledField(
+            model_name="measurement",
+            name="value",
+            field=hydroponics.fields.ScaledDecimalField(decimal_places=2, max_digits=9),
+        ),
+    ]
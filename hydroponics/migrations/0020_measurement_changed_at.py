@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-19 20:01
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def backfill_recent(apps, schema_editor):
+    # A full sync sends the measurements changed in the last
+    # HYDROPONICS_SYNC_INITIAL_DAYS; older ones never need a changed_at.
+    Measurement = apps.get_model("hydroponics", "Measurement")
+    days = getattr(settings, "HYDROPONICS_SYNC_INITIAL_DAYS", 7)
+    Measurement.objects.using(schema_editor.connection.alias).filter(
+        measured_at__gte=timezone.now() - timedelta(days=days)
+    ).update(changed_at=F("measured_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hydroponics", "0019_measurement_scaled_value"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="measurement",
+            name="measurement_sensor_id_idx",
+        ),
+        migrations.AddField(
+            model_name="measurement",
+            name="changed_at",
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        migrations.RunPython(backfill_recent, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="measurement",
+            index=models.Index(
+                fields=["sensor", "changed_at", "id"],
+                name="measurement_sensor_changed_idx",
+            ),
+        ),
+    ]
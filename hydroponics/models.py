@@ -1,5 +1,15 @@
+import hashlib
+import secrets
+
 from django.conf import settings
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MinValueValidator
+from django.db import models, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .db import DB_CASCADE
+from .fields import ScaledDecimalField
 
 """
 Definitions of the following models:HydroponicSystem, 
@@ -7,6 +17,23 @@ Sensor, and Measurement.
 """
 
 
+def hash_api_key(key):
+    """
+    Returns the hex SHA-256 digest under which a sensor API key is stored.
+    """
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class LiveManager(models.Manager):
+    """
+    Default manager hiding objects pending deletion, as selected by the
+    model's `live` condition. The `all_objects` manager includes them.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(self.model.live)
+
+
 class HydroponicSystem(models.Model):
     """
     Represents a hydroponic system.
@@ -16,6 +43,11 @@ class HydroponicSystem(models.Model):
         description: Optional description of the system.
         owner: The user who owns this system.
         created_at: The date and time when the system was created.
+        updated_at: The date and time when the system was last changed.
+        deletion_requested_at: When the system was marked for deletion;
+            its data is purged in the background.
+        ingest_rate_limit: Readings per minute accepted from each of its
+            sensors; HYDROPONICS_SENSOR_RATE_LIMIT when empty.
     """
 
     name = models.CharField(max_length=100)
@@ -24,8 +56,26 @@ class HydroponicSystem(models.Model):
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name="hydroponic_systems",
+        # Users stay on the default database when systems are sharded.
+        db_constraint=False,
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    deletion_requested_at = models.DateTimeField(
+        blank=True, null=True, editable=False
+    )
+    ingest_rate_limit = models.PositiveIntegerField(
+        blank=True, null=True, validators=[MinValueValidator(1)]
+    )
+
+    live = Q(deletion_requested_at__isnull=True)
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "updated_at"], name="system_owner_updated_idx"),
+        ]
 
     def __str__(self):
         """
@@ -33,6 +83,29 @@ class HydroponicSystem(models.Model):
         """
         return f"{self.id} – {self.name}"
 
+    def mark_for_deletion(self):
+        """
+        Hides the system and its sensors until purge_deleted removes them,
+        leaving tombstones for synchronizing clients.
+        """
+        now = timezone.now()
+        using = router.db_for_write(HydroponicSystem, instance=self)
+        with transaction.atomic(using=using):
+            sensors = Sensor.all_objects.using(using).filter(
+                system_id=self.id, deletion_requested_at__isnull=True
+            )
+            sensor_ids = list(sensors.values_list("id", flat=True))
+            sensors.update(deletion_requested_at=now)
+            self.deletion_requested_at = now
+            self.save(update_fields=["deletion_requested_at"])
+            Tombstone.objects.using(using).bulk_create(
+                [Tombstone(owner_id=self.owner_id, kind=Tombstone.SYSTEM, object_id=self.id)]
+                + [
+                    Tombstone(owner_id=self.owner_id, kind=Tombstone.SENSOR, object_id=id)
+                    for id in sensor_ids
+                ]
+            )
+
 
 class Sensor(models.Model):
     """
@@ -42,6 +115,10 @@ class Sensor(models.Model):
        system: The system to which the sensor belongs.
        sensor_type: The sensor type (PH, TEMP, or TDS).
        name: The name or label of the sensor.
+       api_key_hash: SHA-256 of the sensor's API key used by the
+           line-protocol listener (empty when no key was issued).
+       updated_at: The date and time when the sensor was last changed.
+       deletion_requested_at: When the sensor was marked for deletion.
     """
 
     SENSOR_TYPE_CHOICES = [
@@ -51,12 +128,26 @@ class Sensor(models.Model):
     ]
 
     system = models.ForeignKey(
-        HydroponicSystem, on_delete=models.CASCADE, related_name="sensors"
+        HydroponicSystem, on_delete=DB_CASCADE, related_name="sensors"
     )
     sensor_type = models.CharField(
         max_length=10, choices=SENSOR_TYPE_CHOICES, help_text="Choose sensor type."
     )
     name = models.CharField(max_length=100)
+    api_key_hash = models.CharField(max_length=64, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    deletion_requested_at = models.DateTimeField(
+        blank=True, null=True, editable=False
+    )
+
+    live = Q(deletion_requested_at__isnull=True)
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["system", "updated_at"], name="sensor_system_updated_idx"),
+        ]
 
     def __str__(self):
         """
@@ -64,6 +155,31 @@ class Sensor(models.Model):
         """
         return f"{self.id} – {self.name} ({self.get_sensor_type_display()})"
 
+    def issue_api_key(self):
+        """
+        Generates a new API key, stores its hash and returns the key.
+        The key itself is not stored and cannot be retrieved later.
+        """
+        key = secrets.token_urlsafe(24)
+        self.api_key_hash = hash_api_key(key)
+        self.save(update_fields=["api_key_hash"])
+        return key
+
+    def mark_for_deletion(self):
+        """
+        Hides the sensor until purge_deleted removes it, leaving a
+        tombstone for synchronizing clients.
+        """
+        using = router.db_for_write(Sensor, instance=self)
+        with transaction.atomic(using=using):
+            self.deletion_requested_at = timezone.now()
+            self.save(update_fields=["deletion_requested_at"])
+            Tombstone.objects.using(using).create(
+                owner_id=self.system.owner_id,
+                kind=Tombstone.SENSOR,
+                object_id=self.id,
+            )
+
 
 class Measurement(models.Model):
     """
@@ -73,17 +189,453 @@ class Measurement(models.Model):
         sensor: The sensor from which this measurement was taken.
         value: The measured value (e.g., pH, TDS, temperature).
         measured_at: The date and time the measurement was recorded.
+        changed_at: The date and time the measurement was last written,
+            None for measurements older than the sync tracking.
     """
 
     sensor = models.ForeignKey(
-        Sensor, on_delete=models.CASCADE, related_name="measurements"
+        Sensor, on_delete=DB_CASCADE, related_name="measurements"
     )
-    value = models.DecimalField(max_digits=10, decimal_places=2)
-    measured_at = models.DateTimeField(auto_now_add=True)
+    # Stored as hundredths in an integer column (max_digits keeps it in int4).
+    value = ScaledDecimalField(max_digits=9, decimal_places=2)
+    measured_at = models.DateTimeField(default=timezone.now)
+    changed_at = models.DateTimeField(auto_now=True, null=True)
+
+    # Rows of sensors pending deletion are only excluded where nothing
+    # else restricts the sensors to live ones (see Sensor.objects), e.g.
+    # the API querysets, to spare the join on the hot paths.
+    live = Q(sensor__deletion_requested_at__isnull=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["sensor", "measured_at"], name="measurement_sensor_time_idx"
+            ),
+            models.Index(fields=["measured_at"], name="measurement_time_idx"),
+            # Measurements written since a sync watermark, see hydroponics.sync.
+            models.Index(
+                fields=["sensor", "changed_at", "id"],
+                name="measurement_sensor_changed_idx",
+            ),
+        ]
 
     def __str__(self):
         """
-        Returns a representation combining the ID, the name and
+        Returns a representation combining the ID, the sensor name
+        (the sensor ID unless the sensor is already loaded) and
         time of measurement.
         """
-        return f"{self.id} - {self.sensor.name} - {self.measured_at}"
+        sensor_field = self._meta.get_field("sensor")
+        sensor = self.sensor.name if sensor_field.is_cached(self) else self.sensor_id
+        return f"{self.id} - {sensor} - {self.measured_at}"
+
+
+class MeasurementRollup(models.Model):
+    """
+    Hourly aggregate of the measurements of a single sensor.
+
+    Attributes:
+        sensor: The sensor the aggregate belongs to.
+        bucket: Start of the hour covered by the aggregate.
+        count: Number of measurements in the hour.
+        total: Sum of the measured values.
+        total_sq: Sum of the squared measured values.
+        min_value: The smallest measured value.
+        max_value: The largest measured value.
+        sketch: Serialized DDSketch of the values, used for percentiles.
+    """
+
+    sensor = models.ForeignKey(
+        Sensor, on_delete=DB_CASCADE, related_name="rollups"
+    )
+    bucket = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    total = models.FloatField()
+    total_sq = models.FloatField()
+    min_value = models.FloatField()
+    max_value = models.FloatField()
+    sketch = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sensor", "bucket"], name="unique_rollup_sensor_bucket"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["bucket"], name="rollup_bucket_idx"),
+        ]
+
+    def __str__(self):
+        """
+        Returns a representation combining the sensor ID and the hour.
+        """
+        return f"{self.sensor_id} - {self.bucket}"
+
+
+class MeasurementChunk(models.Model):
+    """
+    The sealed measurements of one sensor over one period, packed into a
+    compressed blob by compact_measurements (see hydroponics.chunks).
+
+    Attributes:
+        sensor: The sensor the measurements belong to.
+        start: Start of the period covered by the chunk.
+        end: End of the period (exclusive).
+        count: Number of measurements in the chunk.
+        min_value: The smallest measured value.
+        max_value: The largest measured value.
+        data: The encoded measurements.
+    """
+
+    sensor = models.ForeignKey(
+        Sensor, on_delete=DB_CASCADE, related_name="chunks"
+    )
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    min_value = models.DecimalField(max_digits=10, decimal_places=2)
+    max_value = models.DecimalField(max_digits=10, decimal_places=2)
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sensor", "start"], name="unique_chunk_sensor_start"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["start"], name="chunk_start_idx"),
+        ]
+
+    def __str__(self):
+        """
+        Returns a representation combining the sensor ID and the period.
+        """
+        return f"{self.sensor_id} - {self.start}"
+
+
+class AlertRule(models.Model):
+    """
+    Represents a user-defined alert rule evaluated as measurements arrive.
+
+    A rule targets either a single sensor or every sensor of a given type
+    in the owner's systems.
+
+    Attributes:
+        owner: The user who owns the rule.
+        name: The name of the rule.
+        sensor: Optional sensor the rule applies to.
+        sensor_type: Optional sensor type the rule applies to.
+        kind: The check performed (threshold, rate of change or z-score).
+        min_value: Lower bound for threshold rules.
+        max_value: Upper bound for threshold rules.
+        max_rate: Maximum absolute change per minute for rate rules.
+        z_threshold: Maximum absolute z-score for z-score rules.
+        min_samples: Readings required before z-score rules fire.
+        is_active: Whether the rule is evaluated.
+        created_at: The date and time when the rule was created.
+    """
+
+    KIND_CHOICES = [
+        ("THRESHOLD", "Threshold"),
+        ("RATE", "Rate of change"),
+        ("ZSCORE", "Z-score"),
+    ]
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="alert_rules",
+        db_constraint=False,
+    )
+    name = models.CharField(max_length=100)
+    sensor = models.ForeignKey(
+        Sensor,
+        on_delete=DB_CASCADE,
+        related_name="alert_rules",
+        blank=True,
+        null=True,
+    )
+    sensor_type = models.CharField(
+        max_length=10, choices=Sensor.SENSOR_TYPE_CHOICES, blank=True
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    min_value = models.FloatField(blank=True, null=True)
+    max_value = models.FloatField(blank=True, null=True)
+    max_rate = models.FloatField(blank=True, null=True)
+    z_threshold = models.FloatField(blank=True, null=True)
+    min_samples = models.PositiveIntegerField(default=30)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Rules of sensors pending deletion, excluded by the API querysets.
+    live = Q(sensor__isnull=True) | Q(sensor__deletion_requested_at__isnull=True)
+
+    def __str__(self):
+        """
+        Returns a representation combining the ID, the name and the kind.
+        """
+        return f"{self.id} – {self.name} ({self.get_kind_display()})"
+
+
+class SensorState(models.Model):
+    """
+    Running statistics of a sensor, updated incrementally on ingest.
+
+    Attributes:
+        sensor: The sensor the state belongs to.
+        count: Number of readings folded into the mean and variance
+            (capped at the z-score window).
+        mean: Running mean of the readings.
+        m2: Running sum of squared deviations (Welford).
+        last_value: The most recent reading.
+        last_measured_at: The time of the most recent reading.
+    """
+
+    sensor = models.OneToOneField(
+        Sensor, on_delete=DB_CASCADE, primary_key=True, related_name="state"
+    )
+    count = models.PositiveIntegerField(default=0)
+    mean = models.FloatField(default=0.0)
+    m2 = models.FloatField(default=0.0)
+    last_value = models.FloatField(blank=True, null=True)
+    last_measured_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        """
+        Returns a representation combining the sensor ID and the count.
+        """
+        return f"{self.sensor_id} - {self.count}"
+
+
+class AlertEvent(models.Model):
+    """
+    Represents an alert raised by a rule for a single reading.
+
+    Attributes:
+        rule: The rule that raised the alert.
+        sensor: The sensor that produced the reading.
+        value: The reading that triggered the alert.
+        measured_at: The time of the reading.
+        message: Human-readable description of the violation.
+        created_at: The date and time when the alert was raised.
+    """
+
+    rule = models.ForeignKey(AlertRule, on_delete=DB_CASCADE, related_name="events")
+    sensor = models.ForeignKey(
+        Sensor, on_delete=DB_CASCADE, related_name="alert_events"
+    )
+    value = models.FloatField()
+    measured_at = models.DateTimeField()
+    message = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Events of sensors pending deletion, excluded by the API querysets.
+    live = Q(sensor__deletion_requested_at__isnull=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["sensor", "measured_at"], name="alertevent_sensor_time_idx"
+            ),
+        ]
+
+    def __str__(self):
+        """
+        Returns a representation combining the ID, the rule and the time.
+        """
+        return f"{self.id} - {self.rule_id} - {self.measured_at}"
+
+
+class IngestedSegment(models.Model):
+    """
+    Marks a write-behind log segment as written to the database,
+    making replays of the same segment idempotent.
+
+    Attributes:
+        name: The unique name of the log segment.
+        rows: Number of measurements inserted from the segment.
+        created_at: The date and time when the segment was written.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    rows = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """
+        Returns the segment name.
+        """
+        return self.name
+
+
+class TokenVersion(models.Model):
+    """
+    Per-user version embedded in issued JWTs. Bumping it revokes all
+    tokens issued before.
+
+    Attributes:
+        user: The user the version belongs to.
+        version: The current token version.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="token_version",
+    )
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        """
+        Returns a representation combining the user ID and the version.
+        """
+        return f"{self.user_id} - {self.version}"
+
+
+class Tombstone(models.Model):
+    """
+    Records the deletion of a system, sensor or measurement, so that
+    synchronizing clients learn about it (see hydroponics.sync).
+    Tombstones are pruned after HYDROPONICS_SYNC_TOMBSTONE_DAYS.
+
+    Attributes:
+        owner: The owner of the deleted object.
+        kind: The kind of the deleted object.
+        object_id: The ID of the deleted object.
+        deleted_at: The date and time of the deletion.
+    """
+
+    SYSTEM = "system"
+    SENSOR = "sensor"
+    MEASUREMENT = "measurement"
+
+    KIND_CHOICES = [
+        (SYSTEM, "System"),
+        (SENSOR, "Sensor"),
+        (MEASUREMENT, "Measurement"),
+    ]
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+        db_constraint=False,
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "deleted_at"], name="tombstone_owner_deleted_idx"),
+        ]
+
+    def __str__(self):
+        """
+        Returns a representation combining the kind and the object ID.
+        """
+        return f"{self.kind} {self.object_id}"
+
+
+class TenantShard(models.Model):
+    """
+    Maps an owner to the database shard holding their systems, sensors
+    and measurements. Owners without an entry are placed by owner ID.
+
+    Attributes:
+        owner: The user whose data is placed.
+        shard: The database alias of the shard.
+        is_frozen: Whether writes are rejected while the data is moved.
+    """
+
+    owner = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="tenant_shard",
+    )
+    shard = models.CharField(max_length=50)
+    is_frozen = models.BooleanField(default=False)
+
+    def __str__(self):
+        """
+        Returns a representation combining the owner ID and the shard.
+        """
+        return f"{self.owner_id} - {self.shard}"
+
+
+class Job(models.Model):
+    """
+    A unit of background work executed by the run_jobs worker.
+
+    Attributes:
+        owner: The user who enqueued the job (None for system jobs).
+        kind: The registered job kind (see hydroponics.jobs).
+        params: Validated parameters of the job.
+        status: The state of the job.
+        progress: Completed fraction of the work, from 0 to 1.
+        message: Short description of the current step.
+        result: Result of a successful run.
+        error: The error of the last failed attempt.
+        attempts: Number of started attempts.
+        max_attempts: Attempts allowed before the job fails.
+        run_after: The job is not started before this time (retry backoff).
+        lease_expires_at: When a running job is considered abandoned
+            by its worker unless the lease is renewed.
+        worker: Identifier of the worker running the job.
+        created_at: The date and time when the job was enqueued.
+        started_at: The date and time when the last attempt started.
+        finished_at: The date and time when the job finished.
+    """
+
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
+
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+        (CANCELLED, "Cancelled"),
+    ]
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="jobs",
+        blank=True,
+        null=True,
+    )
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.FloatField(default=0.0)
+    message = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(blank=True, null=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="job_status_run_after_idx"),
+            models.Index(fields=["owner", "created_at"], name="job_owner_created_idx"),
+        ]
+
+    def __str__(self):
+        """
+        Returns a representation combining the ID, the kind and the status.
+        """
+        return f"{self.id} - {self.kind} ({self.status})"
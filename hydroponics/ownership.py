@@ -0,0 +1,196 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import HydroponicSystem, Sensor
+from .sharding import fan_out
+
+"""
+Cached resolution of sensor and system ownership, shared by the
+permission classes, serializers and filters.
+
+The cache is per process. Saving or deleting a sensor or system
+invalidates its entries in this process at once and, when the
+transaction commits, bumps a version in the Django cache; every process
+checks the version on each lookup and clears its cache when it changed,
+so with a shared cache (REDIS_URL) a reassigned sensor is seen by all
+processes immediately. Changes made by queryset.update() become visible
+after the TTL at the latest.
+"""
+
+VERSION_KEY = "hydroponics:ownership-version"
+
+SensorOwnership = namedtuple(
+    "SensorOwnership",
+    ["sensor_id", "system_id", "owner_id", "sensor_type", "rate_limit"],
+)
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Attributes:
+        maxsize: Maximum number of entries.
+        ttl: Lifetime of an entry in seconds.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class OwnershipResolver:
+    """
+    Maps sensor and system IDs to their owners.
+
+    Only existing objects are cached, so a sensor created in another
+    process is found immediately. Cache misses are looked up on every
+    shard in turn.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.sensors = LRUCache(maxsize, ttl)
+        self.systems = LRUCache(maxsize, ttl)
+        self._version = None
+
+    def _check_version(self):
+        """
+        Clears the cache when another process changed an ownership.
+        """
+        version = cache.get(VERSION_KEY, 0)
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    def _bump_version(self):
+        def bump():
+            cache.add(VERSION_KEY, 0, timeout=None)
+            cache.incr(VERSION_KEY)
+
+        transaction.on_commit(bump)
+
+    def sensor(self, sensor_id):
+        """
+        Returns the SensorOwnership of a sensor, or None if it doesn't exist.
+        """
+        return self.sensors_bulk([sensor_id]).get(int(sensor_id))
+
+    def sensors_bulk(self, sensor_ids):
+        """
+        Returns SensorOwnership entries keyed by sensor ID, loading all
+        cache misses with a single query.
+        """
+        self._check_version()
+        found, missing = {}, []
+        for sensor_id in {int(sensor_id) for sensor_id in sensor_ids}:
+            entry = self.sensors.get(sensor_id)
+            if entry is None:
+                missing.append(sensor_id)
+            else:
+                found[sensor_id] = entry
+        queryset = Sensor.objects.values_list(
+            "id",
+            "system_id",
+            "system__owner_id",
+            "sensor_type",
+            "system__ingest_rate_limit",
+        )
+        for shard_queryset in fan_out(queryset):
+            if not missing:
+                break
+            for row in shard_queryset.filter(id__in=missing):
+                entry = SensorOwnership(*row)
+                self.sensors.set(entry.sensor_id, entry)
+                self.systems.set(entry.system_id, entry.owner_id)
+                found[entry.sensor_id] = entry
+            missing = [sensor_id for sensor_id in missing if sensor_id not in found]
+        return found
+
+    def system_owner(self, system_id):
+        """
+        Returns the owner ID of a system, or None if it doesn't exist.
+        """
+        self._check_version()
+        system_id = int(system_id)
+        owner_id = self.systems.get(system_id)
+        if owner_id is None:
+            queryset = HydroponicSystem.objects.filter(id=system_id).values_list(
+                "owner_id", flat=True
+            )
+            for shard_queryset in fan_out(queryset):
+                owner_id = shard_queryset.first()
+                if owner_id is not None:
+                    self.systems.set(system_id, owner_id)
+                    break
+        return owner_id
+
+    def sensor_owner(self, sensor_id):
+        """
+        Returns the owner ID of a sensor, or None if it doesn't exist.
+        """
+        entry = self.sensor(sensor_id)
+        return entry.owner_id if entry else None
+
+    def owns_sensor(self, user_id, sensor_id):
+        return user_id is not None and self.sensor_owner(sensor_id) == user_id
+
+    def owns_system(self, user_id, system_id):
+        return user_id is not None and self.system_owner(system_id) == user_id
+
+    def invalidate_sensor(self, sensor_id):
+        self.sensors.delete(sensor_id)
+        self._bump_version()
+
+    def invalidate_system(self, system_id):
+        self.systems.delete(system_id)
+        self.sensors.delete_where(lambda entry: entry.system_id == system_id)
+        self._bump_version()
+
+    def clear(self):
+        self.sensors.clear()
+        self.systems.clear()
+
+
+resolver = OwnershipResolver(
+    maxsize=getattr(settings, "HYDROPONICS_OWNERSHIP_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "HYDROPONICS_OWNERSHIP_CACHE_TTL", 60),
+)
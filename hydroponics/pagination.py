@@ -1,7 +1,13 @@
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from rest_framework.pagination import PageNumberPagination
 
+from .budgets import query_plan
+
 """
-Definition of pagination classes for the Hydroponic API.
+Definition of pagination classes for the Hydroponic API and the admin.
 """
 
 
@@ -20,3 +26,24 @@ class AddPageNumberPagination(PageNumberPagination):
     max_page_size = 100
     page_query_param = "page"
     page_size_query_param = "page_size"
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    An admin paginator that takes the number of rows of large querysets
+    from the PostgreSQL planner estimate (based on the pg_class
+    statistics) instead of running COUNT(*) over millions of rows.
+
+    Querysets estimated below HYDROPONICS_ADMIN_EXACT_COUNT_LIMIT rows
+    are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if connections[queryset.db].vendor == "postgresql":
+            estimate = int(query_plan(queryset.order_by())["Plan Rows"])
+            limit = getattr(settings, "HYDROPONICS_ADMIN_EXACT_COUNT_LIMIT", 10000)
+            if estimate > limit:
+                return estimate
+        return super().count
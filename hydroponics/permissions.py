@@ -1,6 +1,9 @@
+from django.conf import settings
 from rest_framework import permissions
 
-from hydroponics.models import HydroponicSystem, Measurement, Sensor
+from hydroponics.models import (AlertEvent, AlertRule, HydroponicSystem,
+                                Measurement, Sensor)
+from hydroponics.ownership import resolver
 
 """
 Definition of custom permission classes for the Hydroponic API,
@@ -13,16 +16,39 @@ class IsOwner(permissions.BasePermission):
     A permission class ensuring that only the owner of a resource
     can access or modify it.
 
+    Owners of sensors and measurements are looked up through the cached
+    ownership resolver, so no related objects are loaded.
+
     - For HydroponicSystem, checks if obj.owner == request.user
     - For Sensor, checks if obj.system.owner == request.user
     - For Measurement, checks if obj.sensor.system.owner == request.user
+    - For AlertRule, checks if obj.owner == request.user
+    - For AlertEvent, checks if obj.rule.owner == request.user
     """
 
     def has_object_permission(self, request, view, obj):
+        user_id = request.user.id
         if isinstance(obj, HydroponicSystem):
-            return obj.owner == request.user
+            return obj.owner_id == user_id
         elif isinstance(obj, Sensor):
-            return obj.system.owner == request.user
+            return resolver.owns_system(user_id, obj.system_id)
         elif isinstance(obj, Measurement):
-            return obj.sensor.system.owner == request.user
+            return resolver.owns_sensor(user_id, obj.sensor_id)
+        elif isinstance(obj, AlertRule):
+            return obj.owner_id == user_id
+        elif isinstance(obj, AlertEvent):
+            return obj.rule.owner_id == user_id
         return False
+
+
+class IsMetricsClient(permissions.BasePermission):
+    """
+    Allows metrics scraping by staff users and by clients connecting
+    from HYDROPONICS_METRICS_ALLOWED_IPS.
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        allowed = getattr(settings, "HYDROPONICS_METRICS_ALLOWED_IPS", [])
+        return request.META.get("REMOTE_ADDR") in allowed
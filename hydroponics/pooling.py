@@ -0,0 +1,86 @@
+from django.db import connections
+
+from .metrics import registry
+
+"""
+Statistics and handling of the in-process database connection pools.
+
+With DATABASE_POOL=1 every PostgreSQL database gets a psycopg_pool
+ConnectionPool (Django's "pool" option), shared by the threads of the
+process, so sync views, async views and background threads all borrow
+from the same bounded set of connections and return them at the end of
+the request. The pool statistics are exported labelled with the
+database alias: the current state as gauges, which get the pid of each
+worker (see hydroponics.metrics), and the cumulative statistics as
+counters summed over the workers.
+"""
+
+
+def pools():
+    """
+    Returns the open connection pools, by database alias.
+    """
+    found = {}
+    for alias in connections:
+        options = connections.settings[alias].get("OPTIONS", {})
+        if options.get("pool"):
+            pool = connections[alias].pool
+            if not pool.closed:
+                found[alias] = pool
+    return found
+
+
+def close_pools():
+    """
+    Closes the connection pools, e.g. before forking worker processes,
+    which open their own pools when first used.
+    """
+    for alias in pools():
+        connections[alias].close_pool()
+
+
+def _collect(statistic):
+    def collect():
+        return {
+            (("database", alias),): statistic(pool.get_stats())
+            for alias, pool in pools().items()
+        }
+
+    return collect
+
+
+registry.gauge(
+    "hydroponics_db_pool_connections_in_use",
+    "Pooled database connections lent to requests or being opened.",
+    _collect(lambda stats: stats["pool_size"] - stats["pool_available"]),
+)
+registry.gauge(
+    "hydroponics_db_pool_connections_idle",
+    "Pooled database connections ready to be lent.",
+    _collect(lambda stats: stats["pool_available"]),
+)
+registry.gauge(
+    "hydroponics_db_pool_requests_waiting",
+    "Requests currently waiting for a pooled database connection.",
+    _collect(lambda stats: stats["requests_waiting"]),
+)
+registry.counter(
+    "hydroponics_db_pool_checkouts_total",
+    "Database connections lent by the pool since it was opened.",
+    _collect(lambda stats: stats.get("requests_num", 0)),
+)
+registry.counter(
+    "hydroponics_db_pool_wait_seconds_total",
+    "Time spent waiting for pooled database connections since the pool was opened.",
+    _collect(lambda stats: stats.get("requests_wait_ms", 0) / 1000),
+)
+registry.counter(
+    "hydroponics_db_pool_checkout_timeouts_total",
+    "Requests that timed out waiting for a pooled database connection.",
+    _collect(lambda stats: stats.get("requests_errors", 0)),
+)
+registry.counter(
+    "hydroponics_db_pool_connections_lost_total",
+    "Pooled database connections found broken by a health check.",
+    _collect(lambda stats: stats.get("connections_lost", 0)),
+)
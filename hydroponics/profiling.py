@@ -0,0 +1,290 @@
+import cProfile
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db import connections
+from django.utils import timezone
+
+"""
+On-demand profiling of single API requests in production.
+
+A request carrying a profiling token, issued for a staff user by
+`manage.py profiling_token`, in the X-Profile header (or the _profile
+query parameter) runs under cProfile, or only under a sampling profiler
+with X-Profile-Mode: sample (_profile_mode=sample). Its report is
+written to HYDROPONICS_PROFILING_DIR and named in the X-Profile-Report
+response header:
+
+    <name>.json       Duration, status, the SQL queries with their
+                      timings and the time spent in the phases of the
+                      view (authentication, filtering, serialization, ...).
+    <name>.pstats     The cProfile statistics (`python -m pstats`).
+    <name>.collapsed  The sampled stacks in the collapsed format of
+                      flamegraph.pl and speedscope.
+
+The oldest reports are deleted once the directory holds more than
+HYDROPONICS_PROFILING_MAX_BYTES. Requests without a token only pay for
+a header and a query string lookup.
+"""
+
+logger = logging.getLogger(__name__)
+
+SALT = "hydroponics.profiling"
+
+# Functions whose time is reported as a phase of the request.
+PHASES = {
+    "authentication": {"perform_authentication"},
+    "permissions": {"check_permissions", "check_object_permissions"},
+    "queryset": {"get_queryset"},
+    "filtering": {"filter_queryset"},
+    "pagination": {"paginate_queryset"},
+    "validation": {"is_valid"},
+    "serialization": {"to_representation"},
+    "rendering": {"rendered_content"},
+}
+
+
+def profiling_token(user):
+    """
+    Returns a profiling token for a staff user.
+    """
+    return signing.dumps({"user": user.pk}, salt=SALT, compress=True)
+
+
+def profiling_user(token):
+    """
+    Returns the ID of the active staff user a valid, unexpired token was
+    issued for, or None.
+    """
+    max_age = getattr(settings, "HYDROPONICS_PROFILING_TOKEN_MAX_AGE", 3600)
+    try:
+        user_id = signing.loads(token, salt=SALT, max_age=max_age)["user"]
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+    is_staff = (
+        get_user_model()
+        .objects.filter(pk=user_id, is_staff=True, is_active=True)
+        .exists()
+    )
+    return user_id if is_staff else None
+
+
+class Sampler:
+    """
+    Samples the stack of a thread from a background thread.
+
+    Attributes:
+        thread_id: Identifier of the sampled thread.
+        interval: Seconds between samples.
+        stacks: Number of samples by stack, a tuple of (module, function)
+            pairs from the outermost frame.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                module = frame.f_globals.get("__name__", "?")
+                stack.append((module, frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stack format.
+        """
+        return "".join(
+            ";".join(f"{module}.{name}".replace(";", ":") for module, name in stack)
+            + f" {count}\n"
+            for stack, count in self.stacks.most_common()
+        )
+
+
+class RequestProfile:
+    """
+    Profiles the code run within a `with` block of the current thread
+    and records its database queries.
+
+    Attributes:
+        mode: "cprofile" or "sample".
+        queries: The queries as dicts of database, sql, many and seconds.
+        seconds: The duration of the block.
+    """
+
+    def __init__(self, mode="cprofile"):
+        self.mode = mode
+        self.queries = []
+        self.seconds = None
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        interval = getattr(settings, "HYDROPONICS_PROFILING_SAMPLE_INTERVAL", 0.005)
+        self.sampler = Sampler(threading.get_ident(), interval)
+        self._stack = ExitStack()
+
+    def __enter__(self):
+        for alias in connections:
+            self._stack.enter_context(connections[alias].execute_wrapper(self._record))
+        self.sampler.start()
+        self._started = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.seconds = time.perf_counter() - self._started
+        self.sampler.stop()
+        self._stack.close()
+
+    def _record(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                {
+                    "database": context["connection"].alias,
+                    "sql": sql,
+                    "many": many,
+                    "seconds": round(time.perf_counter() - started, 6),
+                }
+            )
+
+    def phases(self):
+        """
+        Returns the seconds spent in each of the PHASES, from the cProfile
+        statistics or else from the samples.
+        """
+        if self.profiler is not None:
+            longest = {}
+            for (_, _, name), entry in pstats.Stats(self.profiler).stats.items():
+                longest[name] = max(longest.get(name, 0), entry[3])
+            return {
+                phase: round(sum(longest.get(name, 0) for name in names), 6)
+                for phase, names in PHASES.items()
+            }
+        total = sum(self.sampler.stacks.values())
+        phases = {}
+        for phase, names in PHASES.items():
+            count = sum(
+                count
+                for stack, count in self.sampler.stacks.items()
+                if any(name in names for _, name in stack)
+            )
+            phases[phase] = round(self.seconds * count / total, 6) if total else 0.0
+        return phases
+
+    def save(self, directory, details):
+        """
+        Writes the report files to a directory and returns their common
+        name.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"{timezone.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        summary = {
+            **details,
+            "mode": self.mode,
+            "seconds": round(self.seconds, 6),
+            "phases": self.phases(),
+            "query_count": len(self.queries),
+            "query_seconds": round(sum(q["seconds"] for q in self.queries), 6),
+            "queries": self.queries,
+        }
+        (directory / f"{name}.json").write_text(json.dumps(summary, indent=2))
+        (directory / f"{name}.collapsed").write_text(self.sampler.collapsed())
+        if self.profiler is not None:
+            self.profiler.dump_stats(directory / f"{name}.pstats")
+        return name
+
+
+def rotate(directory, max_bytes, keep=None):
+    """
+    Deletes the oldest reports, except the one named keep, until the
+    directory holds at most max_bytes.
+    """
+    # Report names start with their creation time.
+    files = sorted(Path(directory).glob("*"))
+    sizes = [file.stat().st_size for file in files]
+    total = sum(sizes)
+    for file, size in zip(files, sizes):
+        if total <= max_bytes:
+            break
+        if file.stem != keep:
+            file.unlink(missing_ok=True)
+            total -= size
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests carrying a valid profiling token.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.META.get("HTTP_X_PROFILE")
+        if token is None and "_profile=" in request.META.get("QUERY_STRING", ""):
+            token = request.GET.get("_profile")
+        if not token:
+            return self.get_response(request)
+        user_id = profiling_user(token)
+        if user_id is None:
+            logger.warning("Ignored an invalid profiling token for %s.", request.path)
+            return self.get_response(request)
+
+        mode = request.META.get("HTTP_X_PROFILE_MODE") or request.GET.get(
+            "_profile_mode", "cprofile"
+        )
+        with RequestProfile("sample" if mode == "sample" else "cprofile") as profile:
+            response = self.get_response(request)
+
+        query = request.GET.copy()
+        for parameter in ("_profile", "_profile_mode"):
+            query.pop(parameter, None)
+        directory = settings.HYDROPONICS_PROFILING_DIR
+        name = profile.save(
+            directory,
+            {
+                "method": request.method,
+                "path": request.path,
+                "query": query.urlencode(),
+                "user": user_id,
+                "status": response.status_code,
+            },
+        )
+        rotate(
+            directory,
+            getattr(settings, "HYDROPONICS_PROFILING_MAX_BYTES", 100 * 1024 * 1024),
+            keep=name,
+        )
+        response["X-Profile-Report"] = name
+        return response
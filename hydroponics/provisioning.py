@@ -0,0 +1,58 @@
+from django.db import router, transaction
+
+from .models import HydroponicSystem, Sensor
+
+"""
+Bulk provisioning of systems and their sensors, e.g. when onboarding a
+new greenhouse. The document is validated by ProvisioningSerializer.
+"""
+
+
+def provision(owner_id, systems):
+    """
+    Creates the systems and sensors of a provisioning document in one
+    transaction with batched inserts.
+
+    Args:
+        owner_id: The ID of the user owning the systems.
+        systems: Validated system entries; an entry with an `id` adds its
+            sensors to that existing system, the others create a system.
+
+    Returns:
+        A list of {"id": system_id, "sensors": [sensor_id, ...]} dicts in
+        the order of the document.
+    """
+    using = router.db_for_write(HydroponicSystem)
+    with transaction.atomic(using=using):
+        created = iter(
+            HydroponicSystem.objects.using(using).bulk_create(
+                [
+                    HydroponicSystem(
+                        owner_id=owner_id,
+                        name=entry["name"],
+                        description=entry.get("description"),
+                    )
+                    for entry in systems
+                    if "id" not in entry
+                ]
+            )
+        )
+        system_ids = [
+            entry["id"] if "id" in entry else next(created).id for entry in systems
+        ]
+        sensors = Sensor.objects.using(using).bulk_create(
+            [
+                Sensor(system_id=system_id, **sensor)
+                for system_id, entry in zip(system_ids, systems)
+                for sensor in entry.get("sensors", [])
+            ]
+        )
+
+    sensor_ids = iter(sensor.id for sensor in sensors)
+    return [
+        {
+            "id": system_id,
+            "sensors": [next(sensor_ids) for _ in entry.get("sensors", [])],
+        }
+        for system_id, entry in zip(system_ids, systems)
+    ]
@@ -0,0 +1,124 @@
+from itertools import islice
+
+from django.db import connections, router
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from .chunks import merged_reads_enabled, sealed_after, series
+from .models import Measurement
+
+"""
+Reading the most recent measurements of many sensors with one query.
+
+On PostgreSQL each sensor's readings are taken by a LATERAL subquery
+walking the (sensor, measured_at) index backwards, so the cost depends
+on the number of returned rows only. Other backends rank the rows with
+a window function.
+
+When measurements are also stored in chunks or in the archive, one more
+query finds the sensors whose latest readings may be sealed, and only
+those are read through the merged series.
+"""
+
+LATERAL_SQL = """
+SELECT m.{id}, m.{sensor_id}, m.{value}, m.{measured_at}
+FROM unnest(%s::bigint[]) AS selected(sensor_id)
+CROSS JOIN LATERAL (
+    SELECT {id}, {sensor_id}, {value}, {measured_at}
+    FROM {table}
+    WHERE {sensor_id} = selected.sensor_id{conditions}
+    ORDER BY {measured_at} DESC, {id} DESC
+    LIMIT %s
+) AS m
+"""
+
+
+def _lateral(using, sensor_ids, limit, start, end):
+    quote = connections[using].ops.quote_name
+    names = {
+        field: quote(Measurement._meta.get_field(field).column)
+        for field in ("id", "value", "measured_at")
+    }
+    names["sensor_id"] = quote(Measurement._meta.get_field("sensor").column)
+    conditions, params = "", [list(sensor_ids)]
+    if start is not None:
+        conditions += f" AND {names['measured_at']} >= %s"
+        params.append(start)
+    if end is not None:
+        conditions += f" AND {names['measured_at']} < %s"
+        params.append(end)
+    params.append(limit)
+    sql = LATERAL_SQL.format(
+        table=quote(Measurement._meta.db_table), conditions=conditions, **names
+    )
+    return Measurement.objects.raw(sql, params).using(using)
+
+
+def _ranked(using, sensor_ids, limit, start, end):
+    measurements = Measurement.objects.using(using).filter(sensor_id__in=sensor_ids)
+    if start is not None:
+        measurements = measurements.filter(measured_at__gte=start)
+    if end is not None:
+        measurements = measurements.filter(measured_at__lt=end)
+    return measurements.annotate(
+        rank=Window(
+            RowNumber(),
+            partition_by=F("sensor_id"),
+            order_by=[F("measured_at").desc(), F("id").desc()],
+        )
+    ).filter(rank__lte=limit)
+
+
+def latest_rows(sensor_ids, limit, start=None, end=None):
+    """
+    Returns the latest measurements of each sensor in the measurement
+    table, ignoring chunks and the archive. Takes the arguments of
+    latest_measurements().
+    """
+    using = router.db_for_read(Measurement)
+    if connections[using].vendor == "postgresql":
+        measurements = _lateral(using, sensor_ids, limit, start, end)
+    else:
+        measurements = _ranked(using, sensor_ids, limit, start, end)
+
+    by_sensor = {sensor_id: [] for sensor_id in sensor_ids}
+    for measurement in measurements:
+        by_sensor[measurement.sensor_id].append(measurement)
+    for readings in by_sensor.values():
+        readings.sort(key=lambda m: (m.measured_at, m.id), reverse=True)
+    return by_sensor
+
+
+def latest_measurements(sensor_ids, limit, start=None, end=None):
+    """
+    Returns the latest measurements of each sensor, from the table, the
+    chunks and the archive.
+
+    Args:
+        sensor_ids: IDs of the sensors, whose ownership has been checked.
+        limit: Maximal number of measurements per sensor.
+        start: Optional start of the time range (inclusive).
+        end: Optional end of the time range (exclusive).
+
+    Returns:
+        A dict mapping each sensor ID to the list of its measurements,
+        newest first.
+    """
+    by_sensor = latest_rows(sensor_ids, limit, start, end)
+    if not merged_reads_enabled():
+        return by_sensor
+    lookups = {}
+    if start is not None:
+        lookups["measured_at__gte"] = start
+    if end is not None:
+        lookups["measured_at__lt"] = end
+    # Sealed readings can only be among the latest ones of a sensor with
+    # fewer rows than the limit, or newer than its oldest row returned.
+    since = {
+        sensor_id: readings[-1].measured_at if len(readings) == limit else None
+        for sensor_id, readings in by_sensor.items()
+    }
+    for sensor_id in sealed_after(since, lookups):
+        readings = series([sensor_id], lookups, reverse=True)
+        by_sensor[sensor_id] = list(islice(readings, limit))
+    return by_sensor
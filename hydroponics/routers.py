@@ -0,0 +1,244 @@
+import contextvars
+import hashlib
+import random
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import TenantShard
+from .ownership import LRUCache, resolver
+from .sharding import (SHARD_LOCAL_MODELS, TENANT_MODELS, TenantMoving,
+                       current_tenant, is_sharded, pinned_shard, shard_aliases)
+
+"""
+Database routers.
+
+ShardRouter places tenant data on the shard of its owner (see
+hydroponics.sharding). ReplicaRouter sends the remaining reads issued
+while handling safe (GET/HEAD/OPTIONS) requests to a read replica,
+the same one for all the reads of a request; everything else, including all writes and migrations, goes to the
+primary database.
+"""
+
+PIN_COOKIE = "hydroponics_primary"
+
+# The replica serving the reads of the current context, if any.
+_read_replica = contextvars.ContextVar("hydroponics_read_replica", default=None)
+
+
+Placement = namedtuple("Placement", ["shard", "is_frozen"])
+
+_placements = LRUCache(
+    maxsize=getattr(settings, "HYDROPONICS_SHARD_MAP_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "HYDROPONICS_SHARD_MAP_CACHE_TTL", 5),
+)
+
+
+def placement(owner_id):
+    """
+    Returns the Placement of an owner's data, from the TenantShard map
+    or, for owners not in the map, by owner ID.
+    """
+    cached = _placements.get(owner_id)
+    if cached is None:
+        row = (
+            TenantShard.objects.using("default")
+            .filter(owner_id=owner_id)
+            .values_list("shard", "is_frozen")
+            .first()
+        )
+        if row is None:
+            aliases = shard_aliases()
+            row = (aliases[owner_id % len(aliases)], False)
+        cached = Placement(*row)
+        _placements.set(owner_id, cached)
+    return cached
+
+
+def invalidate_placement(owner_id):
+    _placements.delete(owner_id)
+
+
+def shard_for_owner(owner_id, for_write=False):
+    """
+    Returns the shard holding an owner's data.
+
+    Raises:
+        TenantMoving: for writes while the owner is being moved.
+    """
+    current = placement(owner_id)
+    if for_write and current.is_frozen:
+        raise TenantMoving()
+    return current.shard
+
+
+def owner_of(instance):
+    """
+    Returns the owner ID of a tenant model instance, or None if unknown.
+    Only loaded field values are used, as the instance may still be
+    under construction.
+    """
+    values = instance.__dict__
+    if values.get("owner_id") is not None:
+        return values["owner_id"]
+    if values.get("system_id") is not None:
+        return resolver.system_owner(values["system_id"])
+    if values.get("sensor_id") is not None:
+        return resolver.sensor_owner(values["sensor_id"])
+    return None
+
+
+def current_shard(for_write=False):
+    """
+    Returns the shard selected for the current context, falling back
+    to the default database.
+    """
+    alias = pinned_shard()
+    if alias is not None:
+        return alias
+    owner_id = current_tenant()
+    if owner_id is not None:
+        return shard_for_owner(owner_id, for_write)
+    return "default"
+
+
+def _is_tenant_instance(instance):
+    return (
+        instance._meta.app_label == "hydroponics"
+        and instance._meta.model_name in TENANT_MODELS
+    )
+
+
+class ShardRouter:
+    """
+    Routes tenant models to the shard of their owner, shard-local
+    models to the pinned shard and the remaining hydroponics models to
+    the default database. Does nothing while sharding is disabled.
+    """
+
+    def _route(self, model, hints, for_write):
+        if not is_sharded() or model._meta.app_label != "hydroponics":
+            return None
+        name = model._meta.model_name
+        if name in SHARD_LOCAL_MODELS:
+            return pinned_shard() or "default"
+        if name not in TENANT_MODELS:
+            return "default"
+
+        instance = hints.get("instance")
+        if instance is not None:
+            if instance._meta.label == settings.AUTH_USER_MODEL:
+                return shard_for_owner(instance.pk, for_write)
+            if _is_tenant_instance(instance):
+                if instance._state.db and not for_write:
+                    return instance._state.db
+                owner_id = owner_of(instance)
+                if owner_id is not None:
+                    return shard_for_owner(owner_id, for_write)
+        return current_shard(for_write)
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints, for_write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints, for_write=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Tenant data on any shard refers to users on the default database.
+        if is_sharded():
+            aliases = shard_aliases()
+            if obj1._state.db in aliases and obj2._state.db in aliases:
+                return True
+        return None
+
+
+def replica_aliases():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+@contextmanager
+def use_replicas(enabled=True):
+    """
+    Allows (or forbids) reads from replicas within the block, e.g. for
+    analytics queries in management commands. All the reads of the
+    block go to one replica, chosen at random unless an enclosing block
+    already chose one, so e.g. the count and the page of a list see the
+    same state.
+    """
+    replica = None
+    replicas = replica_aliases()
+    if enabled and replicas:
+        replica = _read_replica.get() or random.choice(replicas)
+    token = _read_replica.set(replica)
+    try:
+        yield
+    finally:
+        _read_replica.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Routes reads to the read replica chosen for the current context
+    (see use_replicas), and all writes and migrations to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_replica.get() or "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {"default", *replica_aliases()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replica_aliases():
+            return False
+        return None
+
+
+def _pin_key(request):
+    authorization = request.META.get("HTTP_AUTHORIZATION")
+    if not authorization:
+        return None
+    digest = hashlib.sha256(authorization.encode()).hexdigest()
+    return f"hydroponics:primary-pin:{digest}"
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Enables replica reads for safe requests, with read-your-writes
+    stickiness: after a successful write the client is pinned to the
+    primary for HYDROPONICS_REPLICA_PIN_SECONDS, through a cookie and
+    through a cache entry keyed by its Authorization header. The entry
+    is seen by every worker through the shared cache (see CACHES).
+    """
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not replica_aliases():
+            return self.get_response(request)
+
+        safe = request.method in self.SAFE_METHODS
+        pin_key = _pin_key(request)
+        pinned = PIN_COOKIE in request.COOKIES or (
+            safe and pin_key is not None and cache.get(pin_key) is not None
+        )
+        with use_replicas(safe and not pinned):
+            response = self.get_response(request)
+
+        if not safe and response.status_code < 400:
+            seconds = getattr(settings, "HYDROPONICS_REPLICA_PIN_SECONDS", 10)
+            response.set_cookie(PIN_COOKIE, "1", max_age=seconds, httponly=True)
+            if pin_key is not None:
+                cache.set(pin_key, 1, seconds)
+        return response
@@ -0,0 +1,56 @@
+import functools
+import hashlib
+from pathlib import Path
+
+from django.conf import settings
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg.generators import OpenAPISchemaGenerator
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+"""
+The OpenAPI document of the API, generated once (`manage.py
+generate_schema`) into a file committed with the code and served as a
+static document instead of introspecting every view per request.
+"""
+
+SCHEMA_INFO = openapi.Info(
+    title="Hydroponic API",
+    default_version="v1",
+    description=(
+        "All protected endpoints require a JWT token in the request header. "
+        "Use `Authorization: Bearer <token>` to authenticate. "
+        "Obtain a token from `/api/token/` by providing valid credentials."
+    ),
+)
+
+
+def schema_path():
+    return Path(settings.HYDROPONICS_OPENAPI_SCHEMA)
+
+
+def generate_schema():
+    """
+    Builds the OpenAPI document by introspecting the API views.
+
+    Returns:
+        The document as pretty-printed JSON bytes.
+    """
+    # Views build their querysets from the (anonymous) request user; the
+    # empty URL keeps the host of the mock request out of the document.
+    request = APIView().initialize_request(APIRequestFactory().get("/"))
+    generator = OpenAPISchemaGenerator(SCHEMA_INFO, url="")
+    schema = generator.get_schema(request=request, public=True)
+    return OpenAPICodecJson(validators=[], pretty=True).encode(schema)
+
+
+@functools.lru_cache(maxsize=1)
+def load_schema():
+    """
+    Returns the content of the schema file (generated in memory if the
+    file is missing) and its strong ETag, read once per process.
+    """
+    path = schema_path()
+    content = path.read_bytes() if path.exists() else generate_schema()
+    return content, hashlib.sha256(content).hexdigest()
@@ -1,6 +1,13 @@
+from datetime import timedelta
+
+from django.utils import timezone
 from rest_framework import serializers
 
-from .models import HydroponicSystem, Measurement, Sensor
+from .jobs import kinds
+from .models import (AlertEvent, AlertRule, HydroponicSystem, Job, Measurement,
+                     Sensor)
+from .ownership import resolver
+from .stats import DEFAULT_PERCENTILES
 
 """
 Definition of serializers for the HydroponicSystem, Sensor, and Measurement models.
@@ -15,6 +22,63 @@ ALLOWED_RANGES = {
 }
 
 
+class OwnedSensorField(serializers.PrimaryKeyRelatedField):
+    """
+    A sensor field that resolves the sensor and its owner through the
+    cached ownership resolver instead of querying the sensor queryset.
+    Sensors of other users are rejected as non-existent.
+    """
+
+    def to_internal_value(self, data):
+        request = self.context.get("request")
+        if request is None:
+            return super().to_internal_value(data)
+        try:
+            entry = resolver.sensor(data)
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if entry is None or entry.owner_id != request.user.id:
+            self.fail("does_not_exist", pk_value=data)
+        return Sensor.from_db(
+            None,
+            ["id", "system_id", "sensor_type"],
+            [entry.sensor_id, entry.system_id, entry.sensor_type],
+        )
+
+
+class OwnedSystemField(serializers.PrimaryKeyRelatedField):
+    """
+    A system field that checks ownership through the cached ownership
+    resolver. Systems of other users are rejected as non-existent.
+    """
+
+    def to_internal_value(self, data):
+        request = self.context.get("request")
+        if request is None:
+            return super().to_internal_value(data)
+        try:
+            owner_id = resolver.system_owner(data)
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if owner_id is None or owner_id != request.user.id:
+            self.fail("does_not_exist", pk_value=data)
+        return HydroponicSystem.from_db(None, ["id", "owner_id"], [int(data), owner_id])
+
+
+def validate_value_range(sensor_type, value):
+    """
+    Checks if 'value' is within the ALLOWED_RANGES of the sensor type.
+    Shared by the serializers and the non-HTTP ingestion paths.
+    """
+    if sensor_type in ALLOWED_RANGES:
+        min_val, max_val = ALLOWED_RANGES[sensor_type]
+        if not (min_val <= value <= max_val):
+            raise serializers.ValidationError(
+                f"Value {value} is out of the scope {min_val}–{max_val} "
+                f"for sensor type: {sensor_type}."
+            )
+
+
 class MeasurementSerializer(serializers.ModelSerializer):
     """
     Serializer for the Measurement model which validates:
@@ -28,6 +92,8 @@ class MeasurementSerializer(serializers.ModelSerializer):
         create: Checks system ownership before creating the measurement.
     """
 
+    sensor = OwnedSensorField(queryset=Sensor.objects.all())
+
     class Meta:
         model = Measurement
         fields = ["id", "sensor", "value", "measured_at"]
@@ -37,8 +103,10 @@ class MeasurementSerializer(serializers.ModelSerializer):
         super().__init__(*args, **kwargs)
         request = self.context.get("request")
         if request and hasattr(request, "user"):
-            user = request.user
-            self.fields["sensor"].queryset = Sensor.objects.filter(system__owner=user)
+            user_id = request.user.id
+            self.fields["sensor"].queryset = Sensor.objects.filter(
+                system__owner_id=user_id
+            )
 
     def validate(self, attrs):
         """
@@ -50,14 +118,7 @@ class MeasurementSerializer(serializers.ModelSerializer):
         value = attrs.get("value")
 
         if sensor and value is not None:
-            sensor_type = sensor.sensor_type
-            if sensor_type in ALLOWED_RANGES:
-                min_val, max_val = ALLOWED_RANGES[sensor_type]
-                if not (min_val <= value <= max_val):
-                    raise serializers.ValidationError(
-                        f"Value {value} is out of the scope {min_val}–{max_val} "
-                        f"for sensor type: {sensor_type}."
-                    )
+            validate_value_range(sensor.sensor_type, value)
 
         return attrs
 
@@ -68,7 +129,7 @@ class MeasurementSerializer(serializers.ModelSerializer):
         sensor = validated_data["sensor"]
         user = self.context["request"].user
 
-        if sensor.system.owner != user:
+        if resolver.sensor_owner(sensor.id) != user.id:
             raise serializers.ValidationError("You cannot add another user's sensor.")
 
         return super().create(validated_data)
@@ -88,6 +149,7 @@ class SensorSerializer(serializers.ModelSerializer):
         source="get_sensor_type_display", read_only=True
     )
     measurements = MeasurementSerializer(many=True, read_only=True)
+    system = OwnedSystemField(queryset=HydroponicSystem.objects.all())
 
     class Meta:
         model = Sensor
@@ -104,8 +166,10 @@ class SensorSerializer(serializers.ModelSerializer):
         super().__init__(*args, **kwargs)
         request = self.context.get("request")
         if request and hasattr(request, "user"):
-            user = request.user
-            self.fields["system"].queryset = HydroponicSystem.objects.filter(owner=user)
+            user_id = request.user.id
+            self.fields["system"].queryset = HydroponicSystem.objects.filter(
+                owner_id=user_id
+            )
 
     def validate(self, attrs):
         """
@@ -113,7 +177,7 @@ class SensorSerializer(serializers.ModelSerializer):
         """
         system = attrs.get("system")
         user = self.context["request"].user
-        if system.owner != user:
+        if system and resolver.system_owner(system.id) != user.id:
             raise serializers.ValidationError(
                 "This system doesn't belong to this user."
             )
@@ -135,13 +199,21 @@ class HydroponicSystemSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = HydroponicSystem
-        fields = ["id", "name", "description", "owner", "sensors", "created_at"]
+        fields = [
+            "id",
+            "name",
+            "description",
+            "owner",
+            "sensors",
+            "ingest_rate_limit",
+            "created_at",
+        ]
 
     def validate_name(self, value):
         user = self.context["request"].user
         system_id = self.instance.id if self.instance else None
 
-        if HydroponicSystem.objects.filter(owner=user, name=value).exclude(id=system_id).exists():
+        if HydroponicSystem.objects.filter(owner_id=user.id, name=value).exclude(id=system_id).exists():
             raise serializers.ValidationError(
                 "You already have a system with that name."
             )
@@ -172,6 +244,7 @@ class HydroponicSystemDetailSerializer(serializers.ModelSerializer):
             "description",
             "owner",
             "sensors",
+            "ingest_rate_limit",
             "created_at",
             "last_10_measurements",
         ]
@@ -180,9 +253,9 @@ class HydroponicSystemDetailSerializer(serializers.ModelSerializer):
         """
         Retrieves the 10 most recent measurements for all sensors in this system.
         """
-        measurements = Measurement.objects.filter(sensor__system=obj).order_by(
-            "-measured_at"
-        )[:10]
+        measurements = Measurement.objects.filter(
+            Measurement.live, sensor__system=obj
+        ).order_by("-measured_at")[:10]
         return MeasurementSerializer(measurements, many=True).data
 
     def validate_name(self, value):
@@ -192,8 +265,549 @@ class HydroponicSystemDetailSerializer(serializers.ModelSerializer):
         user = self.context["request"].user
         system_id = self.instance.id if self.instance else None
 
-        if HydroponicSystem.objects.filter(owner=user, name=value).exclude(id=system_id).exists():
+        if HydroponicSystem.objects.filter(owner_id=user.id, name=value).exclude(id=system_id).exists():
             raise serializers.ValidationError(
                 "You already have a system with that name."
             )
         return value
+
+
+class ProvisionSensorSerializer(serializers.Serializer):
+    """
+    Validates a sensor of a provisioning document.
+    """
+
+    name = serializers.CharField(max_length=100)
+    sensor_type = serializers.ChoiceField(choices=Sensor.SENSOR_TYPE_CHOICES)
+
+
+class ProvisionSystemSerializer(serializers.Serializer):
+    """
+    Validates a system of a provisioning document.
+
+    Attributes:
+        id: An existing system of the user to add the sensors to.
+        name: Name of a new system (required unless id is set).
+        description: Optional description of a new system.
+        sensors: The sensors to create in the system.
+    """
+
+    id = serializers.IntegerField(required=False)
+    name = serializers.CharField(max_length=100, required=False)
+    description = serializers.CharField(
+        required=False, allow_blank=True, allow_null=True
+    )
+    sensors = ProvisionSensorSerializer(many=True, required=False)
+
+    def validate(self, attrs):
+        """
+        Checks that the entry either names a new system or refers to an
+        existing one.
+        """
+        if ("id" in attrs) == ("name" in attrs):
+            raise serializers.ValidationError("Set exactly one of id or name.")
+        if "id" in attrs and "description" in attrs:
+            raise serializers.ValidationError(
+                "The description of an existing system cannot be changed here."
+            )
+        return attrs
+
+
+class ProvisioningSerializer(serializers.Serializer):
+    """
+    Validates a bulk provisioning document (systems with their sensors)
+    of the user given as `owner_id` in the context. Name uniqueness and
+    ownership are checked with one query each, for the whole document.
+    """
+
+    MAX_SYSTEMS = 200
+    MAX_SENSORS = 2000
+
+    systems = ProvisionSystemSerializer(many=True, allow_empty=False)
+
+    def validate_systems(self, value):
+        """
+        Checks the size of the document, that the new system names are
+        unique and that the referenced systems belong to the user.
+        """
+        if len(value) > self.MAX_SYSTEMS:
+            raise serializers.ValidationError(
+                f"At most {self.MAX_SYSTEMS} systems may be provisioned at once."
+            )
+        if sum(len(entry.get("sensors", [])) for entry in value) > self.MAX_SENSORS:
+            raise serializers.ValidationError(
+                f"At most {self.MAX_SENSORS} sensors may be provisioned at once."
+            )
+
+        owner_id = self.context["owner_id"]
+        names = [entry["name"] for entry in value if "name" in entry]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise serializers.ValidationError(
+                f"System names are repeated: {', '.join(duplicates)}."
+            )
+        existing = sorted(
+            HydroponicSystem.objects.filter(
+                owner_id=owner_id, name__in=names
+            ).values_list("name", flat=True)
+        )
+        if existing:
+            raise serializers.ValidationError(
+                f"You already have systems with these names: {', '.join(existing)}."
+            )
+
+        system_ids = {entry["id"] for entry in value if "id" in entry}
+        owned = set(
+            HydroponicSystem.objects.filter(
+                owner_id=owner_id, id__in=system_ids
+            ).values_list("id", flat=True)
+        )
+        unknown = sorted(system_ids - owned)
+        if unknown:
+            raise serializers.ValidationError(
+                f"Invalid pk {unknown[0]} - object does not exist."
+            )
+        return value
+
+
+class ProvisionedSystemSerializer(serializers.Serializer):
+    """
+    Serializer for the IDs of a provisioned system and its new sensors.
+    """
+
+    id = serializers.IntegerField()
+    sensors = serializers.ListField(child=serializers.IntegerField())
+
+
+class SystemSyncSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the systems returned by the sync endpoint.
+    """
+
+    class Meta:
+        model = HydroponicSystem
+        fields = ["id", "name", "description", "created_at", "updated_at"]
+
+
+class SensorSyncSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the sensors returned by the sync endpoint.
+    """
+
+    class Meta:
+        model = Sensor
+        fields = ["id", "system", "name", "sensor_type", "updated_at"]
+
+
+class SyncSerializer(serializers.Serializer):
+    """
+    Serializer for the response of the sync endpoint.
+
+    Attributes:
+        watermark: Watermark to pass to the next sync.
+        reset: Whether the client must drop its copy before applying
+            the changes (the previous watermark expired).
+        has_more: Whether more measurements are pending.
+        systems: Systems created or updated since the previous sync.
+        sensors: Sensors created or updated since the previous sync.
+        measurements: Measurements created or updated since the previous sync.
+        deleted: IDs of deleted systems, sensors and measurements.
+    """
+
+    watermark = serializers.CharField()
+    reset = serializers.BooleanField()
+    has_more = serializers.BooleanField()
+    systems = SystemSyncSerializer(many=True)
+    sensors = SensorSyncSerializer(many=True)
+    measurements = MeasurementSerializer(many=True)
+    deleted = serializers.DictField(child=serializers.ListField(child=serializers.IntegerField()))
+
+
+class StatsQuerySerializer(serializers.Serializer):
+    """
+    Validates query parameters of the statistics endpoints.
+
+    Attributes:
+        start: Start of the window, defaults to 24 hours before end.
+        end: End of the window, defaults to now.
+        percentiles: Comma-separated percentiles, e.g. "5,50,95".
+    """
+
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    percentiles = serializers.CharField(required=False)
+
+    def validate_percentiles(self, value):
+        """
+        Parses the percentiles into a list of floats between 0 and 100.
+        """
+        try:
+            percentiles = [float(item) for item in value.split(",") if item.strip()]
+        except ValueError:
+            raise serializers.ValidationError("Percentiles must be numbers.")
+        if not percentiles or not all(0 <= p <= 100 for p in percentiles):
+            raise serializers.ValidationError(
+                "Percentiles must be between 0 and 100."
+            )
+        return percentiles
+
+    def validate(self, attrs):
+        """
+        Fills in the default window and checks that start precedes end.
+        """
+        end = attrs.setdefault("end", timezone.now())
+        start = attrs.setdefault("start", end - timedelta(days=1))
+        attrs.setdefault("percentiles", list(DEFAULT_PERCENTILES))
+        if start >= end:
+            raise serializers.ValidationError("Start must be earlier than end.")
+        return attrs
+
+
+class LatestMeasurementsQuerySerializer(serializers.Serializer):
+    """
+    Validates query parameters of the latest measurements endpoint.
+
+    Attributes:
+        sensors: Comma-separated IDs of sensors owned by the user.
+        limit: Number of readings returned per sensor.
+        start: Optional start of the time range.
+        end: Optional end of the time range.
+    """
+
+    MAX_SENSORS = 100
+
+    sensors = serializers.CharField()
+    limit = serializers.IntegerField(default=10, min_value=1, max_value=100)
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate_sensors(self, value):
+        """
+        Parses the sensor IDs and checks their ownership in bulk.
+        """
+        try:
+            sensor_ids = list(
+                dict.fromkeys(int(item) for item in value.split(",") if item.strip())
+            )
+        except ValueError:
+            raise serializers.ValidationError("Sensor IDs must be integers.")
+        if not sensor_ids:
+            raise serializers.ValidationError("Select at least one sensor.")
+        if len(sensor_ids) > self.MAX_SENSORS:
+            raise serializers.ValidationError(
+                f"At most {self.MAX_SENSORS} sensors may be selected."
+            )
+        user_id = self.context["request"].user.id
+        owned = resolver.sensors_bulk(sensor_ids)
+        unknown = [
+            sensor_id
+            for sensor_id in sensor_ids
+            if sensor_id not in owned or owned[sensor_id].owner_id != user_id
+        ]
+        if unknown:
+            raise serializers.ValidationError(
+                f"Invalid pk {unknown[0]} - object does not exist."
+            )
+        return sensor_ids
+
+    def validate(self, attrs):
+        """
+        Checks that start precedes end.
+        """
+        start, end = attrs.get("start"), attrs.get("end")
+        if start and end and start >= end:
+            raise serializers.ValidationError("Start must be earlier than end.")
+        return attrs
+
+
+class LatestMeasurementsSerializer(serializers.Serializer):
+    """
+    Serializer for the readings of one sensor returned by the latest
+    measurements endpoint.
+    """
+
+    sensor = serializers.IntegerField()
+    measurements = MeasurementSerializer(many=True)
+
+
+class FleetSummaryQuerySerializer(serializers.Serializer):
+    """
+    Validates query parameters of the fleet summary endpoint.
+
+    Attributes:
+        ordering: "name", "stale" (systems silent the longest first) or
+            "out_of_range" (most sensors out of range first).
+    """
+
+    ordering = serializers.ChoiceField(
+        choices=["name", "stale", "out_of_range"], default="name"
+    )
+
+
+class FleetSensorTypeSerializer(serializers.Serializer):
+    """
+    Serializer for the latest reading of a sensor type in a system.
+    """
+
+    sensor_type = serializers.ChoiceField(choices=Sensor.SENSOR_TYPE_CHOICES)
+    sensor = serializers.IntegerField()
+    value = serializers.DecimalField(max_digits=9, decimal_places=2)
+    measured_at = serializers.DateTimeField()
+    in_range = serializers.BooleanField()
+
+
+class FleetSystemSerializer(serializers.Serializer):
+    """
+    Serializer for the health summary of one system.
+    """
+
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    sensor_count = serializers.IntegerField()
+    last_measured_at = serializers.DateTimeField(allow_null=True)
+    seconds_since_last = serializers.FloatField(allow_null=True)
+    out_of_range = serializers.IntegerField()
+    sensor_types = FleetSensorTypeSerializer(many=True)
+
+
+class AlertRuleSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the AlertRule model which validates:
+      - The rule targets either a sensor owned by the user or a sensor type.
+      - The parameters required by the rule kind are set.
+
+    Attributes:
+        owner: Shows the username of the owner.
+    """
+
+    owner = serializers.StringRelatedField(read_only=True)
+    sensor = OwnedSensorField(
+        queryset=Sensor.objects.all(), required=False, allow_null=True
+    )
+
+    REQUIRED_PARAMETERS = {
+        "THRESHOLD": ("min_value", "max_value"),
+        "RATE": ("max_rate",),
+        "ZSCORE": ("z_threshold",),
+    }
+
+    class Meta:
+        model = AlertRule
+        fields = [
+            "id",
+            "owner",
+            "name",
+            "sensor",
+            "sensor_type",
+            "kind",
+            "min_value",
+            "max_value",
+            "max_rate",
+            "z_threshold",
+            "min_samples",
+            "is_active",
+            "created_at",
+        ]
+        read_only_fields = ["id", "created_at"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request and hasattr(request, "user"):
+            user_id = request.user.id
+            self.fields["sensor"].queryset = Sensor.objects.filter(
+                system__owner_id=user_id
+            )
+
+    def validate(self, attrs):
+        """
+        Checks the rule target and the parameters of the rule kind.
+        """
+        sensor = attrs.get("sensor", getattr(self.instance, "sensor", None))
+        sensor_type = attrs.get(
+            "sensor_type", getattr(self.instance, "sensor_type", "")
+        )
+        if bool(sensor) == bool(sensor_type):
+            raise serializers.ValidationError(
+                "Set exactly one of sensor or sensor_type."
+            )
+
+        kind = attrs.get("kind", getattr(self.instance, "kind", None))
+        parameters = self.REQUIRED_PARAMETERS.get(kind, ())
+        if not any(
+            attrs.get(name, getattr(self.instance, name, None)) is not None
+            for name in parameters
+        ):
+            raise serializers.ValidationError(
+                f"Rule kind {kind} requires {' or '.join(parameters)}."
+            )
+        return attrs
+
+
+class AlertEventSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the AlertEvent model.
+
+    Attributes:
+        rule_name: Shows the name of the rule that raised the alert.
+    """
+
+    rule_name = serializers.CharField(source="rule.name", read_only=True)
+
+    class Meta:
+        model = AlertEvent
+        fields = [
+            "id",
+            "rule",
+            "rule_name",
+            "sensor",
+            "value",
+            "measured_at",
+            "message",
+            "created_at",
+        ]
+
+
+class MeasurementExportSerializer(serializers.Serializer):
+    """
+    Validates the parameters of a measurement export job.
+
+    Attributes:
+        system: The exported system, owned by the user.
+        sensor: Optional sensor of the system to export alone.
+        start: Optional start of the exported window.
+        end: Optional end of the exported window.
+    """
+
+    system = OwnedSystemField(queryset=HydroponicSystem.objects.all())
+    sensor = OwnedSensorField(
+        queryset=Sensor.objects.all(), required=False, allow_null=True
+    )
+    start = serializers.DateTimeField(required=False, allow_null=True)
+    end = serializers.DateTimeField(required=False, allow_null=True)
+
+    def validate(self, attrs):
+        """
+        Checks that the sensor belongs to the system and start precedes end.
+        """
+        sensor = attrs.get("sensor")
+        if sensor is not None and sensor.system_id != attrs["system"].id:
+            raise serializers.ValidationError(
+                "The sensor does not belong to the system."
+            )
+        start, end = attrs.get("start"), attrs.get("end")
+        if start and end and start >= end:
+            raise serializers.ValidationError("Start must be earlier than end.")
+        return attrs
+
+
+class SystemReportSerializer(serializers.Serializer):
+    """
+    Validates the parameters of a system report job.
+
+    Attributes:
+        system: The reported system, owned by the user.
+        start: Start of the window, defaults to 30 days before end.
+        end: End of the window, defaults to now.
+        percentiles: Percentiles to compute, e.g. [5, 50, 95].
+    """
+
+    system = OwnedSystemField(queryset=HydroponicSystem.objects.all())
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    percentiles = serializers.ListField(
+        child=serializers.FloatField(min_value=0, max_value=100),
+        required=False,
+        allow_empty=False,
+    )
+
+    def validate(self, attrs):
+        """
+        Fills in the default window and checks that start precedes end.
+        """
+        end = attrs.setdefault("end", timezone.now())
+        start = attrs.setdefault("start", end - timedelta(days=30))
+        attrs.setdefault("percentiles", list(DEFAULT_PERCENTILES))
+        if start >= end:
+            raise serializers.ValidationError("Start must be earlier than end.")
+        return attrs
+
+
+class RollupBackfillSerializer(serializers.Serializer):
+    """
+    Validates the parameters of a rollup backfill job.
+
+    Attributes:
+        hours: Number of most recent complete hours to recompute
+            (all hours not rolled up yet when omitted).
+        chunk_hours: Number of hours processed per pass.
+    """
+
+    hours = serializers.IntegerField(required=False, min_value=1)
+    chunk_hours = serializers.IntegerField(default=24, min_value=1)
+
+
+class PurgeDeletedSerializer(serializers.Serializer):
+    """
+    Validates the parameters of a purge job.
+
+    Attributes:
+        slice_hours: Hours of measurements deleted per statement.
+    """
+
+    slice_hours = serializers.IntegerField(default=24, min_value=1)
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the Job model which validates:
+      - The job kind is registered and allowed for the user.
+      - The parameters, using the serializer of the job kind.
+    """
+
+    class Meta:
+        model = Job
+        fields = [
+            "id",
+            "kind",
+            "params",
+            "status",
+            "progress",
+            "message",
+            "result",
+            "error",
+            "attempts",
+            "created_at",
+            "started_at",
+            "finished_at",
+        ]
+        read_only_fields = [
+            "id",
+            "status",
+            "progress",
+            "message",
+            "result",
+            "error",
+            "attempts",
+            "created_at",
+            "started_at",
+            "finished_at",
+        ]
+
+    def validate(self, attrs):
+        """
+        Replaces the parameters with their validated representation.
+        """
+        kind = kinds.get(attrs["kind"])
+        user = self.context["request"].user
+        if kind is None or (kind.staff_only and not user.is_staff):
+            raise serializers.ValidationError({"kind": "Unknown job kind."})
+        params = attrs.get("params") or {}
+        if kind.params_serializer is None:
+            attrs["params"] = {}
+            return attrs
+        serializer = kind.params_serializer(data=params, context=self.context)
+        if not serializer.is_valid():
+            raise serializers.ValidationError({"params": serializer.errors})
+        attrs["params"] = serializer.data
+        return attrs
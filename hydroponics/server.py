@@ -0,0 +1,99 @@
+import logging
+import os
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+from django.urls import get_resolver
+
+from .metrics import registry
+from .pooling import close_pools
+from .schema import load_schema
+from .sharding import shard_aliases
+
+"""
+Start-up and health of the application server processes.
+
+warm_up() loads everything the first request would otherwise load
+lazily, so `manage.py serve` can fork workers that are ready at once,
+and records how long the process took to get there. The liveness and
+readiness endpoints report on the process and on its databases.
+"""
+
+logger = logging.getLogger(__name__)
+
+startup_seconds = registry.gauge(
+    "hydroponics_startup_seconds",
+    "Time from the start of the process until the application was loaded.",
+)
+
+
+def process_uptime():
+    """
+    Returns the seconds since the current process was started, or None
+    where /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # Fields following the parenthesized command name, from the state.
+            fields = file.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+def warm_up():
+    """
+    Imports the URL configuration with all views, loads the OpenAPI
+    document and closes the database connections (and pools) opened
+    meanwhile, so they are not shared with forked workers.
+
+    Returns:
+        The seconds from the start of the process (of the warm-up where
+        that is unknown) until now.
+    """
+    started = time.monotonic()
+    get_resolver().url_patterns
+    load_schema()
+    connections.close_all()
+    close_pools()
+
+    seconds = process_uptime()
+    if seconds is None:
+        seconds = time.monotonic() - started
+    startup_seconds.set(round(seconds, 3))
+    logger.info("Application loaded in %.3f s.", seconds)
+    return seconds
+
+
+def has_shared_cache():
+    """
+    Returns whether the default cache is shared by the processes of the
+    application, unlike the per-process memory cache.
+    """
+    return not isinstance(caches["default"], (LocMemCache, DummyCache))
+
+
+def readiness_problems():
+    """
+    Returns descriptions of what keeps this process from serving
+    requests, i.e. the databases (shards) and the shared cache it cannot
+    reach.
+    """
+    problems = []
+    for alias in shard_aliases():
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except Exception as error:
+            problems.append(f"Database {alias} is unavailable: {error}")
+    if has_shared_cache():
+        try:
+            caches["default"].get("hydroponics:readiness")
+        except Exception as error:
+            problems.append(f"The cache is unavailable: {error}")
+    return problems
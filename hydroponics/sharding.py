@@ -0,0 +1,178 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from rest_framework.exceptions import APIException
+
+"""
+Owner-based horizontal sharding.
+
+Systems, sensors, measurements and the data derived from them are
+stored on the shard of their owner, chosen by owner ID unless the
+TenantShard map says otherwise. Users, the shard map and token versions
+stay on the default database, which is also the first shard.
+
+Queries are routed by hydroponics.routers.ShardRouter using the tenant
+of the current request (set by TenantRoutingMixin), an explicitly
+pinned shard, or the owner of the instance being saved.
+"""
+
+# Models stored on the shard of their owner.
+TENANT_MODELS = frozenset(
+    {
+        "hydroponicsystem",
+        "sensor",
+        "measurement",
+        "measurementrollup",
+        "measurementchunk",
+        "alertrule",
+        "sensorstate",
+        "alertevent",
+        "tombstone",
+    }
+)
+
+# Models kept on every shard for the data written to that shard.
+SHARD_LOCAL_MODELS = frozenset({"ingestedsegment"})
+
+_tenant = contextvars.ContextVar("hydroponics_tenant", default=None)
+_shard = contextvars.ContextVar("hydroponics_shard", default=None)
+
+
+class TenantMoving(APIException):
+    """
+    Raised on writes for a tenant that is being moved between shards.
+    """
+
+    status_code = 503
+    default_detail = "The account is being moved, please retry shortly."
+    default_code = "tenant_moving"
+
+
+def shard_aliases():
+    """
+    Returns the database aliases of all shards; ["default"] when
+    sharding is disabled.
+    """
+    return getattr(settings, "DATABASE_SHARDS", None) or ["default"]
+
+
+def is_sharded():
+    return len(shard_aliases()) > 1
+
+
+def fan_out(queryset):
+    """
+    Yields the queryset bound to each shard in turn, or the queryset
+    itself when sharding is disabled. Meant for the few lookups that
+    cannot be scoped to one owner (e.g. by a globally unique ID).
+    """
+    if not is_sharded():
+        yield queryset
+        return
+    for alias in shard_aliases():
+        yield queryset.using(alias)
+
+
+@contextmanager
+def tenant(owner_id):
+    """
+    Routes the tenant data queries within the block to the owner's shard.
+    """
+    token = _tenant.set(owner_id)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+@contextmanager
+def on_shard(alias):
+    """
+    Routes the tenant data queries within the block to the given shard.
+    """
+    token = _shard.set(alias)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+
+def current_tenant():
+    return _tenant.get()
+
+
+def pinned_shard():
+    return _shard.get()
+
+
+class TenantRoutingMixin:
+    """
+    Viewset mixin routing the queries of an authenticated request to
+    the shard of the requesting user.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self._tenant_token = _tenant.set(request.user.id)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, "_tenant_token", None)
+        if token is not None:
+            _tenant.reset(token)
+            self._tenant_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+def _sequence_state(connection, table, column):
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, column])
+        (sequence,) = cursor.fetchone()
+        if sequence is None:
+            return None, 0
+        cursor.execute(
+            f"SELECT GREATEST((SELECT COALESCE(MAX({quote(column)}), 0) "
+            f"FROM {quote(table)}), (SELECT last_value FROM {sequence}))"
+        )
+        (high,) = cursor.fetchone()
+    return sequence, high
+
+
+def interleave_sequences(using):
+    """
+    Makes the ID sequences of tenant models on a shard produce IDs equal
+    to the shard's index modulo HYDROPONICS_SHARD_ID_STRIDE, above every
+    ID used on any shard. IDs thus stay globally unique and are kept when
+    a tenant moves between shards. PostgreSQL only.
+    """
+    if not is_sharded() or using not in shard_aliases():
+        return
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return
+
+    stride = getattr(settings, "HYDROPONICS_SHARD_ID_STRIDE", 64)
+    index = shard_aliases().index(using)
+    for model in apps.get_app_config("hydroponics").get_models():
+        pk = model._meta.pk
+        if model._meta.model_name not in TENANT_MODELS or not pk.auto_created:
+            continue
+        if pk.get_internal_type() not in ("AutoField", "BigAutoField"):
+            continue
+        table = model._meta.db_table
+        sequence, _ = _sequence_state(connection, table, pk.column)
+        if sequence is None:
+            continue
+        high = max(
+            _sequence_state(connections[alias], table, pk.column)[1]
+            for alias in shard_aliases()
+        )
+        start = high + 1 + (index - high - 1) % stride
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"ALTER SEQUENCE {sequence} INCREMENT BY {int(stride)} "
+                f"RESTART WITH {int(start)}"
+            )
@@ -0,0 +1,66 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (post_delete, post_migrate, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+
+from .authentication import bump_token_version
+from .models import AlertRule, HydroponicSystem, Sensor, Tombstone
+from .ownership import resolver
+from .routers import shard_for_owner
+from .sharding import interleave_sequences, is_sharded
+
+"""
+Signal handlers keeping the ownership cache in sync with sensor
+and system changes, revoking tokens on security-relevant user
+changes, and maintaining sharded tenant data.
+"""
+
+# Changing any of these user fields revokes the user's tokens.
+TOKEN_REVOKING_FIELDS = ("password", "is_active", "is_staff", "is_superuser")
+
+
+@receiver([post_save, post_delete], sender=Sensor)
+def invalidate_sensor_ownership(sender, instance, **kwargs):
+    resolver.invalidate_sensor(instance.id)
+
+
+@receiver([post_save, post_delete], sender=HydroponicSystem)
+def invalidate_system_ownership(sender, instance, **kwargs):
+    resolver.invalidate_system(instance.id)
+
+
+@receiver(pre_save, sender=get_user_model())
+def detect_token_revoking_change(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+    previous = (
+        sender.objects.filter(pk=instance.pk).values(*TOKEN_REVOKING_FIELDS).first()
+    )
+    instance._revoke_tokens = previous is not None and any(
+        previous[field] != getattr(instance, field) for field in TOKEN_REVOKING_FIELDS
+    )
+
+
+@receiver(post_save, sender=get_user_model())
+def revoke_tokens(sender, instance, created, **kwargs):
+    if getattr(instance, "_revoke_tokens", False):
+        bump_token_version(instance.pk)
+        instance._revoke_tokens = False
+
+
+@receiver(pre_delete, sender=get_user_model())
+def delete_sharded_tenant_data(sender, instance, using, **kwargs):
+    # Data on the user's own database is removed by the regular cascade.
+    if not is_sharded():
+        return
+    shard = shard_for_owner(instance.pk)
+    if shard != using:
+        HydroponicSystem.all_objects.using(shard).filter(owner_id=instance.pk).delete()
+        AlertRule.objects.using(shard).filter(owner_id=instance.pk).delete()
+        Tombstone.objects.using(shard).filter(owner_id=instance.pk).delete()
+
+
+@receiver(post_migrate)
+def interleave_shard_sequences(sender, using, **kwargs):
+    if sender.name == "hydroponics":
+        interleave_sequences(using)
@@ -0,0 +1,118 @@
+import math
+
+"""
+Definition of a mergeable quantile sketch (DDSketch) used to answer
+percentile queries over long windows without scanning raw measurements.
+"""
+
+
+class DDSketch:
+    """
+    A quantile sketch with relative-error guarantees.
+
+    Values are mapped to logarithmically sized buckets, so every quantile
+    is returned within `relative_accuracy` of the true value. Two sketches
+    built with the same accuracy can be merged by adding bucket counts,
+    which makes hourly sketches combinable into any longer window.
+
+    Attributes:
+        relative_accuracy: Maximum relative error of returned quantiles.
+        positive: Bucket counts for values above zero.
+        negative: Bucket counts for absolute values of negative values.
+        zero_count: Number of values equal to zero.
+        count: Total number of values added.
+    """
+
+    DEFAULT_RELATIVE_ACCURACY = 0.01
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key):
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        """
+        Adds a value (optionally several times) to the sketch.
+        """
+        value = float(value)
+        if value > 0:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + count
+        elif value < 0:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + count
+        else:
+            self.zero_count += count
+        self.count += count
+
+    def merge(self, other):
+        """
+        Adds the counts of another sketch with the same accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy.")
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Returns the approximate value at quantile q (0 <= q <= 1),
+        or None for an empty sketch.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+    def to_dict(self):
+        """
+        Returns a JSON-serializable representation of the sketch.
+        """
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": {str(key): count for key, count in self.positive.items()},
+            "negative": {str(key): count for key, count in self.negative.items()},
+            "zero_count": self.zero_count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a sketch from the output of to_dict().
+        """
+        sketch = cls(data["relative_accuracy"])
+        sketch.positive = {int(key): count for key, count in data["positive"].items()}
+        sketch.negative = {int(key): count for key, count in data["negative"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = (
+            sum(sketch.positive.values())
+            + sum(sketch.negative.values())
+            + sketch.zero_count
+        )
+        return sketch
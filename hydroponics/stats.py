@@ -0,0 +1,323 @@
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import (Aggregate, Avg, Count, FloatField, Max, Min,
+                              StdDev)
+from django.db.models.functions import Cast
+
+from .chunks import chunks_overlap, series
+from .models import Measurement, MeasurementRollup
+from .sketches import DDSketch
+
+"""
+Statistics over measurement windows: exact aggregates computed in
+PostgreSQL for short windows, and hourly rollups with mergeable
+sketches for long ones.
+"""
+
+DEFAULT_PERCENTILES = (5, 50, 95)
+ROLLUP_INTERVAL = timedelta(hours=1)
+
+
+class PercentileCont(Aggregate):
+    """
+    PostgreSQL `percentile_cont` computing several continuous
+    percentiles in one pass, returned as an array of floats.
+    """
+
+    function = "PERCENTILE_CONT"
+    template = (
+        "%(function)s(ARRAY[%(fractions)s]::double precision[]) "
+        "WITHIN GROUP (ORDER BY %(expressions)s)"
+    )
+
+    def __init__(self, expression, fractions, **extra):
+        super().__init__(
+            Cast(expression, FloatField()),
+            fractions=", ".join(repr(float(fraction)) for fraction in fractions),
+            output_field=ArrayField(FloatField()),
+            **extra,
+        )
+
+
+def percentile_label(percentile):
+    """
+    Returns the response key for a percentile, e.g. 'p95' or 'p99.9'.
+    """
+    return f"p{percentile:g}"
+
+
+def floor_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(moment):
+    floored = floor_hour(moment)
+    return floored if floored == moment else floored + ROLLUP_INTERVAL
+
+
+class _Accumulator:
+    """
+    Running count, sums, extremes and sketch of a group of values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min_value = None
+        self.max_value = None
+        self.sketch = DDSketch()
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+        self.min_value = value if self.min_value is None else min(self.min_value, value)
+        self.max_value = value if self.max_value is None else max(self.max_value, value)
+        self.sketch.add(value)
+
+    def add_rollup(self, rollup):
+        self.count += rollup.count
+        self.total += rollup.total
+        self.total_sq += rollup.total_sq
+        self.min_value = (
+            rollup.min_value
+            if self.min_value is None
+            else min(self.min_value, rollup.min_value)
+        )
+        self.max_value = (
+            rollup.max_value
+            if self.max_value is None
+            else max(self.max_value, rollup.max_value)
+        )
+        self.sketch.merge(DDSketch.from_dict(rollup.sketch))
+
+    def summary(self, percentiles):
+        mean = self.total / self.count if self.count else None
+        stddev = None
+        if self.count > 1:
+            variance = (self.total_sq - self.total * self.total / self.count) / (
+                self.count - 1
+            )
+            stddev = math.sqrt(max(variance, 0.0))
+        return {
+            "count": self.count,
+            "mean": mean,
+            "stddev": stddev,
+            "min": self.min_value,
+            "max": self.max_value,
+            "percentiles": {
+                percentile_label(p): self.sketch.quantile(p / 100)
+                for p in percentiles
+            },
+        }
+
+
+def _exact_stats(measurements, percentiles, group_by):
+    group_by = f"sensor__{group_by}" if group_by else None
+    fractions = [p / 100 for p in percentiles]
+    # The aggregates run on the stored integers and are scaled back here.
+    scale = 10 ** Measurement._meta.get_field("value").decimal_places
+    aggregates = {
+        "count": Count("id"),
+        "mean": Avg(Cast("value", FloatField())),
+        "stddev": StdDev(Cast("value", FloatField()), sample=True),
+        "min": Min(Cast("value", FloatField())),
+        "max": Max(Cast("value", FloatField())),
+        "values": PercentileCont("value", fractions),
+    }
+    if group_by:
+        rows = measurements.values(group_by).annotate(**aggregates).order_by(group_by)
+    else:
+        rows = [measurements.aggregate(**aggregates)]
+
+    results = {}
+    for row in rows:
+        values = row.pop("values") or [None] * len(percentiles)
+        key = row.pop(group_by) if group_by else None
+        for name in ("mean", "stddev", "min", "max"):
+            if row[name] is not None:
+                row[name] /= scale
+        row["percentiles"] = {
+            percentile_label(p): None if value is None else value / scale
+            for p, value in zip(percentiles, values)
+        }
+        results[key] = row
+    return results
+
+
+def _percentile_cont(values, fraction):
+    position = fraction * (len(values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _merged_exact_stats(sensors, start, end, percentiles, group_by):
+    """
+    Computes the exact statistics in Python from the measurement rows
+    and chunks of the window, as _exact_stats does in the database.
+    """
+    keys = dict(sensors.values_list("id", group_by)) if group_by else {}
+    groups = {}
+    window = {"measured_at__gte": start, "measured_at__lt": end}
+    for measurement in series(sensors, window):
+        groups.setdefault(keys.get(measurement.sensor_id), []).append(
+            float(measurement.value)
+        )
+    if not group_by:
+        groups.setdefault(None, [])
+
+    results = {}
+    for key, values in sorted(groups.items(), key=lambda item: str(item[0])):
+        values.sort()
+        count = len(values)
+        mean = sum(values) / count if count else None
+        stddev = None
+        if count > 1:
+            stddev = math.sqrt(
+                sum((value - mean) ** 2 for value in values) / (count - 1)
+            )
+        results[key] = {
+            "count": count,
+            "mean": mean,
+            "stddev": stddev,
+            "min": values[0] if values else None,
+            "max": values[-1] if values else None,
+            "percentiles": {
+                percentile_label(p): (
+                    _percentile_cont(values, p / 100) if values else None
+                )
+                for p in percentiles
+            },
+        }
+    return results
+
+
+def _sketch_stats(sensors, start, end, percentiles, group_by):
+    horizon = MeasurementRollup.objects.aggregate(last=Max("bucket"))["last"]
+    rolled_from = ceil_hour(start)
+    rolled_to = rolled_from
+    if horizon is not None:
+        rolled_to = max(rolled_from, min(floor_hour(end), horizon + ROLLUP_INTERVAL))
+
+    accumulators = {}
+    rollups = MeasurementRollup.objects.filter(
+        sensor__in=sensors, bucket__gte=rolled_from, bucket__lt=rolled_to
+    )
+    if group_by:
+        rollups = rollups.select_related("sensor")
+    for rollup in rollups.iterator(chunk_size=2000):
+        key = getattr(rollup.sensor, group_by) if group_by else None
+        accumulators.setdefault(key, _Accumulator()).add_rollup(rollup)
+
+    keys = dict(sensors.values_list("id", group_by)) if group_by else {}
+    for remainder in (
+        {"measured_at__gte": start, "measured_at__lt": rolled_from},
+        {"measured_at__gte": rolled_to, "measured_at__lt": end},
+    ):
+        for measurement in series(sensors, remainder):
+            key = keys.get(measurement.sensor_id)
+            accumulators.setdefault(key, _Accumulator()).add(measurement.value)
+
+    if not accumulators and not group_by:
+        accumulators[None] = _Accumulator()
+    return {
+        key: accumulator.summary(percentiles)
+        for key, accumulator in sorted(
+            accumulators.items(), key=lambda item: str(item[0])
+        )
+    }
+
+
+def window_stats(
+    sensors, start, end, percentiles=DEFAULT_PERCENTILES, group_by=None
+):
+    """
+    Returns count, mean, sample standard deviation, extremes and
+    percentiles of the measurement values of the given sensors
+    in [start, end).
+
+    Windows up to HYDROPONICS_STATS_EXACT_WINDOW are computed exactly
+    with `percentile_cont` (in Python when the window reaches measurements
+    sealed into chunks). Longer windows combine hourly rollups with
+    the raw rows of the partial hours at the edges and of the hours
+    not rolled up yet, so percentiles come from merged sketches.
+
+    Args:
+        sensors: Sensor queryset the statistics are computed for.
+        start: Start of the window (inclusive).
+        end: End of the window (exclusive).
+        percentiles: Percentiles to compute, in the 0-100 range.
+        group_by: Optional Sensor field to group the results by.
+
+    Returns:
+        A tuple of the method used ('exact' or 'sketch') and a dict
+        of summaries keyed by group value (None when not grouped).
+    """
+    exact_window = getattr(
+        settings, "HYDROPONICS_STATS_EXACT_WINDOW", timedelta(days=7)
+    )
+    if end - start <= exact_window:
+        if chunks_overlap(sensors, start, end):
+            return "exact", _merged_exact_stats(
+                sensors, start, end, percentiles, group_by
+            )
+        window = Measurement.objects.filter(
+            sensor__in=sensors, measured_at__gte=start, measured_at__lt=end
+        )
+        return "exact", _exact_stats(window, percentiles, group_by)
+    return "sketch", _sketch_stats(sensors, start, end, percentiles, group_by)
+
+
+def build_rollups(start, end):
+    """
+    Computes (or recomputes) the hourly rollups for all sensors
+    for the hours between start and end.
+
+    Returns:
+        The number of rollup rows written.
+    """
+    start, end = floor_hour(start), floor_hour(end)
+    accumulators = {}
+    window = {"measured_at__gte": start, "measured_at__lt": end}
+    for measurement in series(None, window):
+        key = (measurement.sensor_id, floor_hour(measurement.measured_at))
+        accumulators.setdefault(key, _Accumulator()).add(measurement.value)
+    rollups = [
+        _to_rollup(key, accumulator) for key, accumulator in accumulators.items()
+    ]
+
+    MeasurementRollup.objects.bulk_create(
+        rollups,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["sensor", "bucket"],
+        update_fields=[
+            "count",
+            "total",
+            "total_sq",
+            "min_value",
+            "max_value",
+            "sketch",
+        ],
+    )
+    return len(rollups)
+
+
+def _to_rollup(key, accumulator):
+    sensor_id, bucket = key
+    return MeasurementRollup(
+        sensor_id=sensor_id,
+        bucket=bucket,
+        count=accumulator.count,
+        total=accumulator.total,
+        total_sq=accumulator.total_sq,
+        min_value=accumulator.min_value,
+        max_value=accumulator.max_value,
+        sketch=accumulator.sketch.to_dict(),
+    )
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .models import HydroponicSystem, Measurement, Sensor, Tombstone
+from .routers import placement
+
+"""
+Incremental synchronization of a user's systems, sensors and recent
+measurements for offline clients.
+
+A client passes the opaque watermark of its previous sync and receives
+what changed since: systems and sensors by their `updated_at`,
+measurements created or updated by their `changed_at` (paged by a
+(changed_at, id) cursor), and deletions from tombstones. Changes of the
+last HYDROPONICS_SYNC_LAG_SECONDS are left for the next sync, so rows
+of transactions still in flight are not skipped. Watermarks older than
+the tombstone retention, or issued before the user was moved to another
+shard, require a full resync.
+"""
+
+WATERMARK_SALT = "hydroponics.sync"
+
+
+def encode_watermark(changed_until, cursor, shard):
+    changed_at, measurement_id = cursor
+    return signing.dumps(
+        {
+            "t": changed_until.isoformat(),
+            "c": [changed_at.isoformat(), measurement_id],
+            "s": shard,
+        },
+        salt=WATERMARK_SALT,
+    )
+
+
+def decode_watermark(watermark):
+    """
+    Returns the (changed_until, cursor, shard) of a watermark, where the
+    cursor is the (changed_at, id) of the last measurement sent. Watermarks
+    of earlier versions have neither cursor nor shard.
+
+    Raises:
+        ValidationError: if the watermark is malformed or tampered with.
+    """
+    try:
+        data = signing.loads(watermark, salt=WATERMARK_SALT)
+        changed_until = datetime.fromisoformat(data["t"])
+        if "c" not in data:
+            return changed_until, None, None
+        changed_at, measurement_id = data["c"]
+        cursor = (datetime.fromisoformat(changed_at), int(measurement_id))
+        return changed_until, cursor, data["s"]
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise ValidationError({"watermark": "Invalid watermark."})
+
+
+def changes_since(owner_id, watermark=None):
+    """
+    Collects the changes of a user's data since a watermark (everything
+    on a full sync).
+
+    Args:
+        owner_id: The ID of the user.
+        watermark: The watermark returned by the previous sync, or None.
+
+    Returns:
+        A dict with the changed systems, sensors and measurements (model
+        instances), the IDs of deleted objects per kind, whether the
+        client must drop its copy first (`reset`), whether more
+        measurements are pending (`has_more`) and the next watermark.
+    """
+    now = timezone.now()
+    changed_until = now - timedelta(
+        seconds=getattr(settings, "HYDROPONICS_SYNC_LAG_SECONDS", 5)
+    )
+    retention = timedelta(days=getattr(settings, "HYDROPONICS_SYNC_TOMBSTONE_DAYS", 30))
+    shard = placement(owner_id).shard
+    since = cursor = None
+    if watermark:
+        since, cursor, issued_on = decode_watermark(watermark)
+        # IDs and times are only comparable with those of the same shard.
+        reset = since < now - retention or issued_on != shard
+    else:
+        reset = False
+    if reset:
+        since = cursor = None
+
+    systems = HydroponicSystem.objects.filter(
+        owner_id=owner_id, updated_at__lte=changed_until
+    )
+    sensors = Sensor.objects.filter(
+        system__owner_id=owner_id, updated_at__lte=changed_until
+    )
+    tombstones = Tombstone.objects.filter(
+        owner_id=owner_id, deleted_at__lte=changed_until
+    )
+    if since is not None:
+        systems = systems.filter(updated_at__gt=since)
+        sensors = sensors.filter(updated_at__gt=since)
+        tombstones = tombstones.filter(deleted_at__gt=since)
+    else:
+        tombstones = tombstones.none()
+
+    if cursor is None:
+        days = getattr(settings, "HYDROPONICS_SYNC_INITIAL_DAYS", 7)
+        cursor = (now - timedelta(days=days), 0)
+    changed_at, measurement_id = cursor
+    sensor_ids = list(
+        Sensor.objects.filter(system__owner_id=owner_id).values_list("id", flat=True)
+    )
+    after = Q(changed_at__gt=changed_at) | Q(
+        changed_at=changed_at, id__gt=measurement_id
+    )
+    page_size = getattr(settings, "HYDROPONICS_SYNC_PAGE_SIZE", 1000)
+    measurements = list(
+        Measurement.objects.filter(
+            after,
+            sensor_id__in=sensor_ids,
+            changed_at__lte=changed_until,
+        ).order_by("changed_at", "id")[: page_size + 1]
+    )
+    has_more = len(measurements) > page_size
+    measurements = measurements[:page_size]
+    if measurements:
+        cursor = (measurements[-1].changed_at, measurements[-1].id)
+
+    deleted = {f"{kind}s": [] for kind, _ in Tombstone.KIND_CHOICES}
+    for kind, object_id in tombstones.order_by("deleted_at").values_list(
+        "kind", "object_id"
+    ):
+        deleted[f"{kind}s"].append(object_id)
+
+    return {
+        "reset": reset,
+        "has_more": has_more,
+        "systems": list(systems.order_by("updated_at", "id")),
+        "sensors": list(sensors.order_by("updated_at", "id")),
+        "measurements": measurements,
+        "deleted": deleted,
+        "watermark": encode_watermark(changed_until, cursor, shard),
+    }
@@ -0,0 +1,147 @@
+import csv
+import gzip
+import io
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import call_command
+from django.utils.dateparse import parse_datetime
+
+from .chunks import count_series, series
+from .deletion import purge_pending_deletions
+from .jobs import register, report_progress
+from .models import HydroponicSystem, Sensor
+from .serializers import (MeasurementExportSerializer, PurgeDeletedSerializer,
+                          RollupBackfillSerializer, SystemReportSerializer)
+from .stats import window_stats
+
+"""
+Built-in background job kinds (see hydroponics.jobs).
+"""
+
+EXPORT_PROGRESS_ROWS = 5000
+
+
+def files_dir():
+    """
+    Returns the directory where jobs store the files they produce.
+    """
+    return Path(settings.HYDROPONICS_JOB_FILES_DIR)
+
+
+def _owned_system(job):
+    """
+    Returns the system named by the job parameters if it is still
+    owned by the user who enqueued the job.
+    """
+    return HydroponicSystem.objects.get(pk=job.params["system"], owner_id=job.owner_id)
+
+
+@register("export_measurements", MeasurementExportSerializer)
+def export_measurements(job):
+    """
+    Writes the measurements of a system (or one of its sensors),
+    including those sealed into chunks, to a gzip-compressed CSV file,
+    downloadable through the jobs API.
+    """
+    system = _owned_system(job)
+    sensors = Sensor.objects.filter(system=system)
+    if job.params.get("sensor"):
+        sensors = sensors.filter(id=job.params["sensor"])
+    lookups = {}
+    if job.params.get("start"):
+        lookups["measured_at__gte"] = parse_datetime(job.params["start"])
+    if job.params.get("end"):
+        lookups["measured_at__lt"] = parse_datetime(job.params["end"])
+
+    total = count_series(sensors, lookups)
+    names = {
+        sensor_id: (name, sensor_type)
+        for sensor_id, name, sensor_type in sensors.values_list(
+            "id", "name", "sensor_type"
+        )
+    }
+    directory = files_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"job-{job.pk}-measurements.csv.gz"
+    partial = directory / f"{name}.partial"
+    written = 0
+    with gzip.open(partial, "wt", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            ["sensor", "sensor_name", "sensor_type", "measured_at", "value"]
+        )
+        for measurement in series(sensors, lookups):
+            sensor_name, sensor_type = names[measurement.sensor_id]
+            writer.writerow(
+                [
+                    measurement.sensor_id,
+                    sensor_name,
+                    sensor_type,
+                    measurement.measured_at.isoformat(),
+                    measurement.value,
+                ]
+            )
+            written += 1
+            if written % EXPORT_PROGRESS_ROWS == 0:
+                report_progress(
+                    job, written / total, f"Exported {written} of {total} measurements."
+                )
+    os.replace(partial, directory / name)
+    return {"file": name, "rows": written}
+
+
+@register("system_report", SystemReportSerializer)
+def system_report(job):
+    """
+    Computes the statistics of a system's measurements per sensor type
+    over a window too long to be computed within a request.
+    """
+    system = _owned_system(job)
+    params = job.params
+    start, end = parse_datetime(params["start"]), parse_datetime(params["end"])
+    method, results = window_stats(
+        Sensor.objects.filter(system=system),
+        start,
+        end,
+        params["percentiles"],
+        group_by="sensor_type",
+    )
+    return {
+        "system": system.id,
+        "start": start,
+        "end": end,
+        "method": method,
+        "results": [
+            {"sensor_type": sensor_type, **summary}
+            for sensor_type, summary in results.items()
+        ],
+    }
+
+
+@register("rollup_backfill", RollupBackfillSerializer, staff_only=True)
+def rollup_backfill(job):
+    """
+    Builds the hourly measurement rollups (see rollup_measurements).
+    """
+    output = io.StringIO()
+    call_command(
+        "rollup_measurements",
+        hours=job.params.get("hours"),
+        chunk_hours=job.params.get("chunk_hours", 24),
+        stdout=output,
+    )
+    return {"output": output.getvalue().strip()}
+
+
+@register("purge_deleted", PurgeDeletedSerializer, staff_only=True)
+def purge_deleted(job):
+    """
+    Deletes the systems and sensors marked for deletion.
+    """
+    systems, sensors, measurements = purge_pending_deletions(
+        timedelta(hours=job.params.get("slice_hours", 24))
+    )
+    return {"systems": systems, "sensors": sensors, "measurements": measurements}
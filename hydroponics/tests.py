@@ -1,3 +1,2026 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Max, Min
+from django.http import HttpResponse
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import Throttled
+from rest_framework.test import APITestCase
+
+from .admin import IndexedDatesQuerySet
+from .alerts import check_rule, update_state
+from .archive import _columns as archive_columns
+from .archive import (archive_lock, archive_sensor, archived_segments,
+                      compact_manifest, month_start)
+from .authentication import current_token_version
+from .budgets import query_budget
+from .chunks import compact_sensor, period_start, series
+from .deletion import delete_measurements, purge_pending_deletions
+from .encoding import (archive_readings, decode_archive,
+                       decode_archive_columns, decode_chunk, encode_archive,
+                       encode_chunk)
+from .ingest import (IngestionLog, WriteBehindBuffer, flush_log, to_record,
+                     write_measurements)
+from .jobs import claim, enqueue, register, run, work
+from .line_protocol import LineProtocolServer, Session
+from .metrics import Registry, collect, registry
+from .models import (AlertEvent, AlertRule, HydroponicSystem, IngestedSegment,
+                     Job, Measurement, MeasurementRollup, Sensor, SensorState,
+                     TenantShard, Tombstone)
+from .ownership import LRUCache, OwnershipResolver
+from .pooling import close_pools, pools
+from .profiling import profiling_user, rotate
+from .readings import latest_measurements
+from .routers import (PIN_COOKIE, ReplicaRouter, ReplicaRoutingMiddleware,
+                      ShardRouter, invalidate_placement, shard_for_owner,
+                      use_replicas)
+from .schema import load_schema
+from .sharding import TenantMoving, fan_out, on_shard, tenant
+from .sketches import DDSketch
+from .stats import floor_hour, window_stats
+from .sync import changes_since
+from .throttling import throttle
+from .views import MeasurementViewSet
+
+
+def create_sensor(username, sensor_type="PH"):
+    """
+    Creates a user with a system and a sensor, and returns the sensor.
+    """
+    owner = User.objects.create_user(username, password="secret")
+    system = HydroponicSystem.objects.create(owner=owner, name="Greenhouse")
+    return Sensor.objects.create(system=system, name="Probe", sensor_type=sensor_type)
+
+
+class OpenAPISchemaTests(SimpleTestCase):
+    def test_committed_schema_matches_the_code(self):
+        call_command("generate_schema", "--check")
+
+
+class OpenAPISchemaViewTests(TestCase):
+    def test_schema_is_revalidated_with_etag(self):
+        response = self.client.get("/api/schema.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, load_schema()[0])
+        etag = response["ETag"]
+
+        response = self.client.get("/api/schema.json", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class RollupMeasurementsTests(TestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.hour = floor_hour(timezone.now())
+
+    def roll_up(self):
+        call_command("rollup_measurements", stdout=StringIO())
+
+    def rollup(self, hours_ago):
+        return MeasurementRollup.objects.get(
+            sensor=self.sensor, bucket=self.hour - timedelta(hours=hours_ago)
+        )
+
+    def test_backdated_readings_are_rolled_up(self):
+        for hours_ago in (30, 2):
+            Measurement.objects.create(
+                sensor=self.sensor,
+                value=6,
+                measured_at=self.hour - timedelta(hours=hours_ago, minutes=-5),
+            )
+        self.roll_up()
+        self.assertEqual(self.rollup(30).count, 1)
+
+        # Stored late, e.g. by an offline client, in an hour rolled up before.
+        Measurement.objects.create(
+            sensor=self.sensor,
+            value=7,
+            measured_at=self.hour - timedelta(hours=30, minutes=-10),
+        )
+        self.roll_up()
+        self.assertEqual(self.rollup(30).count, 2)
+        self.assertEqual(self.rollup(30).max_value, 7)
+
+    def test_lookback_window_is_configurable(self):
+        for hours_ago in (3, 1):
+            Measurement.objects.create(
+                sensor=self.sensor,
+                value=6,
+                measured_at=self.hour - timedelta(hours=hours_ago),
+            )
+        self.roll_up()
+        Measurement.objects.create(
+            sensor=self.sensor, value=7, measured_at=self.hour - timedelta(hours=3)
+        )
+        with self.settings(HYDROPONICS_ROLLUP_LOOKBACK_HOURS=1):
+            self.roll_up()
+        self.assertEqual(self.rollup(3).count, 1)
+
+
+class DDSketchTests(SimpleTestCase):
+    def test_quantiles_are_within_the_relative_accuracy(self):
+        values = [-5.0, 0.0] + [value / 10 for value in range(1, 1001)]
+        sketch = DDSketch()
+        for value in values:
+            sketch.add(value)
+        for q in (0.05, 0.5, 0.95, 1):
+            exact = sorted(values)[round(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), exact, delta=abs(exact) * 0.01)
+        self.assertAlmostEqual(sketch.quantile(0), -5, delta=0.05)
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+    def test_merged_sketches_equal_one_sketch_of_all_values(self):
+        whole, first, second = DDSketch(), DDSketch(), DDSketch()
+        for value in range(1, 201):
+            whole.add(value)
+            (first if value % 2 else second).add(value)
+        first.merge(DDSketch.from_dict(second.to_dict()))
+        self.assertEqual(first.to_dict(), whole.to_dict())
+        self.assertEqual(first.count, 200)
+
+    def test_sketches_of_different_accuracy_are_not_merged(self):
+        with self.assertRaises(ValueError):
+            DDSketch(0.01).merge(DDSketch(0.02))
+
+
+class WindowStatsTests(TestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower", sensor_type="TEMP")
+        self.end = floor_hour(timezone.now()) - timedelta(hours=1, minutes=30)
+        self.start = self.end - timedelta(days=10)
+        # One reading every 30 minutes, cycling from 10.0 to 29.9.
+        self.values = [10 + index % 200 / 10 for index in range(480)]
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=self.sensor,
+                value=Decimal(str(value)),
+                measured_at=self.start + timedelta(minutes=30 * index),
+            )
+            for index, value in enumerate(self.values)
+        )
+        self.sensors = Sensor.objects.filter(id=self.sensor.id)
+
+    def test_long_window_combines_rollups_and_raw_edges(self):
+        call_command("rollup_measurements", stdout=StringIO())
+        method, stats = window_stats(self.sensors, self.start, self.end)
+        self.assertEqual(method, "sketch")
+        summary = stats[None]
+        self.assertEqual(summary["count"], 480)
+        self.assertAlmostEqual(summary["mean"], statistics.mean(self.values))
+        self.assertAlmostEqual(summary["stddev"], statistics.stdev(self.values))
+        self.assertEqual((summary["min"], summary["max"]), (10, 29.9))
+        median = statistics.median(self.values)
+        self.assertAlmostEqual(
+            summary["percentiles"]["p50"], median, delta=median * 0.01
+        )
+
+    def test_hours_not_rolled_up_yet_are_read_raw(self):
+        method, stats = window_stats(self.sensors, self.start, self.end)
+        self.assertEqual(method, "sketch")
+        self.assertEqual(stats[None]["count"], 480)
+
+
+class AlertRuleCheckTests(SimpleTestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.state = SensorState()
+        for minute, value in enumerate([6.0, 6.2, 5.8, 6.1, 5.9]):
+            update_state(
+                self.state, value, self.now - timedelta(minutes=5 - minute), 1000
+            )
+
+    def test_running_state_matches_the_exact_statistics(self):
+        values = [6.0, 6.2, 5.8, 6.1, 5.9]
+        self.assertEqual(self.state.count, 5)
+        self.assertAlmostEqual(self.state.mean, statistics.mean(values))
+        self.assertAlmostEqual(
+            self.state.m2 / (self.state.count - 1), statistics.variance(values)
+        )
+        self.assertEqual(self.state.last_value, 5.9)
+
+    def test_late_reading_does_not_replace_the_last_one(self):
+        update_state(self.state, 9.0, self.now - timedelta(hours=1), 1000)
+        self.assertEqual(self.state.last_value, 5.9)
+
+    def test_decayed_state_stays_bounded(self):
+        state = SensorState()
+        for index in range(100):
+            update_state(state, 6 + index % 2, self.now, 10)
+        self.assertEqual(state.count, 10)
+        self.assertAlmostEqual(state.mean, 6.5, delta=0.1)
+
+    def test_threshold(self):
+        rule = AlertRule(kind="THRESHOLD", min_value=5.5, max_value=6.5)
+        self.assertIsNone(check_rule(rule, self.state, 6.0, self.now))
+        self.assertIn("below", check_rule(rule, self.state, 5.0, self.now))
+        self.assertIn("above", check_rule(rule, self.state, 7.0, self.now))
+
+    def test_rate_of_change(self):
+        rule = AlertRule(kind="RATE", max_rate=0.5)
+        self.assertIsNone(check_rule(rule, self.state, 6.2, self.now))
+        self.assertIsNotNone(check_rule(rule, self.state, 7.0, self.now))
+        # Readings older than the last one have no rate.
+        earlier = self.now - timedelta(hours=1)
+        self.assertIsNone(check_rule(rule, self.state, 9.0, earlier))
+
+    def test_zscore_needs_min_samples(self):
+        rule = AlertRule(kind="ZSCORE", z_threshold=3, min_samples=5)
+        self.assertIsNone(check_rule(rule, self.state, 6.1, self.now))
+        self.assertIsNotNone(check_rule(rule, self.state, 8.0, self.now))
+        rule.min_samples = 6
+        self.assertIsNone(check_rule(rule, self.state, 8.0, self.now))
+
+
+class AlertEvaluationTests(TestCase):
+    def test_rules_of_the_sensor_and_of_its_type_are_evaluated(self):
+        sensor = create_sensor("grower")
+        owner = sensor.system.owner
+        AlertRule.objects.create(
+            owner=owner, name="Low", sensor=sensor, kind="THRESHOLD", min_value=5
+        )
+        AlertRule.objects.create(
+            owner=owner, name="High", sensor_type="PH", kind="THRESHOLD", max_value=7
+        )
+        AlertRule.objects.create(
+            owner=owner,
+            name="Off",
+            sensor=sensor,
+            kind="THRESHOLD",
+            max_value=1,
+            is_active=False,
+        )
+        now = timezone.now()
+        write_measurements(
+            [
+                Measurement(sensor=sensor, value=Decimal(value), measured_at=now)
+                for value in ("4", "6", "8")
+            ]
+        )
+        self.assertEqual(
+            sorted(AlertEvent.objects.values_list("rule__name", "value")),
+            [("High", 8.0), ("Low", 4.0)],
+        )
+        self.assertEqual(SensorState.objects.get(sensor=sensor).count, 3)
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+        self.assertEqual((cache.get(1), cache.get(2), cache.get(3)), ("a", None, "c"))
+
+    def test_entries_expire(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        with mock.patch("hydroponics.ownership.time.monotonic", return_value=0):
+            cache.set(1, "a")
+        with mock.patch("hydroponics.ownership.time.monotonic", return_value=61):
+            self.assertIsNone(cache.get(1))
+
+    def test_delete_where(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        for key in range(4):
+            cache.set(key, key % 2)
+        cache.delete_where(lambda value: value == 1)
+        self.assertEqual([cache.get(key) for key in range(4)], [0, None, 0, None])
+
+
+class OwnershipResolverTests(TestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.owner_id = self.sensor.system.owner_id
+        self.resolver = OwnershipResolver()
+
+    def test_lookups_are_cached(self):
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                entry = self.resolver.sensor(self.sensor.id)
+        self.assertEqual(entry.owner_id, self.owner_id)
+        self.assertEqual(entry.system_id, self.sensor.system_id)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.resolver.owns_system(self.owner_id, entry.system_id))
+
+    def test_missing_objects_are_not_cached(self):
+        self.assertIsNone(self.resolver.sensor_owner(self.sensor.id + 1000))
+        self.assertFalse(self.resolver.owns_sensor(None, self.sensor.id))
+        with self.assertNumQueries(1):
+            self.resolver.sensor_owner(self.sensor.id + 1000)
+
+    def test_moved_sensor_is_invalidated(self):
+        other = create_sensor("neighbour")
+        self.resolver.sensor(self.sensor.id)
+        with mock.patch("hydroponics.signals.resolver", self.resolver):
+            self.sensor.system = other.system
+            self.sensor.save()
+        self.assertEqual(
+            self.resolver.sensor_owner(self.sensor.id), other.system.owner_id
+        )
+
+    def test_changes_in_other_processes_clear_the_cache(self):
+        other = create_sensor("neighbour")
+        self.resolver.sensor(self.sensor.id)
+        Sensor.objects.filter(id=self.sensor.id).update(system=other.system)
+        # The process that moved the sensor announces it on commit.
+        with self.captureOnCommitCallbacks(execute=True):
+            OwnershipResolver().invalidate_sensor(self.sensor.id)
+        self.assertEqual(
+            self.resolver.sensor_owner(self.sensor.id), other.system.owner_id
+        )
+        with self.assertNumQueries(0):
+            self.resolver.sensor_owner(self.sensor.id)
+
+    def test_system_invalidation_drops_its_sensors(self):
+        self.resolver.sensor(self.sensor.id)
+        self.resolver.invalidate_system(self.sensor.system_id)
+        with self.assertNumQueries(1):
+            self.resolver.sensor(self.sensor.id)
+
+
+class AlertEventFilterTests(APITestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.other_sensor = create_sensor("neighbour")
+        self.user = self.sensor.system.owner
+        self.rule = AlertRule.objects.create(
+            owner=self.user, name="pH", sensor=self.sensor, kind="THRESHOLD"
+        )
+        self.other_rule = AlertRule.objects.create(
+            owner=self.other_sensor.system.owner,
+            name="pH",
+            sensor=self.other_sensor,
+            kind="THRESHOLD",
+        )
+        self.client.force_authenticate(self.user)
+
+    def test_own_objects_are_accepted(self):
+        for parameter, value in (
+            ("rule", self.rule.id),
+            ("sensor", self.sensor.id),
+            ("sensor__system", self.sensor.system_id),
+        ):
+            response = self.client.get("/api/alert-events/", {parameter: value})
+            self.assertEqual(response.status_code, 200, parameter)
+
+    def test_objects_of_other_users_are_rejected(self):
+        for parameter, value in (
+            ("rule", self.other_rule.id),
+            ("sensor", self.other_sensor.id),
+            ("sensor__system", self.other_sensor.system_id),
+        ):
+            response = self.client.get("/api/alert-events/", {parameter: value})
+            self.assertEqual(response.status_code, 400, parameter)
+            self.assertIn(parameter, response.json())
+
+
+class IngestionLogTests(TestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.log = IngestionLog(self.directory)
+
+    def records(self, *values):
+        now = timezone.now()
+        return [to_record(self.sensor.id, value, now) for value in values]
+
+    def segment(self, records):
+        self.log.append(records)
+        self.log.rotate()
+
+    def test_sealed_segments_are_written_once(self):
+        self.segment(self.records("6.10", "6.20"))
+        self.assertEqual(flush_log(self.log), 2)
+        self.assertEqual(Measurement.objects.count(), 2)
+        self.assertEqual(self.log.pending_segments(), 0)
+        self.assertEqual(IngestedSegment.objects.count(), 1)
+
+    def test_segment_already_ingested_is_not_written_again(self):
+        self.segment(self.records("6.10"))
+        name = next(self.directory.glob("*.sealed")).stem
+        IngestedSegment.objects.create(name=name, rows=1)
+        self.assertEqual(flush_log(self.log), 0)
+        self.assertFalse(Measurement.objects.exists())
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_orphaned_segments_are_recovered(self):
+        # Left behind by a process that died while writing or flushing.
+        (self.directory / "1-1-1.active").write_text("")
+        (self.directory / "1-2-1.flushing").write_text("")
+        self.log.recover_orphans()
+        self.assertEqual(self.log.pending_segments(), 2)
+
+    def test_failing_segment_does_not_block_later_ones(self):
+        self.segment([{"s": self.sensor.id, "v": "x", "t": "2024-01-01T00:00:00Z"}])
+        self.segment(self.records("6.10"))
+        with self.settings(HYDROPONICS_INGEST_MAX_ATTEMPTS=2), self.assertLogs(
+            "hydroponics.ingest", "ERROR"
+        ):
+            self.assertEqual(flush_log(self.log), 1)
+            self.assertEqual(self.log.pending_segments(), 1)
+            self.assertEqual(self.log.failed_segments(), 0)
+
+            self.assertEqual(flush_log(self.log), 0)
+        self.assertEqual(self.log.pending_segments(), 0)
+        self.assertEqual(self.log.failed_segments(), 1)
+        self.assertEqual(Measurement.objects.count(), 1)
+
+        self.assertEqual(self.log.retry_failed(), 1)
+        self.assertEqual(self.log.pending_segments(), 1)
+
+    def test_buffer_counts_readings_until_flushed(self):
+        buffer = WriteBehindBuffer(self.directory, 3600, 1000)
+        # Flushed by the test rather than by a background thread.
+        buffer._thread = True
+        buffer.submit(self.records("6.10", "6.20"))
+        self.assertEqual(buffer._pending, 2)
+        buffer.flush()
+        self.assertEqual((buffer._pending, buffer._in_flight), (0, 0))
+        self.assertEqual(Measurement.objects.count(), 2)
+
+
+class LineProtocolServerTests(TransactionTestCase):
+    # The server writes from worker threads, with their own connections.
+
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.key = self.sensor.issue_api_key()
+        self.server = LineProtocolServer(flush_interval=3600)
+
+    def serve(self, client):
+        """
+        Runs the server on free localhost ports while the client coroutine
+        runs, then writes the pending readings.
+        """
+
+        async def scenario():
+            ready = asyncio.Event()
+            serving = asyncio.create_task(
+                self.server.serve("127.0.0.1", 0, 0, ready=ready)
+            )
+            await ready.wait()
+            try:
+                return await client()
+            finally:
+                serving.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await serving
+
+        return asyncio.run(scenario())
+
+    def test_tcp_readings_are_written(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(
+                *self.server.addresses["tcp"]
+            )
+            writer.write(
+                f"AUTH {self.sensor.id} {self.key}\n"
+                f"{self.sensor.id} 6.5\n"
+                f"{self.sensor.id} 20\n"
+                f"{self.sensor.id} 6.6 1700000000\n".encode()
+            )
+            writer.write_eof()
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+
+        response = self.serve(client)
+        self.assertRegex(response, r"^ERR 3 ")
+        self.assertEqual(
+            sorted(Measurement.objects.values_list("value", flat=True)),
+            [Decimal("6.50"), Decimal("6.60")],
+        )
+
+    def test_overlong_tcp_line_is_rejected(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(
+                *self.server.addresses["tcp"]
+            )
+            writer.write(b"1" * 100_000 + b"\n")
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+
+        self.assertEqual(self.serve(client), "ERR 1 Line too long.\n")
+
+    def test_udp_datagram_is_a_session(self):
+        async def client():
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol,
+                remote_addr=self.server.addresses["udp"],
+            )
+            transport.sendto(f"AUTH {self.sensor.id} {self.key}\n".encode())
+            transport.sendto(f"{self.sensor.id} 6.1\n".encode())
+            transport.sendto(
+                f"AUTH {self.sensor.id} {self.key}\n{self.sensor.id} 6.2\n".encode()
+            )
+            for _ in range(100):
+                if self.server._pending:
+                    break
+                await asyncio.sleep(0.01)
+            transport.close()
+
+        self.serve(client)
+        self.assertEqual(
+            list(Measurement.objects.values_list("value", flat=True)),
+            [Decimal("6.20")],
+        )
+
+    def test_blocks_are_throttled_once_off_the_event_loop(self):
+        calls = []
+
+        def record(owner_id, readings):
+            calls.append((owner_id, readings, threading.current_thread()))
+
+        text = f"AUTH {self.sensor.id} {self.key}\n" + f"{self.sensor.id} 6.5\n" * 3
+        with mock.patch("hydroponics.line_protocol.throttle", side_effect=record):
+            errors = asyncio.run(self.server.process_text(Session(), text))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.server._pending), 3)
+        [(owner_id, readings, thread)] = calls
+        self.assertEqual(owner_id, self.sensor.system.owner_id)
+        self.assertEqual(readings, {self.sensor.id: (None, 3)})
+        self.assertIsNot(thread, threading.main_thread())
+
+    @override_settings(HYDROPONICS_SENSOR_RATE_LIMIT=60)
+    def test_throttled_blocks_are_rejected(self):
+        cache.clear()
+        text = f"AUTH {self.sensor.id} {self.key}\n" + f"{self.sensor.id} 6.5\n" * 20
+        session = Session()
+        self.assertEqual(asyncio.run(self.server.process_text(session, text)), [])
+        errors = asyncio.run(
+            self.server.process_text(session, f"{self.sensor.id} 6.5\n" * 2)
+        )
+        self.assertEqual(len(errors), 2)
+        for number, error in enumerate(errors, start=1):
+            self.assertRegex(error, rf"^ERR {number} The sensor rate limit is exceeded")
+        self.assertEqual(len(self.server._pending), 20)
+
+    def test_failing_readings_do_not_drop_the_batch(self):
+        other = create_sensor("neighbour")
+        now = timezone.now()
+        self.server._pending = [
+            Measurement(
+                sensor_id=self.sensor.id, value=Decimal("6.5"), measured_at=now
+            ),
+            # A sensor deleted while its key was still cached.
+            Measurement(sensor_id=other.id, value=Decimal("6.5"), measured_at=now),
+            Measurement(sensor_id=self.sensor.id, value="bad", measured_at=now),
+            Measurement(
+                sensor_id=self.sensor.id, value=Decimal("6.7"), measured_at=now
+            ),
+        ]
+        other.delete()
+        with self.assertLogs("hydroponics.line_protocol", "WARNING"):
+            asyncio.run(self.server.flush())
+        self.assertEqual(
+            sorted(Measurement.objects.values_list("value", flat=True)),
+            [Decimal("6.50"), Decimal("6.70")],
+        )
+        self.assertEqual(self.server._pending, [])
+
+
+class TokenRevocationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("grower", password="secret")
+
+    def obtain(self, password="secret"):
+        response = self.client.post(
+            "/api/token/", {"username": "grower", "password": password}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get_systems(self, access):
+        return self.client.get("/api/systems/", HTTP_AUTHORIZATION=f"Bearer {access}")
+
+    def test_changing_the_password_revokes_issued_tokens(self):
+        tokens = self.obtain()
+        self.assertEqual(self.get_systems(tokens["access"]).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password("changed")
+            self.user.save()
+
+        self.assertEqual(self.get_systems(tokens["access"]).status_code, 401)
+        response = self.client.post(
+            "/api/token/refresh/", {"refresh": tokens["refresh"]}
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(
+            self.get_systems(self.obtain("changed")["access"]).status_code, 200
+        )
+
+    def test_other_processes_see_the_revocation_within_the_ttl(self):
+        # A process with its own cache, which the revocation does not reach.
+        other_process = LocMemCache("other-process", {})
+        with mock.patch("hydroponics.authentication.cache", other_process):
+            self.assertEqual(current_token_version(self.user.id), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        self.assertEqual(current_token_version(self.user.id), 1)
+
+        now = time.time()
+        ttl = settings.HYDROPONICS_TOKEN_VERSION_CACHE_TTL
+        with mock.patch("hydroponics.authentication.cache", other_process):
+            with mock.patch("time.time", return_value=now + ttl - 1):
+                self.assertEqual(current_token_version(self.user.id), 0)
+            with mock.patch("time.time", return_value=now + ttl + 1):
+                self.assertEqual(current_token_version(self.user.id), 1)
+
+
+class ServeCommandTests(SimpleTestCase):
+    def test_several_workers_require_a_shared_cache(self):
+        with self.settings(
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+            }
+        ):
+            with self.assertRaisesMessage(CommandError, "REDIS_URL"):
+                call_command("serve", "--workers", "2")
+
+    def test_static_files_must_be_collected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            missing = Path(directory) / "static"
+            with self.settings(STATIC_ROOT=missing):
+                with self.assertRaisesMessage(CommandError, "collectstatic"):
+                    call_command("serve", "--workers", "1")
+
+    def test_workers_share_their_metrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stale = Path(directory) / "metrics" / "1234.json"
+            stale.parent.mkdir()
+            stale.write_text("[]")
+            with self.settings(
+                STATIC_ROOT=directory, HYDROPONICS_METRICS_DIR=stale.parent
+            ), mock.patch(
+                "hydroponics.management.commands.serve.PreloadedApplication"
+            ) as application:
+                call_command("serve", "--workers", "1", stdout=StringIO())
+            self.assertFalse(stale.exists())
+        options = application.call_args.args[1]
+        self.assertEqual(
+            (options["post_fork"].__name__, options["worker_exit"].__name__),
+            ("share_metrics", "unshare_metrics"),
+        )
+
+    def test_production_requires_allowed_hosts(self):
+        environment = {
+            **os.environ,
+            "PROFILE": "production",
+            "SECRET_KEY": "production-secret",
+            "ALLOWED_HOSTS": "",
+        }
+        check = [sys.executable, "-c", "import hydroponic_system.settings"]
+        result = subprocess.run(
+            check,
+            env=environment,
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("Set ALLOWED_HOSTS", result.stderr)
+        environment["ALLOWED_HOSTS"] = "hydroponics.example.com"
+        result = subprocess.run(check, env=environment, cwd=settings.BASE_DIR)
+        self.assertEqual(result.returncode, 0)
+
+
+class HealthEndpointTests(TestCase):
+    def test_liveness_and_readiness(self):
+        self.assertEqual(self.client.get("/healthz").json(), {"status": "ok"})
+        self.assertEqual(self.client.get("/readyz").json(), {"status": "ok"})
+
+    def test_unreachable_database_is_not_ready(self):
+        with mock.patch("hydroponics.server.connections") as databases:
+            databases.__getitem__.return_value.cursor.side_effect = OperationalError(
+                "Connection refused."
+            )
+            response = self.client.get("/readyz")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Connection refused.", response.json()["problems"][0])
+        # Liveness does not depend on the database.
+        with mock.patch("hydroponics.server.connections") as databases:
+            databases.__getitem__.side_effect = OperationalError
+            self.assertEqual(self.client.get("/healthz").status_code, 200)
+
+    def test_collected_static_files_are_served(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(STATIC_ROOT=directory), self.modify_settings(
+                MIDDLEWARE={"prepend": "whitenoise.middleware.WhiteNoiseMiddleware"}
+            ):
+                call_command("collectstatic", "--noinput", verbosity=0)
+                response = self.client.get("/static/admin/css/base.css")
+                self.assertEqual(response.status_code, 200)
+                self.assertIn("max-age", response["Cache-Control"])
+                response.close()
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"], HYDROPONICS_REPLICA_PIN_SECONDS=10)
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.router = ReplicaRouter()
+
+    def route(self, request, status=200):
+        """
+        Passes a request through the middleware and returns the response
+        with the database its reads were routed to.
+        """
+        routed = []
+
+        def view(request):
+            routed.append(self.router.db_for_read(Measurement))
+            return HttpResponse(status=status)
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return response, routed[0]
+
+    def test_reads_of_safe_requests_go_to_replicas(self):
+        _, database = self.route(self.factory.get("/api/systems/"))
+        self.assertEqual(database, "replica1")
+        response, database = self.route(self.factory.post("/api/systems/"))
+        self.assertEqual(database, "default")
+        self.assertEqual(self.router.db_for_write(Measurement), "default")
+        self.assertFalse(self.router.allow_migrate("replica1", "hydroponics"))
+
+    def test_replicas_are_only_used_when_allowed(self):
+        self.assertEqual(self.router.db_for_read(Measurement), "default")
+        with use_replicas():
+            self.assertEqual(self.router.db_for_read(Measurement), "replica1")
+            with use_replicas(False):
+                self.assertEqual(self.router.db_for_read(Measurement), "default")
+
+    @override_settings(DATABASE_REPLICAS=["replica1", "replica2", "replica3"])
+    def test_reads_of_a_request_go_to_one_replica(self):
+        routed = set()
+
+        def view(request):
+            for _ in range(20):
+                routed.add(self.router.db_for_read(Measurement))
+            return HttpResponse()
+
+        for _ in range(5):
+            routed.clear()
+            ReplicaRoutingMiddleware(view)(self.factory.get("/api/systems/"))
+            self.assertEqual(len(routed), 1)
+        with use_replicas():
+            replica = self.router.db_for_read(Measurement)
+            with use_replicas():
+                self.assertEqual(self.router.db_for_read(Measurement), replica)
+
+    def test_client_is_pinned_to_the_primary_after_a_write(self):
+        response, _ = self.route(
+            self.factory.post("/api/systems/", HTTP_AUTHORIZATION="Bearer a"), 201
+        )
+        self.assertEqual(response.cookies[PIN_COOKIE]["max-age"], 10)
+
+        # Without the cookie, e.g. served by another worker of a client
+        # that ignores cookies: pinned through the shared cache.
+        _, database = self.route(
+            self.factory.get("/api/systems/", HTTP_AUTHORIZATION="Bearer a")
+        )
+        self.assertEqual(database, "default")
+        _, database = self.route(
+            self.factory.get("/api/systems/", HTTP_AUTHORIZATION="Bearer b")
+        )
+        self.assertEqual(database, "replica1")
+        request = self.factory.get("/api/systems/")
+        request.COOKIES[PIN_COOKIE] = "1"
+        _, database = self.route(request)
+        self.assertEqual(database, "default")
+
+    def test_failed_writes_do_not_pin(self):
+        response, _ = self.route(
+            self.factory.post("/api/systems/", HTTP_AUTHORIZATION="Bearer a"), 400
+        )
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        _, database = self.route(
+            self.factory.get("/api/systems/", HTTP_AUTHORIZATION="Bearer a")
+        )
+        self.assertEqual(database, "replica1")
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "Needs DATABASE_REPLICA_HOSTS.")
+class ReplicaMirrorTests(APITestCase):
+    # Replicas mirror the primary in tests (TEST MIRROR).
+    databases = {"default", *settings.DATABASE_REPLICAS}
+
+    def test_client_reads_its_own_writes(self):
+        self.client.force_authenticate(
+            User.objects.create_user("grower", password="secret")
+        )
+        response = self.client.post("/api/systems/", {"name": "Greenhouse"})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get("/api/systems/")
+        self.assertEqual(
+            [system["name"] for system in response.json()["results"]], ["Greenhouse"]
+        )
+
+
+@override_settings(DATABASE_SHARDS=["default", "shard1"])
+class ShardRoutingTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("grower", password="secret")
+        self.router = ShardRouter()
+        invalidate_placement(self.owner.id)
+        self.addCleanup(invalidate_placement, self.owner.id)
+
+    def test_owners_are_placed_by_id_unless_mapped(self):
+        expected = ["default", "shard1"][self.owner.id % 2]
+        self.assertEqual(shard_for_owner(self.owner.id), expected)
+        TenantShard.objects.create(owner=self.owner, shard="shard1")
+        invalidate_placement(self.owner.id)
+        self.assertEqual(shard_for_owner(self.owner.id), "shard1")
+
+    def test_tenant_data_follows_the_request_tenant(self):
+        TenantShard.objects.create(owner=self.owner, shard="shard1")
+        with tenant(self.owner.id):
+            self.assertEqual(self.router.db_for_read(Sensor), "shard1")
+            self.assertEqual(self.router.db_for_write(Measurement), "shard1")
+            # Users and the shard map stay on the default database.
+            self.assertIsNone(self.router.db_for_read(User))
+            self.assertEqual(self.router.db_for_read(TenantShard), "default")
+        with on_shard("shard1"):
+            self.assertEqual(self.router.db_for_read(IngestedSegment), "shard1")
+        self.assertEqual(self.router.db_for_read(Sensor), "default")
+
+    def test_writes_of_a_moving_tenant_are_rejected(self):
+        TenantShard.objects.create(owner=self.owner, shard="shard1", is_frozen=True)
+        with tenant(self.owner.id):
+            self.assertEqual(self.router.db_for_read(Sensor), "shard1")
+            with self.assertRaises(TenantMoving):
+                self.router.db_for_write(Sensor)
+
+    def test_fan_out_visits_every_shard(self):
+        databases = [queryset.db for queryset in fan_out(Sensor.objects.all())]
+        self.assertEqual(databases, ["default", "shard1"])
+
+
+@skipUnless(len(settings.DATABASE_SHARDS) > 1, "Needs DATABASE_SHARD_HOSTS.")
+@override_settings(HYDROPONICS_SHARD_MAP_CACHE_TTL=0)
+class MoveTenantTests(TransactionTestCase):
+    databases = "__all__"
+
+    def test_tenant_data_is_moved_with_its_ids(self):
+        sensor = create_sensor("grower")
+        owner_id = sensor.system.owner_id
+        source = shard_for_owner(owner_id)
+        target = next(alias for alias in settings.DATABASE_SHARDS if alias != source)
+        now = timezone.now()
+        write_measurements(
+            [
+                Measurement(sensor=sensor, value=Decimal("6.5"), measured_at=now)
+                for _ in range(10)
+            ]
+        )
+        ids = sorted(Measurement.objects.using(source).values_list("id", flat=True))
+
+        call_command("move_tenant", owner_id, target, stdout=StringIO())
+
+        self.assertEqual(shard_for_owner(owner_id), target)
+        self.assertFalse(Sensor.objects.using(source).filter(id=sensor.id).exists())
+        self.assertTrue(Sensor.objects.using(target).filter(id=sensor.id).exists())
+        self.assertEqual(
+            sorted(Measurement.objects.using(target).values_list("id", flat=True)), ids
+        )
+
+
+class PendingDeletionTests(APITestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.system = self.sensor.system
+        now = timezone.now()
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=self.sensor,
+                value=Decimal("6.5"),
+                measured_at=now - timedelta(hours=7 * index),
+            )
+            for index in range(20)
+        )
+        self.client.force_authenticate(self.system.owner)
+
+    def test_deleted_system_is_hidden_then_purged(self):
+        response = self.client.delete(f"/api/systems/{self.system.id}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            self.client.get(f"/api/systems/{self.system.id}/").status_code, 404
+        )
+        self.assertEqual(
+            self.client.get(f"/api/sensors/{self.sensor.id}/").status_code, 404
+        )
+        self.assertEqual(
+            sorted(Tombstone.objects.values_list("kind", "object_id")),
+            sorted(
+                [
+                    (Tombstone.SENSOR, self.sensor.id),
+                    (Tombstone.SYSTEM, self.system.id),
+                ]
+            ),
+        )
+
+        self.assertEqual(purge_pending_deletions(), (1, 1, 20))
+        self.assertFalse(HydroponicSystem.all_objects.exists())
+        self.assertFalse(Sensor.all_objects.exists())
+        self.assertFalse(Measurement.objects.exists())
+
+    def test_readings_of_a_deleted_sensor_are_hidden_by_the_api(self):
+        other = Sensor.objects.create(system=self.system, sensor_type="TDS", name="b")
+        Measurement.objects.create(sensor=other, value=Decimal("500"))
+        AlertRule.objects.create(
+            owner=self.system.owner, name="pH", sensor=self.sensor, kind="THRESHOLD"
+        )
+        response = self.client.delete(f"/api/sensors/{self.sensor.id}/")
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get("/api/measurements/", {"page_size": 50})
+        self.assertEqual(
+            [item["sensor"] for item in response.data["results"]], [other.id]
+        )
+        response = self.client.get(f"/api/systems/{self.system.id}/")
+        self.assertEqual(len(response.data["last_10_measurements"]), 1)
+        self.assertEqual(self.client.get("/api/alert-rules/").data["count"], 0)
+
+        # Internal reads by sensor are not joined with the sensor table.
+        with CaptureQueriesContext(connection) as queries:
+            list(Measurement.objects.filter(sensor_id=other.id))
+        self.assertNotIn("hydroponics_sensor", queries[0]["sql"])
+
+    def test_measurements_are_deleted_in_time_slices(self):
+        with CaptureQueriesContext(connection) as queries:
+            deleted = delete_measurements(self.sensor.id, slice=timedelta(days=1))
+        self.assertEqual(deleted, 20)
+        deletes = [q for q in queries if q["sql"].startswith("DELETE")]
+        # Five days of readings, oldest first.
+        self.assertEqual(len(deletes), 5)
+
+
+@register("test_echo")
+def echo(job):
+    if job.params.get("fail"):
+        raise ValueError("Failed on purpose.")
+    return {"echo": job.params.get("value")}
+
+
+class JobTests(TestCase):
+    def test_jobs_are_claimed_in_order_once(self):
+        first = enqueue("test_echo", params={"value": 1})
+        later = enqueue("test_echo", params={"value": 2})
+        Job.objects.filter(pk=later.pk).update(
+            run_after=timezone.now() + timedelta(minutes=1)
+        )
+        job = claim("worker-1")
+        self.assertEqual(job.pk, first.pk)
+        self.assertEqual(
+            (job.status, job.attempts, job.worker), (Job.RUNNING, 1, "worker-1")
+        )
+        self.assertIsNone(claim("worker-2"))
+
+    def test_expired_lease_is_claimed_again(self):
+        enqueue("test_echo")
+        job = claim("worker-1")
+        Job.objects.filter(pk=job.pk).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        again = claim("worker-2")
+        self.assertEqual(
+            (again.pk, again.attempts, again.worker), (job.pk, 2, "worker-2")
+        )
+
+    def test_unique_jobs_are_not_queued_twice(self):
+        first = enqueue("test_echo", params={"value": 1}, unique=True)
+        self.assertEqual(enqueue("test_echo", params={"value": 1}, unique=True), first)
+        self.assertNotEqual(
+            enqueue("test_echo", params={"value": 2}, unique=True), first
+        )
+
+    def test_outcomes_are_recorded(self):
+        enqueue("test_echo", params={"value": 7})
+        run(claim("worker"))
+        job = Job.objects.get()
+        self.assertEqual(
+            (job.status, job.result, job.progress), (Job.SUCCEEDED, {"echo": 7}, 1.0)
+        )
+
+    def test_failed_job_is_retried_with_backoff_then_failed(self):
+        enqueue("test_echo", params={"fail": True})
+        with self.assertLogs("hydroponics.jobs", "ERROR"):
+            run(claim("worker"))
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn("Failed on purpose.", job.error)
+
+        Job.objects.update(run_after=timezone.now(), attempts=job.max_attempts - 1)
+        with self.assertLogs("hydroponics.jobs", "ERROR"):
+            run(claim("worker"))
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+
+    def test_worker_survives_errors_while_running_a_job(self):
+        enqueue("test_echo")
+        enqueue("test_echo")
+        stop = threading.Event()
+        calls = []
+
+        def flaky_run(job):
+            calls.append(job.pk)
+            if len(calls) == 1:
+                raise OperationalError("The database went away.")
+            run(job)
+
+        with mock.patch("hydroponics.jobs.run", flaky_run), self.assertLogs(
+            "hydroponics.jobs", "ERROR"
+        ):
+            work("worker", stop, poll_interval=0, exit_when_idle=True)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Job.objects.filter(status=Job.SUCCEEDED).count(), 1)
+
+
+class MeasurementAdminTests(TestCase):
+    url = "/admin/hydroponics/measurement/"
+
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        start = timezone.now() - timedelta(days=40)
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=self.sensor,
+                value=Decimal(6),
+                measured_at=start + timedelta(days=day),
+            )
+            for day in range(40)
+        )
+        admin = User.objects.create_superuser("admin", password="secret")
+        self.client.force_login(admin)
+
+    def test_changelist_queries_do_not_grow_with_sensors(self):
+        with CaptureQueriesContext(connection) as before:
+            self.assertContains(self.client.get(self.url), "Probe")
+        Measurement.objects.bulk_create(
+            Measurement(sensor=create_sensor(f"grower{i}"), value=Decimal(6))
+            for i in range(10)
+        )
+        with CaptureQueriesContext(connection) as after:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(len(after), len(before))
+
+    def test_search_matches_sensor_id_or_exact_name(self):
+        other = create_sensor("other")
+        Measurement.objects.create(sensor=other, value=Decimal(7))
+        for term, count in (
+            (str(self.sensor.pk), 40),
+            (str(other.pk), 1),
+            ("probe", 41),
+            ("Prob", 0),
+        ):
+            response = self.client.get(self.url, {"q": term})
+            self.assertEqual(response.context["cl"].result_count, count, term)
+
+    def test_date_hierarchy_lists_periods_with_readings(self):
+        queryset = IndexedDatesQuerySet(Measurement)
+        for kind, order in (("year", "ASC"), ("month", "ASC"), ("day", "DESC")):
+            self.assertEqual(
+                list(queryset.datetimes("measured_at", kind, order)),
+                list(Measurement.objects.datetimes("measured_at", kind, order)),
+            )
+        response = self.client.get(self.url, {"measured_at__year": timezone.now().year})
+        self.assertEqual(response.status_code, 200)
+
+    def test_str_does_not_load_the_sensor(self):
+        measurement = Measurement.objects.first()
+        with self.assertNumQueries(0):
+            self.assertIn(f" - {self.sensor.pk} - ", str(measurement))
+
+
+@override_settings(HYDROPONICS_SYNC_LAG_SECONDS=0)
+class SyncTests(APITestCase):
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.owner = self.sensor.system.owner
+        self.client.force_authenticate(self.owner)
+        invalidate_placement(self.owner.id)
+        self.addCleanup(invalidate_placement, self.owner.id)
+
+    def sync(self, watermark=None):
+        params = {"watermark": watermark} if watermark else {}
+        response = self.client.get("/api/sync/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_are_sent_once(self):
+        first = Measurement.objects.create(sensor=self.sensor, value=Decimal(6))
+        full = self.sync()
+        self.assertEqual([s["id"] for s in full["sensors"]], [self.sensor.pk])
+        self.assertEqual([m["id"] for m in full["measurements"]], [first.pk])
+
+        second = Measurement.objects.create(sensor=self.sensor, value=Decimal(7))
+        response = self.client.patch(f"/api/measurements/{first.pk}/", {"value": "6.5"})
+        self.assertEqual(response.status_code, 200)
+        changes = self.sync(full["watermark"])
+        self.assertFalse(changes["reset"])
+        self.assertEqual(changes["sensors"], [])
+        self.assertEqual(
+            [(m["id"], m["value"]) for m in changes["measurements"]],
+            [(second.pk, "7.00"), (first.pk, "6.50")],
+        )
+        self.assertEqual(self.sync(changes["watermark"])["measurements"], [])
+
+    def test_pages_follow_the_cursor(self):
+        Measurement.objects.bulk_create(
+            Measurement(sensor=self.sensor, value=Decimal(i)) for i in range(5)
+        )
+        # Rows written in one statement share their changed_at.
+        Measurement.objects.update(changed_at=timezone.now() - timedelta(seconds=1))
+        sent, watermark = [], None
+        with self.settings(HYDROPONICS_SYNC_PAGE_SIZE=2):
+            while True:
+                changes = self.sync(watermark)
+                sent += [m["id"] for m in changes["measurements"]]
+                watermark = changes["watermark"]
+                if not changes["has_more"]:
+                    break
+        self.assertEqual(sent, sorted(Measurement.objects.values_list("id", flat=True)))
+
+    def test_concurrent_insert_is_not_skipped(self):
+        now = timezone.now()
+        in_flight = Measurement.objects.create(sensor=self.sensor, value=Decimal(6))
+        committed = Measurement.objects.create(sensor=self.sensor, value=Decimal(7))
+        # The lower ID was allocated by a transaction committing after the sync.
+        Measurement.objects.filter(pk=in_flight.pk).update(
+            changed_at=now - timedelta(seconds=2)
+        )
+        Measurement.objects.filter(pk=committed.pk).update(
+            changed_at=now - timedelta(seconds=60)
+        )
+        with self.settings(HYDROPONICS_SYNC_LAG_SECONDS=5):
+            full = self.sync()
+        self.assertEqual([m["id"] for m in full["measurements"]], [committed.pk])
+        changes = self.sync(full["watermark"])
+        self.assertEqual([m["id"] for m in changes["measurements"]], [in_flight.pk])
+
+    @override_settings(DATABASE_SHARDS=["default", "shard1"])
+    def test_tenant_move_forces_a_full_resync(self):
+        Measurement.objects.create(sensor=self.sensor, value=Decimal(6))
+        TenantShard.objects.create(owner=self.owner, shard="default")
+        invalidate_placement(self.owner.id)
+        watermark = changes_since(self.owner.id)["watermark"]
+        self.assertFalse(changes_since(self.owner.id, watermark)["reset"])
+
+        TenantShard.objects.filter(owner=self.owner).update(shard="shard1")
+        invalidate_placement(self.owner.id)
+        changes = changes_since(self.owner.id, watermark)
+        self.assertTrue(changes["reset"])
+        self.assertEqual(len(changes["sensors"]), 1)
+        self.assertEqual(len(changes["measurements"]), 1)
+
+    def test_invalid_watermark_is_rejected(self):
+        response = self.client.get("/api/sync/", {"watermark": "forged"})
+        self.assertEqual(response.status_code, 400)
+
+
+class LatestMeasurementsTests(APITestCase):
+    url = "/api/measurements/latest/"
+
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.other = Sensor.objects.create(
+            system=self.sensor.system, name="Thermometer", sensor_type="TEMP"
+        )
+        self.client.force_authenticate(self.sensor.system.owner)
+        now = timezone.now()
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=sensor,
+                value=Decimal(i),
+                measured_at=now - timedelta(minutes=10 - i),
+            )
+            for sensor in (self.sensor, self.other)
+            for i in range(10)
+        )
+        self.now = now
+
+    def test_latest_readings_of_each_sensor_newest_first(self):
+        readings = latest_measurements([self.sensor.pk, self.other.pk], 3)
+        for sensor_id in (self.sensor.pk, self.other.pk):
+            self.assertEqual(
+                [m.value for m in readings[sensor_id]],
+                [Decimal(9), Decimal(8), Decimal(7)],
+            )
+
+    def test_time_range_is_half_open(self):
+        start = self.now - timedelta(minutes=8)
+        readings = latest_measurements(
+            [self.sensor.pk], 10, start=start, end=self.now - timedelta(minutes=5)
+        )
+        self.assertEqual(
+            [m.value for m in readings[self.sensor.pk]],
+            [Decimal(4), Decimal(3), Decimal(2)],
+        )
+
+    def test_endpoint_answers_with_one_reading_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                self.url, {"sensors": f"{self.other.pk},{self.sensor.pk}", "limit": 2}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(item["sensor"], len(item["measurements"])) for item in response.data],
+            [(self.other.pk, 2), (self.sensor.pk, 2)],
+        )
+        # The ownership check and the readings of all sensors.
+        self.assertEqual(len(queries), 2)
+
+    @override_settings(HYDROPONICS_CHUNKED_STORAGE=True)
+    def test_sealed_readings_are_merged(self):
+        Measurement.objects.all().delete()
+        now = timezone.now()
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=sensor,
+                value=Decimal(day),
+                measured_at=now - timedelta(days=10 - day),
+            )
+            for sensor in (self.sensor, self.other)
+            for day in range(10)
+        )
+        # The first sensor keeps its last reading as a row, the other
+        # one is sealed entirely.
+        compact_sensor(self.sensor.pk, period_start(now - timedelta(days=1)))
+        compact_sensor(self.other.pk, now)
+        self.assertEqual(Measurement.objects.filter(sensor=self.sensor).count(), 1)
+        self.assertFalse(Measurement.objects.filter(sensor=self.other).exists())
+
+        response = self.client.get(
+            self.url, {"sensors": f"{self.sensor.pk},{self.other.pk}", "limit": 3}
+        )
+        self.assertEqual(response.status_code, 200)
+        for item in response.data:
+            self.assertEqual(
+                [m["value"] for m in item["measurements"]], ["9.00", "8.00", "7.00"]
+            )
+        end = now - timedelta(days=5)
+        readings = latest_measurements([self.other.pk], 2, end=end)
+        self.assertEqual(
+            [m.value for m in readings[self.other.pk]], [Decimal(4), Decimal(3)]
+        )
+
+    def test_sensors_of_other_users_are_rejected(self):
+        stranger = create_sensor("stranger")
+        response = self.client.get(
+            self.url, {"sensors": f"{self.sensor.pk},{stranger.pk}"}
+        )
+        self.assertEqual(response.status_code, 400)
+        for sensors in ("", "a,b"):
+            response = self.client.get(self.url, {"sensors": sensors})
+            self.assertEqual(response.status_code, 400)
+
+
+class ProvisioningTests(APITestCase):
+    url = "/api/systems/provision/"
+
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.owner = self.sensor.system.owner
+        self.client.force_authenticate(self.owner)
+
+    def document(self, systems, sensors):
+        return {
+            "systems": [
+                {
+                    "name": f"Bay {i}",
+                    "sensors": [
+                        {"name": f"Probe {j}", "sensor_type": "PH"}
+                        for j in range(sensors)
+                    ],
+                }
+                for i in range(systems)
+            ]
+        }
+
+    def test_ids_are_returned_in_document_order(self):
+        document = self.document(2, 2)
+        document["systems"].insert(
+            1,
+            {
+                "id": self.sensor.system_id,
+                "sensors": [{"name": "Thermometer", "sensor_type": "TEMP"}],
+            },
+        )
+        response = self.client.post(self.url, document, format="json")
+        self.assertEqual(response.status_code, 201)
+        names = [
+            [Sensor.objects.get(pk=pk).name for pk in system["sensors"]]
+            for system in response.data
+        ]
+        self.assertEqual(
+            names, [["Probe 0", "Probe 1"], ["Thermometer"], ["Probe 0", "Probe 1"]]
+        )
+        self.assertEqual(response.data[1]["id"], self.sensor.system_id)
+        self.assertEqual(
+            HydroponicSystem.objects.get(pk=response.data[2]["id"]).name, "Bay 1"
+        )
+
+    def test_queries_do_not_grow_with_the_document(self):
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(self.url, self.document(1, 1), format="json")
+        document = self.document(5, 10)
+        for system in document["systems"]:
+            system["name"] += " (large)"
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.post(self.url, document, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(large), len(small))
+
+    def test_invalid_documents_create_nothing(self):
+        stranger = create_sensor("stranger")
+        for systems in (
+            [{"name": "Greenhouse"}],
+            [{"name": "Bay"}, {"name": "Bay"}],
+            [{"name": "Bay"}, {"id": stranger.system_id}],
+            [{"id": self.sensor.system_id, "name": "Bay"}],
+        ):
+            response = self.client.post(self.url, {"systems": systems}, format="json")
+            self.assertEqual(response.status_code, 400, systems)
+        self.assertEqual(HydroponicSystem.objects.count(), 2)
+
+    def test_command_provisions_from_a_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+            json.dump(self.document(2, 3), file)
+            file.flush()
+            out, err = StringIO(), StringIO()
+            call_command(
+                "provision_systems", "grower", file.name, stdout=out, stderr=err
+            )
+        systems = json.loads(out.getvalue())
+        self.assertEqual([len(system["sensors"]) for system in systems], [3, 3])
+        self.assertIn("Provisioned 2 systems with 6 sensors.", err.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("provision_systems", "nobody", file.name)
+
+
+class EncodingTests(SimpleTestCase):
+    def setUp(self):
+        start = timezone.now().replace(microsecond=0) - timedelta(days=3)
+        values = ["6.50", "-0.25", "1200.00", "0.00", "7.13", "7.13"]
+        offsets = [0, 1, 2, 4, 4, 3600 * 24]
+        self.readings = [
+            (
+                100 + 3 * i,
+                start + timedelta(seconds=offset, microseconds=i),
+                Decimal(value),
+            )
+            for i, (offset, value) in enumerate(zip(offsets, values))
+        ]
+
+    def test_chunks_round_trip(self):
+        self.assertEqual(decode_chunk(encode_chunk(self.readings)), self.readings)
+        self.assertEqual(decode_chunk(encode_chunk([])), [])
+
+    def test_archives_round_trip(self):
+        data = encode_archive(self.readings)
+        self.assertEqual(decode_archive(data), self.readings)
+        with self.assertRaises(ValueError):
+            decode_archive(b"XXXX" + data[4:])
+
+    def test_archive_ranges_are_found_by_bisection(self):
+        columns = decode_archive_columns(encode_archive(self.readings))
+        since, until = self.readings[1][1], self.readings[4][1]
+        self.assertEqual(archive_readings(columns, since, until), self.readings[1:5])
+        self.assertEqual(archive_readings(columns, until=since), self.readings[:2])
+        self.assertEqual(
+            archive_readings(columns, since=self.readings[-1][1] + timedelta(1)), []
+        )
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(HYDROPONICS_ARCHIVE_DIR=directory.name))
+        self.addCleanup(archive_columns.clear)
+        self.sensor = create_sensor("grower")
+        self.month = month_start(timezone.now()) - timedelta(days=60)
+        self.add_readings(range(10))
+
+    def add_readings(self, values):
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=self.sensor,
+                value=Decimal(value),
+                measured_at=month_start(self.month) + timedelta(hours=value),
+            )
+            for value in values
+        )
+
+    def archive(self):
+        with archive_lock():
+            return archive_sensor(self.sensor.pk, month_start(timezone.now()))
+
+    def test_archived_measurements_are_read_with_the_rows(self):
+        self.assertEqual(self.archive(), 10)
+        self.assertFalse(Measurement.objects.exists())
+        (segment,) = archived_segments([self.sensor.pk])
+        self.assertEqual((segment.count, segment.min_value), (10, Decimal(0)))
+        start = month_start(self.month) + timedelta(hours=3)
+        readings = series([self.sensor.pk], {"measured_at__gte": start}, reverse=True)
+        self.assertEqual(
+            [m.value for m in readings], [Decimal(v) for v in range(9, 2, -1)]
+        )
+
+    def test_decoded_columns_are_cached(self):
+        self.archive()
+        (segment,) = archived_segments([self.sensor.pk])
+        archive_columns.clear()
+        segment.readings()
+        with mock.patch("hydroponics.archive.open") as opened:
+            self.assertEqual(len(segment.readings()), 10)
+        opened.assert_not_called()
+
+    def test_superseded_files_are_deleted_and_skipped_by_readers(self):
+        self.archive()
+        (old,) = archived_segments([self.sensor.pk])
+        self.add_readings([20, 21])
+        self.archive()
+        (current,) = archived_segments([self.sensor.pk])
+        self.assertEqual(current.count, 12)
+
+        with archive_lock():
+            compact_manifest([self.sensor.pk])
+        files = list(Path(settings.HYDROPONICS_ARCHIVE_DIR).glob("sensor-*/*.col"))
+        self.assertEqual([path.name for path in files], [Path(current.file).name])
+        # A reader still holding the segment listed before the compaction.
+        archive_columns.clear()
+        self.assertEqual(len(old.readings()), 12)
+
+        with archive_lock():
+            compact_manifest([])
+        self.assertEqual(archived_segments([self.sensor.pk]), [])
+        self.assertEqual(old.readings(), [])
+
+
+@override_settings(
+    HYDROPONICS_SENSOR_RATE_LIMIT=60,
+    HYDROPONICS_USER_RATE_LIMIT=600,
+    HYDROPONICS_RATE_LIMIT_BURST_SECONDS=10,
+)
+class ThrottlingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.now = 1_000_000.0
+        clock = mock.patch("hydroponics.throttling.time")
+        clock.start().time.side_effect = lambda: self.now
+        self.addCleanup(clock.stop)
+
+    def wait(self, readings, owner_id=1):
+        """
+        Returns the seconds to wait for the readings, or 0 if admitted.
+        """
+        try:
+            throttle(owner_id, readings)
+        except Throttled as error:
+            return error.wait
+        return 0
+
+    def test_burst_then_steady_rate(self):
+        for _ in range(10):
+            self.assertEqual(self.wait({1: (None, 1)}), 0)
+        self.assertEqual(self.wait({1: (None, 1)}), 1)
+        self.now += 1
+        self.assertEqual(self.wait({1: (None, 1)}), 0)
+        # Systems may set their own rate.
+        self.assertEqual(self.wait({2: (120, 20)}), 0)
+        self.assertEqual(self.wait({2: (120, 1)}), 1)
+
+    def test_rejected_readings_are_not_counted(self):
+        self.assertEqual(self.wait({1: (None, 10)}), 0)
+        for _ in range(3):
+            self.assertEqual(self.wait({1: (None, 5)}), 5)
+        self.now += 5
+        self.assertEqual(self.wait({1: (None, 5)}), 0)
+
+    def test_batch_over_the_burst_is_paid_off(self):
+        self.assertEqual(self.wait({1: (None, 30)}), 0)
+        self.assertEqual(self.wait({1: (None, 1)}), 21)
+        self.now += 21
+        self.assertEqual(self.wait({1: (None, 1)}), 0)
+        # A large batch waits for the bucket to empty, not for a burst.
+        self.assertEqual(self.wait({1: (None, 30)}), 10)
+        self.now += 10
+        self.assertEqual(self.wait({1: (None, 30)}), 0)
+
+    def test_user_limit_spans_sensors(self):
+        readings = {sensor_id: (None, 10) for sensor_id in range(10)}
+        self.assertEqual(self.wait(readings), 0)
+        self.assertEqual(self.wait({99: (None, 1)}), 1)
+        self.assertEqual(self.wait({99: (None, 1)}, owner_id=2), 0)
+        # A batch over the user burst is admitted on an empty bucket.
+        self.now += 60
+        readings = {sensor_id: (None, 30) for sensor_id in range(100, 110)}
+        self.assertEqual(self.wait(readings), 0)
+        self.assertEqual(self.wait({99: (None, 1)}), 21)
+
+
+class ScaledDecimalFieldTests(TestCase):
+    def stored(self, measurement):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT value FROM hydroponics_measurement WHERE id = %s",
+                [measurement.pk],
+            )
+            return cursor.fetchone()[0]
+
+    def test_values_round_trip_as_integers(self):
+        sensor = create_sensor("grower")
+        for value, stored in (
+            ("6.50", 650),
+            ("-12.07", -1207),
+            ("0", 0),
+            ("9999999.99", 999999999),
+            # Extra places are rounded half to even.
+            ("2.345", 234),
+            ("2.355", 236),
+        ):
+            measurement = Measurement.objects.create(
+                sensor=sensor, value=Decimal(value)
+            )
+            self.assertEqual(self.stored(measurement), stored)
+            measurement.refresh_from_db()
+            self.assertEqual(measurement.value, Decimal(stored).scaleb(-2))
+            self.assertEqual(measurement.value.as_tuple().exponent, -2)
+
+    def test_lookups_and_aggregates_use_decimals(self):
+        sensor = create_sensor("grower")
+        for value in ("5.25", "6.50", "7.75"):
+            Measurement.objects.create(sensor=sensor, value=Decimal(value))
+        measurements = Measurement.objects.filter(sensor=sensor)
+        self.assertEqual(measurements.filter(value__gte=Decimal("6.5")).count(), 2)
+        self.assertEqual(measurements.filter(value=Decimal("5.25")).count(), 1)
+        self.assertEqual(
+            measurements.aggregate(low=Min("value"), high=Max("value")),
+            {"low": Decimal("5.25"), "high": Decimal("7.75")},
+        )
+        self.assertEqual(
+            list(measurements.order_by("-value").values_list("value", flat=True)),
+            [Decimal("7.75"), Decimal("6.50"), Decimal("5.25")],
+        )
+
+
+class AlterScaledFieldTests(TransactionTestCase):
+    before = [("hydroponics", "0018_system_ingest_rate_limit")]
+    after = [("hydroponics", "0019_measurement_scaled_value")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def values(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT value FROM hydroponics_measurement ORDER BY id")
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_values_are_converted_both_ways(self):
+        self.addCleanup(call_command, "migrate", "hydroponics", verbosity=0)
+        apps = self.migrate(self.before)
+        owner = apps.get_model("auth", "User").objects.create(username="grower")
+        system = apps.get_model("hydroponics", "HydroponicSystem").objects.create(
+            owner_id=owner.pk, name="Greenhouse"
+        )
+        sensor = apps.get_model("hydroponics", "Sensor").objects.create(
+            system_id=system.pk, name="Probe", sensor_type="PH"
+        )
+        apps.get_model("hydroponics", "Measurement").objects.bulk_create(
+            apps.get_model("hydroponics", "Measurement")(
+                sensor_id=sensor.pk, value=Decimal(value)
+            )
+            for value in ("6.50", "-1.25", "0.01")
+        )
+
+        self.migrate(self.after)
+        self.assertEqual(self.values(), [650, -125, 1])
+        self.migrate(self.before)
+        self.assertEqual(
+            [Decimal(str(value)) for value in self.values()],
+            [Decimal("6.5"), Decimal("-1.25"), Decimal("0.01")],
+        )
+
+
+class FleetSummaryTests(APITestCase):
+    url = "/api/systems/summary/"
+
+    def setUp(self):
+        self.now = timezone.now()
+        probe = create_sensor("grower")
+        self.owner = probe.system.owner
+        self.client.force_authenticate(self.owner)
+        self.systems = {"Greenhouse": probe.system}
+        for name in ("Attic", "basement"):
+            self.systems[name] = HydroponicSystem.objects.create(
+                owner=self.owner, name=name
+            )
+        heater = Sensor.objects.create(
+            system=probe.system, name="Heater", sensor_type="TEMP"
+        )
+        cellar = Sensor.objects.create(
+            system=self.systems["basement"], name="Probe", sensor_type="PH"
+        )
+        Sensor.objects.create(
+            system=self.systems["Attic"], name="Probe", sensor_type="PH"
+        )
+        self.add(probe, "6.50", minutes=10)
+        self.add(probe, "15.00", minutes=20)
+        self.add(heater, "200.00", minutes=5)
+        self.add(cellar, "7.00", minutes=600)
+        create_sensor("stranger")
+
+    def add(self, sensor, value, minutes):
+        Measurement.objects.create(
+            sensor=sensor,
+            value=Decimal(value),
+            measured_at=self.now - timedelta(minutes=minutes),
+        )
+
+    def summary(self, ordering=None):
+        params = {"ordering": ordering} if ordering else {}
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_latest_reading_of_each_sensor_type(self):
+        systems = {system["name"]: system for system in self.summary()}
+        self.assertEqual(set(systems), {"Attic", "basement", "Greenhouse"})
+        greenhouse = systems["Greenhouse"]
+        self.assertEqual(
+            (greenhouse["sensor_count"], greenhouse["out_of_range"]), (2, 1)
+        )
+        self.assertEqual(
+            [
+                (t["sensor_type"], t["value"], t["in_range"])
+                for t in greenhouse["sensor_types"]
+            ],
+            [("PH", "6.50", True), ("TEMP", "200.00", False)],
+        )
+        self.assertAlmostEqual(greenhouse["seconds_since_last"], 300, delta=60)
+        attic = systems["Attic"]
+        self.assertEqual((attic["sensor_count"], attic["last_measured_at"]), (1, None))
+        self.assertEqual(attic["sensor_types"], [])
+
+    def test_orderings(self):
+        self.assertEqual(
+            [system["name"] for system in self.summary()],
+            ["Attic", "basement", "Greenhouse"],
+        )
+        self.assertEqual(
+            [system["name"] for system in self.summary("stale")],
+            ["Attic", "basement", "Greenhouse"],
+        )
+        self.assertEqual(
+            [system["name"] for system in self.summary("out_of_range")][0], "Greenhouse"
+        )
+        response = self.client.get(self.url, {"ordering": "size"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_queries_do_not_grow_with_the_fleet(self):
+        with CaptureQueriesContext(connection) as before:
+            self.summary()
+        for i in range(5):
+            system = HydroponicSystem.objects.create(owner=self.owner, name=f"Bay {i}")
+            sensor = Sensor.objects.create(
+                system=system, name="Probe", sensor_type="TDS"
+            )
+            self.add(sensor, "800.00", minutes=i)
+        with CaptureQueriesContext(connection) as after:
+            self.assertEqual(len(self.summary()), 8)
+        self.assertEqual(len(after), len(before))
+
+    @override_settings(HYDROPONICS_CHUNKED_STORAGE=True)
+    def test_sealed_readings_are_included(self):
+        cellar = Sensor.objects.get(system=self.systems["basement"])
+        compact_sensor(cellar.pk, self.now)
+        self.assertFalse(Measurement.objects.filter(sensor=cellar).exists())
+        (basement,) = [s for s in self.summary() if s["name"] == "basement"]
+        self.assertEqual(basement["sensor_types"][0]["value"], "7.00")
+
+
+@override_settings(
+    HYDROPONICS_QUERY_BUDGETS={
+        "default": {"statement_timeout_ms": 1000, "window_days": 30},
+        "measurement.list": {"window_days": 1},
+    }
+)
+class QueryBudgetTests(APITestCase):
+    url = "/api/measurements/"
+
+    def setUp(self):
+        self.sensor = create_sensor("grower")
+        self.client.force_authenticate(self.sensor.system.owner)
+        self.midnight = timezone.localtime().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        Measurement.objects.bulk_create(
+            Measurement(
+                sensor=self.sensor,
+                value=Decimal(hours),
+                measured_at=self.midnight - timedelta(hours=hours),
+            )
+            for hours in range(0, 120, 6)
+        )
+
+    def values(self, params):
+        response = self.client.get(self.url, {"page_size": 100, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return sorted(Decimal(m["value"]) for m in response.data["results"])
+
+    def test_budgets_complete_the_default(self):
+        self.assertEqual(
+            query_budget("measurement", "list"),
+            {"statement_timeout_ms": 1000, "window_days": 1},
+        )
+        self.assertEqual(
+            query_budget("sensor", "list"),
+            {"statement_timeout_ms": 1000, "window_days": 30},
+        )
+
+    def test_lists_are_bounded_to_the_window(self):
+        end = self.midnight - timedelta(days=2)
+        for value in (end.isoformat(), end.date().isoformat()):
+            self.assertEqual(
+                self.values({"measured_at__lte": value}),
+                [Decimal(hours) for hours in (48, 54, 60, 66, 72)],
+            )
+        start = self.midnight - timedelta(days=3)
+        self.assertEqual(len(self.values({"measured_at__gte": start.isoformat()})), 13)
+
+    def test_invalid_end_is_reported_by_the_filterset(self):
+        response = self.client.get(self.url, {"measured_at__lte": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("measured_at__lte", response.data)
+
+    def test_window_may_be_required(self):
+        budgets = {"measurement.list": {"require_window": True}}
+        with self.settings(HYDROPONICS_QUERY_BUDGETS=budgets):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("measured_at__gte", response.data)
+            start = (self.midnight - timedelta(days=1)).isoformat()
+            self.assertEqual(len(self.values({"measured_at__gte": start})), 5)
+
+    def test_cancelled_queries_are_answered_with_400(self):
+        error = OperationalError("canceling statement due to statement timeout")
+        error.__cause__ = Exception()
+        error.__cause__.pgcode = "57014"
+        with mock.patch.object(MeasurementViewSet, "list", side_effect=error):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["detail"].code, "query_too_expensive")
+        self.assertIn("1000 ms", str(response.data["detail"]))
+
+
+class PoolingTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = mock.Mock(closed=False)
+        self.pool.get_stats.return_value = {
+            "pool_size": 5,
+            "pool_available": 2,
+            "requests_waiting": 1,
+            "requests_num": 40,
+            "requests_wait_ms": 1500,
+        }
+        closed = mock.Mock(closed=True)
+        databases = mock.MagicMock()
+        databases.__iter__.return_value = ["default", "shard1", "replica1"]
+        databases.settings = {
+            "default": {"OPTIONS": {"pool": {"max_size": 5}}},
+            "shard1": {"OPTIONS": {"pool": True}},
+            "replica1": {},
+        }
+        databases.__getitem__.side_effect = lambda alias: {
+            "default": mock.Mock(pool=self.pool),
+            "shard1": mock.Mock(pool=closed),
+        }[alias]
+        self.databases = databases
+        patcher = mock.patch("hydroponics.pooling.connections", databases)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_open_pools_are_listed(self):
+        self.assertEqual(pools(), {"default": self.pool})
+
+    def test_pool_statistics_are_exported(self):
+        rendered = registry.render()
+        for line in (
+            'hydroponics_db_pool_connections_in_use{database="default"} 3',
+            'hydroponics_db_pool_connections_idle{database="default"} 2',
+            'hydroponics_db_pool_requests_waiting{database="default"} 1',
+            'hydroponics_db_pool_checkouts_total{database="default"} 40',
+            'hydroponics_db_pool_wait_seconds_total{database="default"} 1.5',
+            # Statistics psycopg_pool reports only once they happened.
+            'hydroponics_db_pool_checkout_timeouts_total{database="default"} 0',
+        ):
+            self.assertIn(line, rendered)
+        self.assertNotIn('database="shard1"', rendered)
+        self.assertIn("# TYPE hydroponics_db_pool_checkouts_total counter", rendered)
+
+    def test_open_pools_are_closed(self):
+        connection = mock.Mock(pool=self.pool)
+        self.databases.__getitem__.side_effect = lambda alias: connection
+        self.databases.settings = {"default": {"OPTIONS": {"pool": True}}}
+        self.databases.__iter__.return_value = ["default"]
+        close_pools()
+        connection.close_pool.assert_called_once_with()
+
+
+@skipUnless(
+    settings.HYDROPONICS_DATABASE_POOL and connection.vendor == "postgresql",
+    "Needs DATABASE_POOL=1 on PostgreSQL.",
+)
+class ConnectionPoolTests(APITestCase):
+    def test_connections_return_to_the_pool(self):
+        sensor = create_sensor("grower")
+        self.client.force_authenticate(sensor.system.owner)
+        self.assertEqual(self.client.get("/api/systems/").status_code, 200)
+        stats = pools()["default"].get_stats()
+        self.assertEqual(stats["requests_waiting"], 0)
+        self.assertLessEqual(stats["pool_size"], stats["pool_max"])
+
+
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.enterContext(override_settings(HYDROPONICS_PROFILING_DIR=self.directory))
+        self.sensor = create_sensor("grower")
+        self.client.force_authenticate(self.sensor.system.owner)
+        self.staff = User.objects.create_user("admin", password="secret", is_staff=True)
+        out = StringIO()
+        call_command("profiling_token", "admin", stdout=out)
+        self.token = out.getvalue().strip()
+
+    def test_tokens_are_issued_for_active_staff_only(self):
+        self.assertEqual(profiling_user(self.token), self.staff.pk)
+        self.assertIsNone(profiling_user(self.token + "x"))
+        with self.settings(HYDROPONICS_PROFILING_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(profiling_user(self.token))
+        self.staff.is_staff = False
+        self.staff.save()
+        self.assertIsNone(profiling_user(self.token))
+        with self.assertRaisesMessage(CommandError, "not active staff"):
+            call_command("profiling_token", "admin")
+        with self.assertRaises(CommandError):
+            call_command("profiling_token", "nobody")
+
+    def test_profiled_request_writes_a_report(self):
+        response = self.client.get(
+            "/api/sensors/", {"_profile": self.token, "page_size": 5}
+        )
+        self.assertEqual(response.status_code, 200)
+        name = response["X-Profile-Report"]
+        self.assertEqual(
+            sorted(path.suffix for path in self.directory.glob(f"{name}.*")),
+            [".collapsed", ".json", ".pstats"],
+        )
+        report = json.loads((self.directory / f"{name}.json").read_text())
+        self.assertEqual(
+            (report["path"], report["query"], report["status"], report["user"]),
+            ("/api/sensors/", "page_size=5", 200, self.staff.pk),
+        )
+        self.assertEqual(report["mode"], "cprofile")
+        self.assertEqual(report["query_count"], len(report["queries"]))
+        self.assertGreater(report["query_count"], 0)
+        self.assertGreater(report["phases"]["serialization"], 0)
+
+    def test_sampling_mode(self):
+        with self.settings(HYDROPONICS_PROFILING_SAMPLE_INTERVAL=0.001):
+            response = self.client.get(
+                "/api/sensors/", HTTP_X_PROFILE=self.token, HTTP_X_PROFILE_MODE="sample"
+            )
+        name = response["X-Profile-Report"]
+        self.assertFalse((self.directory / f"{name}.pstats").exists())
+        report = json.loads((self.directory / f"{name}.json").read_text())
+        self.assertEqual(report["mode"], "sample")
+
+    def test_requests_without_a_valid_token_are_not_profiled(self):
+        self.assertNotIn("X-Profile-Report", self.client.get("/api/sensors/"))
+        with self.assertLogs("hydroponics.profiling", "WARNING"):
+            response = self.client.get("/api/sensors/", HTTP_X_PROFILE="forged")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile-Report", response)
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_rotation_deletes_the_oldest_reports(self):
+        for name in ("20260101T000000-a", "20260102T000000-b", "20260103T000000-c"):
+            (self.directory / f"{name}.json").write_text("x" * 100)
+        rotate(self.directory, 250, keep="20260101T000000-a")
+        self.assertEqual(
+            sorted(path.stem for path in self.directory.iterdir()),
+            ["20260101T000000-a", "20260103T000000-c"],
+        )
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        # The PID of a process that has exited.
+        process = subprocess.run(
+            [sys.executable, "-c", "import os; print(os.getpid())"],
+            capture_output=True,
+            text=True,
+        )
+        self.exited = int(process.stdout)
+
+    def snapshot(self, pid, requests, queue_depth):
+        families = [
+            [
+                "requests_total",
+                "Requests.",
+                "counter",
+                [["", [["kind", "api"]], requests]],
+            ],
+            ["queue_depth", "Queue depth.", "gauge", [["", [], queue_depth]]],
+        ]
+        (self.directory / f"{pid}.json").write_text(json.dumps(families))
+
+    def test_summaries_expose_their_maximum_as_a_gauge(self):
+        metrics = Registry()
+        latency = metrics.summary("latency_seconds", "Latency.")
+        latency.observe(0.5)
+        latency.observe(1.5)
+        rendered = metrics.render()
+        self.assertIn(
+            "# TYPE latency_seconds summary\nlatency_seconds_count 2\nlatency_seconds_sum 2.0\n",
+            rendered,
+        )
+        self.assertIn(
+            "# TYPE latency_seconds_max gauge\nlatency_seconds_max 1.5\n", rendered
+        )
+
+    def test_snapshots_of_all_processes_are_merged(self):
+        self.snapshot(os.getpid(), 3, 7)
+        self.snapshot(self.exited, 5, 11)
+        merged = {
+            name: (kind, samples) for name, _, kind, samples in collect(self.directory)
+        }
+        self.assertEqual(
+            merged["requests_total"], ("counter", [("", (("kind", "api"),), 8)])
+        )
+        # Gauges of exited processes are dropped, the others get their PID.
+        self.assertEqual(
+            merged["queue_depth"], ("gauge", [("", (("pid", os.getpid()),), 7)])
+        )
+        # The counters of exited processes are kept once their snapshot is gone.
+        self.assertFalse((self.directory / f"{self.exited}.json").exists())
+        self.snapshot(os.getpid(), 4, 7)
+        merged = {name: samples for name, _, _, samples in collect(self.directory)}
+        self.assertEqual(merged["requests_total"], [("", (("kind", "api"),), 9)])
+
+    def test_shared_metrics_are_rendered_for_all_processes(self):
+        metrics = Registry()
+        requests = metrics.counter("requests_total", "Requests.")
+        metrics.gauge("queue_depth", "Queue depth.").set(2)
+        requests.inc(kind="api")
+        self.snapshot(self.exited, 5, 11)
+        metrics.share(self.directory, interval=60)
+        self.addCleanup(metrics.unshare)
+        requests.inc(kind="api")
+        rendered = metrics.render()
+        self.assertIn('requests_total{kind="api"} 7', rendered)
+        self.assertIn(f'queue_depth{{pid="{os.getpid()}"}} 2', rendered)
+        self.assertNotIn(f'pid="{self.exited}"', rendered)
+        requests.inc(kind="api")
+        metrics.unshare()
+        self.assertIsNone(metrics.directory)
+        merged = {name: samples for name, _, _, samples in collect(self.directory)}
+        self.assertEqual(merged["requests_total"], [("", (("kind", "api"),), 8)])
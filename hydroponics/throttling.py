@@ -0,0 +1,116 @@
+import math
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import Throttled
+
+from .metrics import registry
+from .ownership import resolver
+
+"""
+Rate limiting of measurement ingestion per sensor and per user.
+
+Every limit is a GCRA (generic cell rate algorithm) bucket: the Django
+cache holds the theoretical arrival time of the next reading under the
+key of the sensor or the user, and readings are admitted while it stays
+at most HYDROPONICS_RATE_LIMIT_BURST_SECONDS (or one reading) ahead of
+now. A batch larger than the burst is admitted once the bucket is empty
+and charged in full, so the sender waits until the batch is paid off
+before sending again. A check costs one get_many() and one set_many()
+on the cache and no database query, as the per-system limits come with
+the cached sensor ownership; callers on an event loop run it in a
+thread, once per batch of readings. Concurrent checks of the same key
+may both be admitted; the limits are meant to stop runaway devices, not
+to count exactly.
+
+The cache must be shared by the worker processes (e.g. Memcached or
+Redis) for the limits to hold across them.
+"""
+
+throttled_requests = registry.counter(
+    "hydroponics_ingest_throttled_total",
+    "Ingestion requests rejected by a rate limit, by limit scope.",
+)
+
+
+def _key(scope, object_id):
+    return f"hydroponics:throttle:{scope}:{object_id}"
+
+
+def _admit(limits):
+    """
+    Charges GCRA buckets, all or none of them.
+
+    Args:
+        limits: A list of (scope, key, readings per minute, cost) tuples.
+
+    Returns:
+        The scope and the seconds to wait of the most restrictive
+        exceeded limit, or None if the readings are admitted.
+    """
+    burst = getattr(settings, "HYDROPONICS_RATE_LIMIT_BURST_SECONDS", 10)
+    now = time.time()
+    arrivals = cache.get_many([key for _, key, _, _ in limits])
+    updates, exceeded = {}, None
+    for scope, key, rate, cost in limits:
+        start = max(arrivals.get(key, now), now)
+        charge = cost * 60 / rate
+        # A batch over the burst only has to wait for the bucket to empty.
+        wait = start - now - max(burst, 60 / rate, charge) + charge
+        arrival = start + charge
+        if wait > 0 and (exceeded is None or wait > exceeded[1]):
+            exceeded = (scope, wait)
+        updates[key] = arrival
+    if exceeded is None:
+        cache.set_many(updates, timeout=math.ceil(max(updates.values()) - now) + 1)
+    return exceeded
+
+
+def throttle(owner_id, readings):
+    """
+    Checks readings against the rate limits of their sensors and of the
+    user owning them, and counts them if admitted.
+
+    Args:
+        owner_id: The ID of the user owning the sensors.
+        readings: A dict mapping sensor IDs to (rate limit of the system
+            or None, number of readings) pairs.
+
+    Raises:
+        Throttled: if a limit is exceeded; the readings are not counted.
+    """
+    default = getattr(settings, "HYDROPONICS_SENSOR_RATE_LIMIT", 60)
+    limits, total = [], 0
+    for sensor_id, (rate, count) in readings.items():
+        rate = rate or default
+        limits.append(("sensor", _key("sensor", sensor_id), rate, count))
+        total += count
+    user_rate = getattr(settings, "HYDROPONICS_USER_RATE_LIMIT", 6000)
+    limits.append(("user", _key("user", owner_id), user_rate, total))
+
+    exceeded = _admit(limits)
+    if exceeded is not None:
+        scope, wait = exceeded
+        throttled_requests.inc(scope=scope)
+        raise Throttled(
+            wait=math.ceil(wait), detail=f"The {scope} rate limit is exceeded."
+        )
+
+
+def throttle_ingestion(owner_id, sensor_ids):
+    """
+    Applies throttle() to readings validated by the API, given the
+    sensor ID of every reading, taking the limits of their systems from
+    the ownership resolver (where validation has cached them).
+    """
+    counts = Counter(sensor_ids)
+    entries = resolver.sensors_bulk(counts)
+    throttle(
+        owner_id,
+        {
+            sensor_id: (entries[sensor_id].rate_limit, count)
+            for sensor_id, count in counts.items()
+        },
+    )
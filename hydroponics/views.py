@@ -1,14 +1,51 @@
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Prefetch
+from django.http import FileResponse, HttpResponse, JsonResponse
+from django.utils import timezone
+from django.views.decorators.cache import cache_control, never_cache
+from django.views.decorators.http import condition, require_safe
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import filters, viewsets
+from drf_yasg import openapi
+from drf_yasg.utils import swagger_auto_schema
+from rest_framework import filters, mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from .filters import MeasurementFilter, SensorFilter
-from .models import HydroponicSystem, Measurement, Sensor
+from .alerts import evaluate_measurements
+from .budgets import QueryBudgetMixin, TimeWindowFilterBackend
+from .chunks import MergedMeasurements, filterset_lookups, merged_reads_enabled
+from .filters import AlertEventFilter, MeasurementFilter, SensorFilter
+from .fleet import fleet_summary
+from .ingest import get_buffer, is_buffered, to_record, write_measurements
+from .jobs import enqueue
+from .metrics import registry
+from .models import (AlertEvent, AlertRule, HydroponicSystem, Job, Measurement,
+                     Sensor, Tombstone)
+from .ownership import resolver
 from .pagination import AddPageNumberPagination
-from .permissions import IsOwner
-from .serializers import (HydroponicSystemDetailSerializer,
-                          HydroponicSystemSerializer, MeasurementSerializer,
-                          SensorSerializer)
+from .permissions import IsMetricsClient, IsOwner
+from .provisioning import provision
+from .readings import latest_measurements
+from .schema import load_schema
+from .serializers import (AlertEventSerializer, AlertRuleSerializer,
+                          FleetSummaryQuerySerializer, FleetSystemSerializer,
+                          HydroponicSystemDetailSerializer,
+                          HydroponicSystemSerializer, JobSerializer,
+                          LatestMeasurementsQuerySerializer,
+                          LatestMeasurementsSerializer, MeasurementSerializer,
+                          ProvisionedSystemSerializer, ProvisioningSerializer,
+                          SensorSerializer, StatsQuerySerializer,
+                          SyncSerializer)
+from .server import readiness_problems
+from .sharding import TenantRoutingMixin, is_sharded
+from .stats import window_stats
+from .sync import changes_since
+from .tasks import files_dir
+from .throttling import throttle_ingestion
 
 """
 Defintion of ViewSets for HydroponicSystem, Sensor, and Measurement.
@@ -16,7 +53,9 @@ Handling of CRUD operations, filtering, ordering, pagination, and permission che
 """
 
 
-class HydroponicSystemViewSet(viewsets.ModelViewSet):
+class HydroponicSystemViewSet(
+    QueryBudgetMixin, TenantRoutingMixin, viewsets.ModelViewSet
+):
     """
     A ViewSet for managing HydroponicSystem objects.
 
@@ -24,7 +63,10 @@ class HydroponicSystemViewSet(viewsets.ModelViewSet):
       - GET (list/retrieve): List or detail view of systems.
       - POST: Create a new system.
       - PUT/PATCH: Update an existing system.
-      - DELETE: Delete a system.
+      - DELETE: Mark a system for deletion (purged in the background).
+      - GET stats: Measurement statistics per sensor type in a time window.
+      - GET summary: Latest readings and health of all systems at once.
+      - POST provision: Create many systems with their sensors at once.
 
     Features: filters, ordering, pagination, permissions.
 
@@ -67,16 +109,100 @@ class HydroponicSystemViewSet(viewsets.ModelViewSet):
         """
         Restricts the queryset to HydroponicSystems owned by the current user.
         """
-        return HydroponicSystem.objects.filter(owner=self.request.user)
+        queryset = HydroponicSystem.objects.filter(
+            owner_id=self.request.user.id
+        ).prefetch_related(
+            Prefetch("sensors", queryset=Sensor.objects.only("id", "system_id"))
+        )
+        # Users are not joinable from shards other than the default database.
+        if is_sharded():
+            return queryset.prefetch_related("owner")
+        return queryset.select_related("owner")
 
     def perform_create(self, serializer):
         """
         Sets the owner of the created HydroponicSystem to the current user.
         """
-        serializer.save(owner=self.request.user)
+        serializer.save(owner_id=self.request.user.id)
 
+    def perform_destroy(self, instance):
+        """
+        Hides the system at once; its data is deleted by a background job.
+        """
+        instance.mark_for_deletion()
+        enqueue("purge_deleted", unique=True)
+
+    @action(detail=True, methods=["get"])
+    def stats(self, request, pk=None):
+        """
+        Returns statistics of the system's measurements in a time window,
+        grouped by sensor type.
+        """
+        system = self.get_object()
+        query = StatsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        method, results = window_stats(
+            Sensor.objects.filter(system=system),
+            params["start"],
+            params["end"],
+            params["percentiles"],
+            group_by="sensor_type",
+        )
+        return Response(
+            {
+                "system": system.id,
+                "start": params["start"],
+                "end": params["end"],
+                "method": method,
+                "results": [
+                    {"sensor_type": sensor_type, **summary}
+                    for sensor_type, summary in results.items()
+                ],
+            }
+        )
+
+    @swagger_auto_schema(
+        query_serializer=FleetSummaryQuerySerializer,
+        responses={200: FleetSystemSerializer(many=True)},
+    )
+    @action(detail=False, methods=["get"], filter_backends=[], pagination_class=None)
+    def summary(self, request):
+        """
+        Returns the health summary of all systems of the user: the sensor
+        count, the latest reading of each sensor type, the time since the
+        last reading and the number of sensors out of the allowed ranges.
+        """
+        query = FleetSummaryQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        systems = fleet_summary(request.user.id, query.validated_data["ordering"])
+        return Response(FleetSystemSerializer(systems, many=True).data)
+
+    @swagger_auto_schema(
+        request_body=ProvisioningSerializer,
+        responses={201: ProvisionedSystemSerializer(many=True)},
+    )
+    @action(detail=False, methods=["post"])
+    def provision(self, request):
+        """
+        Creates systems and their sensors (or adds sensors to existing
+        systems) from a nested document in one transaction. Returns the
+        created IDs in the order of the document.
+        """
+        serializer = ProvisioningSerializer(
+            data=request.data, context={"owner_id": request.user.id}
+        )
+        serializer.is_valid(raise_exception=True)
+        systems = provision(request.user.id, serializer.validated_data["systems"])
+        return Response(
+            ProvisionedSystemSerializer(systems, many=True).data,
+            status=status.HTTP_201_CREATED,
+        )
 
-class SensorViewSet(viewsets.ModelViewSet):
+
+class SensorViewSet(
+    QueryBudgetMixin, TenantRoutingMixin, viewsets.ModelViewSet
+):
     """
     A ViewSet for managing Sensor objects.
 
@@ -84,7 +210,9 @@ class SensorViewSet(viewsets.ModelViewSet):
       - GET (list/retrieve): List or detail view of sensors.
       - POST: Create a new sensor.
       - PUT/PATCH: Update an existing sensor.
-      - DELETE: Delete a sensor.
+      - DELETE: Mark a sensor for deletion (purged in the background).
+      - GET stats: Measurement statistics of the sensor in a time window.
+      - POST api-key: Issue an API key for the line-protocol listener.
 
     Features: filtering, ordering, pagination, permissions.
 
@@ -113,22 +241,79 @@ class SensorViewSet(viewsets.ModelViewSet):
         """
         Restricts the queryset to sensors in systems owned by the current user.
         """
-        return Sensor.objects.filter(system__owner=self.request.user)
+        return Sensor.objects.filter(system__owner_id=self.request.user.id)
 
     def perform_create(self, serializer):
         serializer.save()
 
+    def perform_destroy(self, instance):
+        """
+        Hides the sensor at once; its data is deleted by a background job.
+        """
+        instance.mark_for_deletion()
+        enqueue("purge_deleted", unique=True)
+
+    @action(detail=True, methods=["post"], url_path="api-key")
+    def api_key(self, request, pk=None):
+        """
+        Issues a new API key for the line-protocol listener. The key is
+        returned only once; any previous key stops working.
+        """
+        sensor = self.get_object()
+        return Response(
+            {"sensor": sensor.id, "api_key": sensor.issue_api_key()},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=True, methods=["get"])
+    def stats(self, request, pk=None):
+        """
+        Returns statistics of the sensor's measurements in a time window.
+        """
+        sensor = self.get_object()
+        query = StatsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        method, results = window_stats(
+            Sensor.objects.filter(pk=sensor.pk),
+            params["start"],
+            params["end"],
+            params["percentiles"],
+        )
+        return Response(
+            {
+                "sensor": sensor.id,
+                "start": params["start"],
+                "end": params["end"],
+                "method": method,
+                **results[None],
+            }
+        )
+
 
-class MeasurementViewSet(viewsets.ModelViewSet):
+class MeasurementViewSet(
+    QueryBudgetMixin, TenantRoutingMixin, viewsets.ModelViewSet
+):
     """
     A ViewSet for managing Measurement objects.
 
     Provides:
       - GET (list/retrieve): List or detail view of measurements.
+        The list includes measurements sealed into chunks; those cannot
+        be retrieved, changed or deleted individually.
       - POST: Create a new measurement.
+      - POST batch: Create many measurements at once.
+      - GET latest: The latest measurements of several sensors at once.
       - PUT/PATCH: Update an existing measurement.
       - DELETE: Delete a measurement.
 
+    With HYDROPONICS_INGEST_MODE = "buffered", POST and POST batch validate
+    the readings, append them to the write-behind log and answer
+    202 Accepted; the readings are inserted shortly afterwards.
+
+    Lists without measured_at__gte are restricted to the time window of
+    the query budget (HYDROPONICS_QUERY_BUDGETS["measurement.list"]).
+
     Features: filtering, ordering, pagination, permissions.
 
     Attributes:
@@ -140,6 +325,7 @@ class MeasurementViewSet(viewsets.ModelViewSet):
         filterset_class: The custom SensorFilter for advanced filtering.
         ordering_fields: Fields allowed for ordering.
         ordering: Default ordering.
+        time_window_field: Field bounded by the time window of the query budget.
     """
 
     queryset = Measurement.objects.all()
@@ -147,8 +333,9 @@ class MeasurementViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated, IsOwner]
     pagination_class = AddPageNumberPagination
 
-    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filter_backends = [TimeWindowFilterBackend, filters.OrderingFilter]
     filterset_class = MeasurementFilter
+    time_window_field = "measured_at"
     ordering_fields = [
         "value",
         "measured_at",
@@ -163,7 +350,389 @@ class MeasurementViewSet(viewsets.ModelViewSet):
         """
         Restricts the queryset to measurements in systems owned by the current user.
         """
-        return Measurement.objects.filter(sensor__system__owner=self.request.user)
+        return Measurement.objects.filter(
+            Measurement.live, sensor__system__owner_id=self.request.user.id
+        )
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lists measurements, merged with the sealed readings of chunks
+        and of the archive when these are in use.
+        """
+        if not merged_reads_enabled():
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        filterset = TimeWindowFilterBackend().get_filterset(
+            request, self.get_queryset(), self
+        )
+        filterset.is_valid()
+        sensor_filters, lookups = filterset_lookups(filterset)
+        sensors = Sensor.objects.filter(
+            system__owner_id=request.user.id, **sensor_filters
+        )
+        ordering = filters.OrderingFilter().get_ordering(request, queryset, self)
+        measurements = MergedMeasurements(queryset, sensors, lookups, ordering)
+        page = self.paginate_queryset(measurements)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def create(self, request, *args, **kwargs):
+        """
+        Creates a measurement, or accepts it into the write-behind buffer.
+        """
+        if not is_buffered():
+            return super().create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self._throttle([serializer.validated_data])
+        return self._accept([serializer.validated_data])
 
     def perform_create(self, serializer):
-        serializer.save()
+        """
+        Saves the measurement and evaluates the alert rules of its sensor.
+        """
+        self._throttle([serializer.validated_data])
+        with transaction.atomic(using=router.db_for_write(Measurement)):
+            measurement = serializer.save()
+            evaluate_measurements([measurement])
+
+    def perform_destroy(self, instance):
+        """
+        Deletes the measurement, leaving a tombstone for synchronizing clients.
+        """
+        with transaction.atomic(using=router.db_for_write(Measurement)):
+            Tombstone.objects.create(
+                owner_id=self.request.user.id,
+                kind=Tombstone.MEASUREMENT,
+                object_id=instance.id,
+            )
+            instance.delete()
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """
+        Creates a list of measurements with batched inserts.
+        """
+        if not isinstance(request.data, list):
+            raise ValidationError("Expected a list of measurements.")
+        if len(request.data) > settings.HYDROPONICS_INGEST_MAX_BATCH:
+            raise ValidationError(
+                f"A batch may contain at most "
+                f"{settings.HYDROPONICS_INGEST_MAX_BATCH} measurements."
+            )
+        # Warms the ownership cache for all sensors with a single query.
+        resolver.sensors_bulk(
+            item["sensor"]
+            for item in request.data
+            if isinstance(item, dict) and isinstance(item.get("sensor"), int)
+        )
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self._throttle(serializer.validated_data)
+        if is_buffered():
+            return self._accept(serializer.validated_data)
+
+        measurements = write_measurements(
+            [Measurement(**item) for item in serializer.validated_data]
+        )
+        data = self.get_serializer(measurements, many=True).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(
+        query_serializer=LatestMeasurementsQuerySerializer,
+        responses={200: LatestMeasurementsSerializer(many=True)},
+        filter_inspectors=[],
+        paginator_inspectors=[],
+    )
+    @action(detail=False, methods=["get"])
+    def latest(self, request):
+        """
+        Returns the latest readings of each selected sensor (optionally
+        within a time range), including those sealed into chunks or
+        archived, with a single query for the measurement rows.
+        """
+        query = LatestMeasurementsQuerySerializer(
+            data=request.query_params, context={"request": request}
+        )
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        readings = latest_measurements(
+            params["sensors"],
+            params["limit"],
+            params.get("start"),
+            params.get("end"),
+        )
+        results = [
+            {"sensor": sensor_id, "measurements": measurements}
+            for sensor_id, measurements in readings.items()
+        ]
+        return Response(LatestMeasurementsSerializer(results, many=True).data)
+
+    def _throttle(self, readings):
+        """
+        Applies the ingestion rate limits to validated readings; exceeding
+        them is answered with 429 and a Retry-After header.
+        """
+        throttle_ingestion(
+            self.request.user.id, [item["sensor"].id for item in readings]
+        )
+
+    def _accept(self, readings):
+        """
+        Appends validated readings to the write-behind log.
+        """
+        now = timezone.now()
+        measurements = [Measurement(measured_at=now, **item) for item in readings]
+        get_buffer().submit(
+            [to_record(m.sensor_id, m.value, m.measured_at) for m in measurements]
+        )
+        if self.action == "batch":
+            data = self.get_serializer(measurements, many=True).data
+        else:
+            data = self.get_serializer(measurements[0]).data
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+
+class AlertRuleViewSet(
+    QueryBudgetMixin, TenantRoutingMixin, viewsets.ModelViewSet
+):
+    """
+    A ViewSet for managing AlertRule objects.
+
+    Provides:
+      - GET (list/retrieve): List or detail view of alert rules.
+      - POST: Create a new rule.
+      - PUT/PATCH: Update an existing rule.
+      - DELETE: Delete a rule.
+
+    Attributes:
+        queryset: Base queryset restricted to rules owned by the user.
+        serializer_class: Default serializer.
+        permission_classes: List of permission checks.
+        pagination_class: Custom pagination class.
+        filter_backends: List of filter backends.
+        filterset_fields: Dict specifying how to filter.
+        ordering_fields: Fields allowed for ordering.
+        ordering: Default ordering.
+    """
+
+    queryset = AlertRule.objects.all()
+    serializer_class = AlertRuleSerializer
+    permission_classes = [IsAuthenticated, IsOwner]
+    pagination_class = AddPageNumberPagination
+
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_fields = {
+        "sensor": ["exact"],
+        "sensor_type": ["exact"],
+        "kind": ["exact"],
+        "is_active": ["exact"],
+    }
+    ordering_fields = ["name", "created_at"]
+    ordering = ["-created_at"]
+
+    def get_queryset(self):
+        """
+        Restricts the queryset to alert rules owned by the current user.
+        """
+        return AlertRule.objects.filter(AlertRule.live, owner_id=self.request.user.id)
+
+    def perform_create(self, serializer):
+        """
+        Sets the owner of the created rule to the current user.
+        """
+        serializer.save(owner_id=self.request.user.id)
+
+
+class AlertEventViewSet(
+    QueryBudgetMixin, TenantRoutingMixin, viewsets.ReadOnlyModelViewSet
+):
+    """
+    A read-only ViewSet for AlertEvent objects.
+
+    Provides:
+      - GET (list/retrieve): List or detail view of raised alerts.
+
+    Attributes:
+        queryset: Base queryset restricted to alerts of the user's rules.
+        serializer_class: Default serializer.
+        permission_classes: List of permission checks.
+        pagination_class: Custom pagination class.
+        filter_backends: List of filter backends.
+        filterset_class: The custom AlertEventFilter for advanced filtering.
+        ordering_fields: Fields allowed for ordering.
+        ordering: Default ordering.
+    """
+
+    queryset = AlertEvent.objects.all()
+    serializer_class = AlertEventSerializer
+    permission_classes = [IsAuthenticated, IsOwner]
+    pagination_class = AddPageNumberPagination
+
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_class = AlertEventFilter
+    ordering_fields = ["measured_at", "created_at"]
+    ordering = ["-measured_at"]
+
+    def get_queryset(self):
+        """
+        Restricts the queryset to alerts raised by the current user's rules.
+        """
+        return AlertEvent.objects.filter(
+            AlertEvent.live, rule__owner_id=self.request.user.id
+        ).select_related("rule")
+
+
+class JobViewSet(
+    QueryBudgetMixin,
+    TenantRoutingMixin,
+    mixins.CreateModelMixin,
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    viewsets.GenericViewSet,
+):
+    """
+    A ViewSet for background jobs of the current user.
+
+    Provides:
+      - GET (list/retrieve): List or detail view of jobs with their progress.
+      - POST: Enqueue a job of a registered kind.
+      - POST cancel: Cancel a queued or running job.
+      - GET download: Download the file produced by a job.
+
+    Attributes:
+        queryset: Base queryset restricted to jobs of the user.
+        serializer_class: Default serializer.
+        permission_classes: List of permission checks.
+        pagination_class: Custom pagination class.
+        filter_backends: List of filter backends.
+        filterset_fields: Dict specifying how to filter.
+        ordering_fields: Fields allowed for ordering.
+        ordering: Default ordering.
+    """
+
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = AddPageNumberPagination
+
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_fields = {
+        "kind": ["exact"],
+        "status": ["exact"],
+    }
+    ordering_fields = ["created_at", "finished_at"]
+    ordering = ["-created_at"]
+
+    def get_queryset(self):
+        """
+        Restricts the queryset to jobs enqueued by the current user.
+        """
+        return Job.objects.filter(owner_id=self.request.user.id)
+
+    def perform_create(self, serializer):
+        """
+        Sets the owner of the enqueued job to the current user.
+        """
+        serializer.save(owner_id=self.request.user.id)
+
+    @action(detail=True, methods=["post"])
+    def cancel(self, request, pk=None):
+        """
+        Cancels a job that has not finished; a running job stops at its
+        next progress report.
+        """
+        job = self.get_object()
+        Job.objects.filter(pk=job.pk, status__in=[Job.QUEUED, Job.RUNNING]).update(
+            status=Job.CANCELLED, lease_expires_at=None, finished_at=timezone.now()
+        )
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        """
+        Returns the file produced by a succeeded job.
+        """
+        job = self.get_object()
+        name = (job.result or {}).get("file") if job.status == Job.SUCCEEDED else None
+        if not name or not (files_dir() / name).is_file():
+            raise NotFound("The job has not produced a file.")
+        return FileResponse(open(files_dir() / name, "rb"), as_attachment=True)
+
+
+class SyncView(TenantRoutingMixin, APIView):
+    """
+    Returns the systems, sensors and measurements of the current user
+    created, updated or deleted since the watermark passed in the
+    `watermark` query parameter (everything when omitted), together
+    with the watermark for the next sync.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "watermark",
+                openapi.IN_QUERY,
+                description="Watermark returned by the previous sync.",
+                type=openapi.TYPE_STRING,
+            )
+        ],
+        responses={200: SyncSerializer},
+    )
+    def get(self, request):
+        changes = changes_since(request.user.id, request.query_params.get("watermark"))
+        return Response(SyncSerializer(changes, context={"request": request}).data)
+
+
+class MetricsView(APIView):
+    """
+    Exposes the metrics in the Prometheus text format: those of all the
+    processes sharing them (see hydroponics.metrics), or else of the
+    worker process answering.
+    """
+
+    permission_classes = [IsMetricsClient]
+
+    def get(self, request):
+        return HttpResponse(
+            registry.render(), content_type="text/plain; version=0.0.4"
+        )
+
+
+@require_safe
+@cache_control(public=True, no_cache=True)
+@condition(etag_func=lambda request: load_schema()[1])
+def openapi_schema(request):
+    """
+    Serves the pre-generated OpenAPI document. Clients revalidate it
+    with its strong ETag and get 304 Not Modified until it changes.
+    """
+    content, _ = load_schema()
+    return HttpResponse(content, content_type="application/json")
+
+
+@require_safe
+@never_cache
+def liveness(request):
+    """
+    Answers as long as the worker process serves requests.
+    """
+    return JsonResponse({"status": "ok"})
+
+
+@require_safe
+@never_cache
+def readiness(request):
+    """
+    Answers 200 when the worker can serve API requests, or 503 with the
+    problems found, e.g. an unreachable database.
+    """
+    problems = readiness_problems()
+    if problems:
+        return JsonResponse(
+            {"status": "unavailable", "problems": problems}, status=503
+        )
+    return JsonResponse({"status": "ok"})